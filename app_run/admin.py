@@ -1,7 +1,32 @@
 from django.contrib import admin
+from django.db import transaction
+
 from . import models
+from .utils import recompute_run_totals
+
+
+@admin.register(models.Positions)
+class PositionsAdmin(admin.ModelAdmin):
+    # Deletes bypass the post_save signal that keeps run totals in step, so rebuild them here
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            super().delete_model(request, obj)
+            recompute_run_totals(obj.run_id)
+
+    def delete_queryset(self, request, queryset):
+        run_ids = set(queryset.values_list('run_id', flat=True))
+        with transaction.atomic():
+            super().delete_queryset(request, queryset)
+            for run_id in run_ids:
+                recompute_run_totals(run_id)
+
 
 admin.site.register(models.Run)
 admin.site.register(models.Challenge)
-admin.site.register(models.Positions)
 admin.site.register(models.CollectibleItem)
+admin.site.register(models.RunArchive)
+admin.site.register(models.Task)
+admin.site.register(models.AthleteStats)
+admin.site.register(models.LeaderboardEntry)
+admin.site.register(models.RunRollup)
+admin.site.register(models.ImportJob)
@@ -0,0 +1,92 @@
+import struct
+import zlib
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+# Archived tracks are stored column by column:
+#   id, latitude, longitude, date_time  int64 deltas (coordinates in 1e-7 degrees, times in microseconds)
+#   date_time null mask                 packed bits
+#   speed, distance                     float32, NaN for null
+# and the whole blob is zlib-compressed.
+MAGIC = b'RTRK'
+VERSION = 1
+HEADER = struct.Struct('<4sBI')
+COORDINATE_SCALE = 10 ** 7
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _deltas(values):
+    values = np.asarray(values, dtype=np.int64)
+    return np.diff(values, prepend=np.int64(0)).astype('<i8').tobytes()
+
+
+def _undeltas(buffer, offset, count):
+    values = np.cumsum(np.frombuffer(buffer, dtype='<i8', count=count, offset=offset), dtype=np.int64)
+    return values, offset + count * 8
+
+
+def _floats(values):
+    return np.array([np.nan if value is None else value for value in values], dtype='<f4').tobytes()
+
+
+def _unfloats(buffer, offset, count):
+    values = np.frombuffer(buffer, dtype='<f4', count=count, offset=offset)
+    # str() of a float32 is its shortest round-tripping form, so 4.17 comes back as 4.17
+    return [None if np.isnan(value) else float(text) for value, text in zip(values, values.astype(str))], \
+        offset + count * 4
+
+
+def pack_track(rows):
+    """Pack (id, latitude, longitude, date_time, speed, distance) rows into a compressed blob."""
+    ids, latitudes, longitudes, date_times, speeds, distances = zip(*rows) if rows else ((),) * 6
+
+    has_time = np.array([date_time is not None for date_time in date_times], dtype=bool)
+    micros = []
+    previous = 0
+    for date_time in date_times:
+        if date_time is not None:
+            delta = date_time - EPOCH
+            previous = (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+        micros.append(previous)
+
+    body = b''.join([
+        _deltas(ids),
+        _deltas(np.round(np.asarray(latitudes, dtype=np.float64) * COORDINATE_SCALE)),
+        _deltas(np.round(np.asarray(longitudes, dtype=np.float64) * COORDINATE_SCALE)),
+        _deltas(micros),
+        np.packbits(has_time).tobytes(),
+        _floats(speeds),
+        _floats(distances),
+    ])
+    return zlib.compress(HEADER.pack(MAGIC, VERSION, len(ids)) + body, 9)
+
+
+def unpack_track(blob):
+    """Rows packed by pack_track, in the same order and shape."""
+    buffer = zlib.decompress(bytes(blob))
+    magic, version, count = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a packed run track')
+
+    offset = HEADER.size
+    ids, offset = _undeltas(buffer, offset, count)
+    latitudes, offset = _undeltas(buffer, offset, count)
+    longitudes, offset = _undeltas(buffer, offset, count)
+    micros, offset = _undeltas(buffer, offset, count)
+    mask_size = (count + 7) // 8
+    has_time = np.unpackbits(np.frombuffer(buffer, dtype=np.uint8, count=mask_size, offset=offset),
+                             count=count).astype(bool)
+    offset += mask_size
+    speeds, offset = _unfloats(buffer, offset, count)
+    distances, offset = _unfloats(buffer, offset, count)
+
+    return [
+        (int(ids[i]),
+         int(latitudes[i]) / COORDINATE_SCALE,
+         int(longitudes[i]) / COORDINATE_SCALE,
+         EPOCH + timedelta(microseconds=int(micros[i])) if has_time[i] else None,
+         speeds[i],
+         distances[i])
+        for i in range(count)
+    ]
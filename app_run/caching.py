@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+KEY_PREFIX = 'response_cache'
+COUNTERS = ('hits', 'stale', 'misses')
+
+# Counted in memory: writing them to a shared cache would add queries to every hit
+_counters = Counter()
+_counters_lock = threading.Lock()
+
+
+def response_cache():
+    return caches[settings.RESPONSE_CACHE_ALIAS]
+
+
+def _options(name):
+    options = settings.RESPONSE_CACHE.get(name, {})
+    return options.get('ttl', 30), options.get('stale_ttl', 300)
+
+
+def _count(name, counter):
+    with _counters_lock:
+        _counters[name, counter] += 1
+
+
+def cache_counters(name):
+    """Hits, stale hits and misses of one cached endpoint in this process."""
+    with _counters_lock:
+        return {counter: _counters[name, counter] for counter in COUNTERS}
+
+
+def reset_cache_counters():
+    with _counters_lock:
+        _counters.clear()
+
+
+def _store(key, lock_key, compute, ttl, stale_ttl):
+    try:
+        value = compute()
+        response_cache().set(key, (value, time.time() + ttl), timeout=ttl + stale_ttl)
+        return value
+    finally:
+        response_cache().delete(lock_key)
+
+
+def _refresh_in_background(key, lock_key, compute, ttl, stale_ttl):
+    def refresh():
+        try:
+            _store(key, lock_key, compute, ttl, stale_ttl)
+        finally:
+            connection.close()
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def cached(name, key, compute):
+    """
+    Value of ``compute()`` cached under ``key`` with the TTLs configured for ``name`` in RESPONSE_CACHE.
+
+    Fresh entries are returned as they are. Entries past their ttl but within stale_ttl are still
+    returned while a single request recomputes them, and concurrent misses wait for the one request
+    that computes the value instead of all hitting the database.
+    """
+    ttl, stale_ttl = _options(name)
+    key = f'{KEY_PREFIX}:{name}:{key}'
+    lock_key = f'{key}:lock'
+
+    cache = response_cache()
+    entry = cache.get(key)
+    if entry is not None:
+        value, fresh_until = entry
+        if fresh_until > time.time():
+            _count(name, 'hits')
+            return value
+
+        _count(name, 'stale')
+        if cache.add(lock_key, 1, timeout=settings.RESPONSE_CACHE_LOCK_SECONDS):
+            if settings.RESPONSE_CACHE_REFRESH_IN_BACKGROUND:
+                _refresh_in_background(key, lock_key, compute, ttl, stale_ttl)
+            else:
+                _store(key, lock_key, compute, ttl, stale_ttl)
+        return value
+
+    _count(name, 'misses')
+    deadline = time.time() + settings.RESPONSE_CACHE_LOCK_SECONDS
+    while not cache.add(lock_key, 1, timeout=settings.RESPONSE_CACHE_LOCK_SECONDS):
+        # Someone else is computing this value, use theirs once it lands
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
+        if time.time() > deadline:
+            return compute()
+    return _store(key, lock_key, compute, ttl, stale_ttl)
@@ -0,0 +1,60 @@
+from .models import AthleteStats, Challenge
+
+CHALLENGE_RULES = {}
+
+
+class ChallengeContext:
+    """What rules get to look at: the athlete's stats and, on a stop, the run that just finished."""
+    __slots__ = ('athlete_id', 'stats', 'run')
+
+    def __init__(self, athlete_id, stats, run=None):
+        self.athlete_id = athlete_id
+        self.stats = stats
+        self.run = run
+
+
+def challenge_rule(name):
+    """Register ``rule(context) -> bool`` as the condition for earning the challenge ``name``."""
+    def register(rule):
+        CHALLENGE_RULES[name] = rule
+        return rule
+    return register
+
+
+@challenge_rule(Challenge.NameChoices.RUN10)
+def ten_runs(context):
+    return context.stats.runs_finished >= 10
+
+
+@challenge_rule(Challenge.NameChoices.RUN50KM)
+def fifty_kilometers(context):
+    return context.stats.total_distance >= 50
+
+
+@challenge_rule(Challenge.NameChoices.RUN2KMIN10M)
+def two_kilometers_in_ten_minutes(context):
+    run = context.run
+    return (run is not None and run.distance is not None and run.distance >= 2 and
+            run.run_time_seconds is not None and run.run_time_seconds <= 600)
+
+
+def earned_challenges(contexts):
+    """(athlete_id, challenge name) pairs earned in the given contexts."""
+    return {(context.athlete_id, name)
+            for context in contexts
+            for name, rule in CHALLENGE_RULES.items()
+            if rule(context)}
+
+
+def evaluate_challenges(contexts):
+    """Run every rule against every context and insert the earned challenges in one query."""
+    awards = [Challenge(athlete_id=athlete_id, full_name=name) for athlete_id, name in earned_challenges(contexts)]
+    if awards:
+        Challenge.objects.bulk_create(awards, ignore_conflicts=True)
+    return awards
+
+
+def award_challenges(athlete_id, stats=None, run=None):
+    if stats is None:
+        stats = AthleteStats.objects.filter(athlete_id=athlete_id).first() or AthleteStats(athlete_id=athlete_id)
+    return evaluate_challenges([ChallengeContext(athlete_id, stats, run)])
@@ -0,0 +1,316 @@
+import math
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from geopy.distance import geodesic
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+EARTH_RADIUS_KM = 6371.0088
+
+# Lower bounds of the length of one degree on WGS-84, so boxes built from them never cut a radius short
+METERS_PER_DEGREE_LATITUDE = 110574.0
+METERS_PER_DEGREE_LONGITUDE_AT_EQUATOR = 111320.0
+
+VINCENTY_MAX_ITERATIONS = 200
+VINCENTY_TOLERANCE = 1e-12
+
+
+def _as_arrays(points):
+    coords = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return coords[:, 0], coords[:, 1]
+
+
+def geodesic_segments(latitudes, longitudes):
+    """Exact segment lengths in km computed with geopy, one pair at a time."""
+    return np.array([
+        geodesic((latitudes[i], longitudes[i]), (latitudes[i + 1], longitudes[i + 1])).kilometers
+        for i in range(len(latitudes) - 1)
+    ], dtype=np.float64)
+
+
+def haversine_segments(latitudes, longitudes):
+    """Great-circle segment lengths in km on a sphere of the mean Earth radius."""
+    lat = np.radians(latitudes)
+    lon = np.radians(longitudes)
+    d_lat = np.diff(lat)
+    d_lon = np.diff(lon)
+    h = np.sin(d_lat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def vincenty_segments(latitudes, longitudes):
+    """Segment lengths in km on the WGS-84 ellipsoid (Vincenty's inverse formula).
+
+    All segments are iterated together; the few that do not converge (nearly
+    antipodal points) are recomputed with geopy.
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    if len(latitudes) < 2:
+        return np.zeros(0, dtype=np.float64)
+
+    u = np.arctan((1 - WGS84_F) * np.tan(np.radians(latitudes)))
+    sin_u1, sin_u2 = np.sin(u[:-1]), np.sin(u[1:])
+    cos_u1, cos_u2 = np.cos(u[:-1]), np.cos(u[1:])
+    big_l = np.radians(np.diff(longitudes))
+    big_l = (big_l + np.pi) % (2 * np.pi) - np.pi
+
+    lam = big_l.copy()
+    converged = np.zeros(lam.shape, dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(VINCENTY_MAX_ITERATIONS):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            cos_2sigma_m = np.where(cos_sq_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos_sq_alpha)
+            c = WGS84_F / 16 * cos_sq_alpha * (4 + WGS84_F * (4 - 3 * cos_sq_alpha))
+            lam_next = big_l + (1 - c) * WGS84_F * sin_alpha * (
+                    sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam_next - lam) <= VINCENTY_TOLERANCE
+            lam = lam_next
+            if converged.all():
+                break
+
+        u_sq = cos_sq_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+                cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+                big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        segments = WGS84_B * big_a * (sigma - delta_sigma) / 1000
+
+    for i in np.flatnonzero(~converged | ~np.isfinite(segments)):
+        segments[i] = geodesic((latitudes[i], longitudes[i]), (latitudes[i + 1], longitudes[i + 1])).kilometers
+    return segments
+
+
+DISTANCE_ENGINES = {
+    'geodesic': geodesic_segments,
+    'vincenty': vincenty_segments,
+    'haversine': haversine_segments,
+}
+
+
+def get_distance_engine(name=None):
+    name = name or getattr(settings, 'RUN_DISTANCE_ENGINE', 'vincenty')
+    try:
+        return DISTANCE_ENGINES[name]
+    except KeyError:
+        raise ValueError(f'Unknown distance engine "{name}"; expected one of {sorted(DISTANCE_ENGINES)}')
+
+
+def segment_lengths(points, engine=None):
+    """Lengths in km of the segments between consecutive (latitude, longitude) points."""
+    latitudes, longitudes = _as_arrays(points)
+    if len(latitudes) < 2:
+        return np.zeros(0, dtype=np.float64)
+    return get_distance_engine(engine)(latitudes, longitudes)
+
+
+def track_length(points, engine=None):
+    return float(segment_lengths(points, engine).sum())
+
+
+def distances_from(origin, points, engine=None):
+    """Lengths in km from the ``origin`` point to each of the (latitude, longitude) points."""
+    latitudes, longitudes = _as_arrays(points)
+    # origin, p1, origin, p2, ...: every other segment of this path starts at the origin
+    path = np.empty((2 * len(latitudes), 2), dtype=np.float64)
+    path[0::2] = origin
+    path[1::2, 0] = latitudes
+    path[1::2, 1] = longitudes
+    return segment_lengths(path, engine)[0::2]
+
+
+def bounding_box(points, radius_m):
+    """Box containing everything within ``radius_m`` metres of any of the (latitude, longitude) points.
+
+    Returns ``(min_latitude, max_latitude, longitude_ranges)``; there are two longitude
+    ranges when the box crosses the antimeridian.
+    """
+    latitudes, longitudes = _as_arrays(points)
+    d_lat = radius_m / METERS_PER_DEGREE_LATITUDE
+    min_lat = max(float(latitudes.min()) - d_lat, -90.0)
+    max_lat = min(float(latitudes.max()) + d_lat, 90.0)
+
+    widest_lat = max(abs(min_lat), abs(max_lat))
+    if widest_lat >= 90:
+        return min_lat, max_lat, [(-180.0, 180.0)]
+    d_lon = radius_m / (METERS_PER_DEGREE_LONGITUDE_AT_EQUATOR * np.cos(np.radians(widest_lat)))
+    min_lon = float(longitudes.min()) - d_lon
+    max_lon = float(longitudes.max()) + d_lon
+
+    if max_lon - min_lon >= 180:
+        # Either a huge radius or points on both sides of the antimeridian
+        return min_lat, max_lat, [(-180.0, 180.0)]
+    if min_lon < -180:
+        return min_lat, max_lat, [(min_lon + 360, 180.0), (-180.0, max_lon)]
+    if max_lon > 180:
+        return min_lat, max_lat, [(min_lon, 180.0), (-180.0, max_lon - 360)]
+    return min_lat, max_lat, [(min_lon, max_lon)]
+
+
+class GridIndex:
+    """In-memory spatial index bucketing ``(key, latitude, longitude)`` entries into square grid cells."""
+
+    def __init__(self, entries, cell_degrees=0.01):
+        self.cell_degrees = cell_degrees
+        self.cells = defaultdict(list)
+        self.size = 0
+        for key, latitude, longitude in entries:
+            self.cells[self._cell(latitude, longitude)].append((key, latitude, longitude))
+            self.size += 1
+
+    def _cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    def _cells_in_box(self, min_lat, max_lat, longitude_ranges):
+        min_row, _ = self._cell(min_lat, 0)
+        max_row, _ = self._cell(max_lat, 0)
+        for min_lon, max_lon in longitude_ranges:
+            _, min_col = self._cell(0, min_lon)
+            _, max_col = self._cell(0, max_lon)
+            if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self.cells):
+                # Cheaper to walk the occupied cells than every cell of a huge box
+                for (row, col), entries in self.cells.items():
+                    if min_row <= row <= max_row and min_col <= col <= max_col:
+                        yield entries
+                continue
+            for row in range(min_row, max_row + 1):
+                for col in range(min_col, max_col + 1):
+                    entries = self.cells.get((row, col))
+                    if entries:
+                        yield entries
+
+    def candidates(self, points, radius_m):
+        """Entries inside the bounding box of ``radius_m`` metres around any of the points."""
+        seen = set()
+        for point in points:
+            min_lat, max_lat, longitude_ranges = bounding_box([point], radius_m)
+            for entries in self._cells_in_box(min_lat, max_lat, longitude_ranges):
+                for key, latitude, longitude in entries:
+                    if key in seen or not min_lat <= latitude <= max_lat:
+                        continue
+                    if any(min_lon <= longitude <= max_lon for min_lon, max_lon in longitude_ranges):
+                        seen.add(key)
+                        yield key, latitude, longitude
+
+
+def _encode_signed(value, chunks):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+
+
+def _decode_signed(encoded):
+    values = []
+    shift = result = 0
+    for char in encoded:
+        byte = ord(char) - 63
+        result |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(result >> 1) if result & 1 else result >> 1)
+            shift = result = 0
+    return values
+
+
+def encode_deltas(values):
+    """Encode a sequence of integers as their successive differences, polyline style."""
+    chunks = []
+    previous = 0
+    for value in values:
+        _encode_signed(value - previous, chunks)
+        previous = value
+    return ''.join(chunks)
+
+
+def decode_deltas(encoded):
+    return [int(value) for value in np.cumsum(_decode_signed(encoded), dtype=np.int64)]
+
+
+def encode_polyline(points, precision=5):
+    """Google encoded polyline of (latitude, longitude) points."""
+    factor = 10 ** precision
+    chunks = []
+    previous_lat = previous_lon = 0
+    for latitude, longitude in points:
+        lat, lon = round(latitude * factor), round(longitude * factor)
+        _encode_signed(lat - previous_lat, chunks)
+        _encode_signed(lon - previous_lon, chunks)
+        previous_lat, previous_lon = lat, lon
+    return ''.join(chunks)
+
+
+def decode_polyline(encoded, precision=5):
+    factor = 10 ** precision
+    values = _decode_signed(encoded)
+    latitudes = np.cumsum(values[0::2], dtype=np.int64)
+    longitudes = np.cumsum(values[1::2], dtype=np.int64)
+    return [(int(lat) / factor, int(lon) / factor) for lat, lon in zip(latitudes, longitudes)]
+
+
+def polyline_length(encoded):
+    """Number of points in an encoded polyline, without decoding it."""
+    return sum(1 for char in encoded if ord(char) - 63 < 0x20) // 2
+
+
+def douglas_peucker_ranks(points):
+    """Douglas-Peucker significance of every (latitude, longitude) point, in metres.
+
+    A point's rank is the largest tolerance at which Douglas-Peucker still keeps it,
+    so keeping the points ranked at or above a tolerance gives the simplified track
+    for that tolerance, and keeping the N best ranked points gives the best N-point
+    track. The endpoints are always kept and rank as infinity.
+    """
+    latitudes, longitudes = _as_arrays(points)
+    n = len(latitudes)
+    ranks = np.zeros(n, dtype=np.float64)
+    if n == 0:
+        return ranks
+    ranks[0] = ranks[-1] = np.inf
+
+    # Local equirectangular projection is accurate enough at track scale
+    y = latitudes * METERS_PER_DEGREE_LATITUDE
+    x = longitudes * METERS_PER_DEGREE_LONGITUDE_AT_EQUATOR * np.cos(np.radians(latitudes.mean()))
+
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        start, end, parent_rank = stack.pop()
+        if end - start < 2:
+            continue
+        px, py = x[start + 1:end], y[start + 1:end]
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        length_sq = dx * dx + dy * dy
+        if length_sq == 0:
+            distances = np.hypot(px - x[start], py - y[start])
+        else:
+            t = np.clip(((px - x[start]) * dx + (py - y[start]) * dy) / length_sq, 0, 1)
+            distances = np.hypot(px - (x[start] + t * dx), py - (y[start] + t * dy))
+        index = start + 1 + int(np.argmax(distances))
+        ranks[index] = min(float(distances[index - start - 1]), parent_rank)
+        stack.append((start, index, ranks[index]))
+        stack.append((index, end, ranks[index]))
+    return ranks
+
+
+def simplify_track(points, tolerance_m=None, max_points=None):
+    """Indices of the points kept by Douglas-Peucker simplification, in track order."""
+    ranks = douglas_peucker_ranks(points)
+    keep = np.ones(len(ranks), dtype=bool)
+    if tolerance_m is not None:
+        keep &= ranks >= tolerance_m
+    if max_points is not None and keep.sum() > max_points:
+        order = np.argsort(-ranks, kind='stable')
+        best = np.zeros(len(ranks), dtype=bool)
+        best[order[:max(max_points, 2)]] = True
+        keep &= best
+    return [int(index) for index in np.flatnonzero(keep)]
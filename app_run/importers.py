@@ -0,0 +1,321 @@
+import codecs
+import csv
+import json
+import math
+import os
+from contextlib import closing
+from io import BytesIO
+from itertools import islice
+from typing import Callable, NamedTuple
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from openpyxl import load_workbook
+
+from .models import CollectibleItem, ImportJob, ImportRejectedRow
+from .utils import bump_collectible_items_version, rebuild_athlete_stats, _Echo
+
+EXPECTED_HEADERS = ['Name', 'UID', 'Value', 'Latitude', 'Longitude', 'URL']
+IMPORT_CHUNK_SIZE = 1000
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+class WrongHeaders(Exception):
+    def __init__(self, headers):
+        super().__init__('Wrong headers')
+        self.headers = headers
+
+
+def _text(value):
+    if value is None or isinstance(value, bool):
+        raise ValueError
+    value = str(value).strip()
+    if not value:
+        raise ValueError
+    return value
+
+
+def _integer(value):
+    if isinstance(value, bool):
+        raise ValueError
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError
+        return int(value)
+    text = str(value).strip()
+    # Same as the serializer: '5.0' is accepted as 5
+    return int(text.rstrip('0').rstrip('.') if '.' in text else text)
+
+
+def _float(value):
+    if isinstance(value, bool):
+        raise ValueError
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError
+    return value
+
+
+# Spreadsheet column, model field and how the cell is parsed, in EXPECTED_HEADERS order
+ITEM_COLUMNS = (
+    ('name', _text),
+    ('uid', _text),
+    ('value', _integer),
+    ('latitude', _float),
+    ('longitude', _float),
+    ('picture', _text),
+)
+_ITEM_VALIDATORS = {name: CollectibleItem._meta.get_field(name).validators for name, _ in ITEM_COLUMNS}
+
+
+def validate_item_row(row):
+    """CollectibleItem built from a spreadsheet row, or None if any cell is invalid."""
+    data = {}
+    try:
+        for (name, parse), value in zip(ITEM_COLUMNS, row):
+            value = parse(value)
+            for validator in _ITEM_VALIDATORS[name]:
+                validator(value)
+            data[name] = value
+    except (TypeError, ValueError, ValidationError):
+        return None
+    if len(data) != len(ITEM_COLUMNS):
+        return None
+    return CollectibleItem(**data)
+
+
+def iter_xlsx_rows(file):
+    """Rows of the active sheet, streamed from a read-only workbook."""
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        yield from wb.active.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def xlsx_row_count(file):
+    """Data rows of the active sheet as recorded in its dimensions, or None when the file doesn't say."""
+    wb = load_workbook(file, read_only=True)
+    try:
+        max_row = wb.active.max_row
+    finally:
+        wb.close()
+    return max_row - 1 if max_row else None
+
+
+def _lines(file):
+    # Uploaded files and BytesIO both iterate line by line without reading the whole file
+    return codecs.iterdecode(file, 'utf-8-sig')
+
+
+def iter_csv_rows(file):
+    """Rows of a CSV file with empty cells as None, like blank spreadsheet cells."""
+    for row in csv.reader(_lines(file)):
+        yield tuple(cell if cell != '' else None for cell in row)
+
+
+def iter_ndjson_rows(file):
+    """
+    Header row and rows of a file with one JSON object per line, keyed by the spreadsheet headers.
+
+    The header row is taken from the keys of the first object; lines that aren't objects come out as
+    a one-cell row so they are reported as invalid.
+    """
+    headers = None
+    for line in _lines(file):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = None
+        if headers is None:
+            keys = list(item) if isinstance(item, dict) else []
+            # Key order doesn't matter in JSON, only that every expected header is there
+            headers = EXPECTED_HEADERS if sorted(keys) == sorted(EXPECTED_HEADERS) else keys
+            yield headers
+        if isinstance(item, dict):
+            yield tuple(item.get(header) for header in EXPECTED_HEADERS)
+        else:
+            yield (line.rstrip('\r\n'),)
+
+
+def text_row_count(file):
+    """Lines after the first one, a close enough guess of the rows in a CSV or NDJSON file."""
+    return max(sum(chunk.count(b'\n') for chunk in iter(lambda: file.read(1 << 20), b'')) - 1, 0)
+
+
+class ItemParser(NamedTuple):
+    content_types: tuple
+    extensions: tuple
+    iter_rows: Callable
+    count_rows: Callable
+
+
+# Upload formats, each streamed into the same header check, validation and bulk upsert
+ITEM_PARSERS = {
+    'xlsx': ItemParser(('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',), ('.xlsx',),
+                       iter_xlsx_rows, xlsx_row_count),
+    'csv': ItemParser(('text/csv',), ('.csv',), iter_csv_rows, text_row_count),
+    'ndjson': ItemParser(('application/x-ndjson', 'application/jsonl'), ('.ndjson', '.jsonl'),
+                         iter_ndjson_rows, text_row_count),
+}
+
+
+def detect_format(file_name, content_type=None):
+    """Key of ITEM_PARSERS for an upload, by its content type and failing that by its extension."""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    extension = os.path.splitext(file_name or '')[1].lower()
+    for name, parser in ITEM_PARSERS.items():
+        if content_type in parser.content_types:
+            return name
+    for name, parser in ITEM_PARSERS.items():
+        if extension in parser.extensions:
+            return name
+    raise UnsupportedFormat(f'Unsupported file format, expected one of: {", ".join(ITEM_PARSERS)}')
+
+
+def check_headers(rows):
+    """Consume the header row of ``rows``; raises WrongHeaders unless it matches EXPECTED_HEADERS."""
+    headers = list(next(rows, None) or [])
+    while headers and headers[-1] is None:
+        headers.pop()
+    if headers != EXPECTED_HEADERS:
+        raise WrongHeaders(headers)
+
+
+ITEM_FIELDS = [name for name, _ in ITEM_COLUMNS]
+ITEM_UPDATE_FIELDS = [name for name in ITEM_FIELDS if name != 'uid']
+
+
+def _upsert_items(items):
+    """
+    Insert new uids and update changed ones; returns inserted, updated and unchanged counts.
+
+    Athletes who collected an item whose value changed get their stats and leaderboard entries recomputed.
+    """
+    # Later rows of the same uid win, as they would have if written one by one
+    items = list({item.uid: item for item in items}.values())
+    existing = {row[0]: row[1:] for row in CollectibleItem.objects.filter(uid__in=[item.uid for item in items])
+                .values_list('uid', *ITEM_UPDATE_FIELDS)}
+    changed = [item for item in items
+               if existing.get(item.uid) != tuple(getattr(item, name) for name in ITEM_UPDATE_FIELDS)]
+    if changed:
+        CollectibleItem.objects.bulk_create(changed, update_conflicts=True, unique_fields=['uid'],
+                                            update_fields=ITEM_UPDATE_FIELDS)
+    value_index = ITEM_UPDATE_FIELDS.index('value')
+    revalued = [item.uid for item in changed if item.uid in existing and existing[item.uid][value_index] != item.value]
+    if revalued:
+        # Whoever collected a revalued item holds a different total now
+        collectors = (CollectibleItem.user.through.objects.filter(collectibleitem__uid__in=revalued)
+                      .values_list('user_id', flat=True).distinct())
+        rebuild_athlete_stats(athlete_ids=list(collectors))
+    inserted = sum(1 for item in changed if item.uid not in existing)
+    return inserted, len(changed) - inserted, len(items) - len(changed)
+
+
+def import_collectible_items(rows, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Validate and upsert item rows (header row already consumed) by uid, chunk by chunk.
+
+    Each chunk is written in its own transaction and yields a report of the rows it read, how many
+    items were inserted, updated or already up to date, and the invalid rows, so callers can report
+    progress without holding the whole file in memory. The catalog version is bumped once, when the
+    import ends or stops partway (close the generator to stop it early), if any chunk changed it.
+    """
+    rows = (tuple(row[:len(ITEM_COLUMNS)]) for row in rows if any(cell is not None for cell in row))
+    changed = False
+    try:
+        while chunk := list(islice(rows, chunk_size)):
+            items = []
+            invalid_rows = []
+            for row in chunk:
+                item = validate_item_row(row)
+                if item is None:
+                    invalid_rows.append(row)
+                else:
+                    items.append(item)
+            with transaction.atomic():
+                inserted, updated, unchanged = _upsert_items(items)
+            changed = changed or bool(inserted or updated)
+            yield {'rows': len(chunk), 'inserted': inserted, 'updated': updated, 'unchanged': unchanged,
+                   'invalid_rows': invalid_rows}
+    finally:
+        if changed:
+            bump_collectible_items_version()
+
+
+def import_report(chunks):
+    """Totals of the per-chunk reports of import_collectible_items."""
+    report = {'rows': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'invalid_rows': []}
+    for chunk in chunks:
+        for key, value in chunk.items():
+            report[key] += value
+    return report
+
+
+def run_import_job(job_id, chunk_size=IMPORT_CHUNK_SIZE, on_chunk=None):
+    """
+    Import the file of an ImportJob, recording progress and rejected rows after every chunk.
+
+    ``on_chunk`` is called after every chunk, e.g. to keep the lock of the task running the job fresh.
+
+    A retried job starts over: the upsert by uid makes already imported chunks come back as unchanged.
+    """
+    job = ImportJob.objects.get(id=job_id)
+    if job.status == ImportJob.Status.DONE:
+        return
+
+    job.rejected_rows.all().delete()
+    job.status = ImportJob.Status.RUNNING
+    job.started_at = timezone.now()
+    job.rows_processed = job.rows_rejected = job.inserted = job.updated = job.unchanged = 0
+    parser = ITEM_PARSERS[job.format]
+    job.total_rows = parser.count_rows(BytesIO(job.data))
+    progress_fields = ['rows_processed', 'rows_rejected', 'inserted', 'updated', 'unchanged']
+    job.save(update_fields=['status', 'started_at', 'total_rows'] + progress_fields)
+
+    rows = parser.iter_rows(BytesIO(job.data))
+    try:
+        check_headers(rows)
+    except WrongHeaders as e:
+        rows.close()
+        ImportJob.objects.filter(id=job.id).update(
+            status=ImportJob.Status.FAILED, finished_at=timezone.now(), data=b'',
+            error=f'Wrong headers: expected {EXPECTED_HEADERS}, got {e.headers}')
+        return
+
+    with closing(import_collectible_items(rows, chunk_size=chunk_size)) as chunks:
+        for chunk in chunks:
+            ImportRejectedRow.objects.bulk_create([ImportRejectedRow(job=job, row=list(row))
+                                                   for row in chunk['invalid_rows']])
+            job.rows_processed += chunk['rows']
+            job.rows_rejected += len(chunk['invalid_rows'])
+            job.inserted += chunk['inserted']
+            job.updated += chunk['updated']
+            job.unchanged += chunk['unchanged']
+            job.save(update_fields=progress_fields)
+            if on_chunk is not None:
+                on_chunk()
+
+    job.status = ImportJob.Status.DONE
+    job.finished_at = timezone.now()
+    job.data = b''
+    job.save(update_fields=['status', 'finished_at', 'data'])
+
+
+def mark_import_job_failed(job_id):
+    ImportJob.objects.filter(id=job_id).update(status=ImportJob.Status.FAILED, finished_at=timezone.now(),
+                                               error='Import failed after all retries')
+
+
+def iter_rejected_rows_csv(rows):
+    """Rejected rows as CSV under the EXPECTED_HEADERS header, so a fixed file can be uploaded again."""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPECTED_HEADERS)
+    for row in rows:
+        yield writer.writerow(row)
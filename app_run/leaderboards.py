@@ -0,0 +1,83 @@
+from django.db import transaction
+from django.db.models import Q
+
+from .models import AthleteStats, LeaderboardEntry
+
+# Score of an athlete on each board, None keeps them off it
+LEADERBOARDS = {
+    'total_distance': lambda stats: stats.total_distance if stats.runs_finished else None,
+    'runs_finished': lambda stats: stats.runs_finished or None,
+    'avg_speed': lambda stats: stats.avg_speed,
+    'items_value': lambda stats: stats.items_value if stats.items_count else None,
+}
+
+
+def update_leaderboards(stats_list):
+    """Write the scores of the given AthleteStats rows to every board."""
+    entries = []
+    off_board = {}
+    for stats in stats_list:
+        for board, score in LEADERBOARDS.items():
+            value = score(stats)
+            if value is None:
+                off_board.setdefault(board, []).append(stats.athlete_id)
+            else:
+                entries.append(LeaderboardEntry(board=board, athlete_id=stats.athlete_id, score=value))
+
+    if entries:
+        LeaderboardEntry.objects.bulk_create(entries, update_conflicts=True, unique_fields=['board', 'athlete'],
+                                             update_fields=['score'])
+    if off_board:
+        q = Q()
+        for board, athlete_ids in off_board.items():
+            q |= Q(board=board, athlete_id__in=athlete_ids)
+        LeaderboardEntry.objects.filter(q).delete()
+
+
+def _board_entries(board, coach_id=None):
+    entries = LeaderboardEntry.objects.filter(board=board)
+    if coach_id is not None:
+        entries = entries.filter(athlete__subscriptions__subscribed_to_id=coach_id)
+    return entries
+
+
+def top_entries(board, limit, coach_id=None):
+    """The first ``limit`` entries of a board, best first, ties broken by athlete id."""
+    entries = (_board_entries(board, coach_id)
+               .select_related('athlete')
+               .order_by('-score', 'athlete_id')[:limit])
+    return [(rank, entry) for rank, entry in enumerate(entries, start=1)]
+
+
+def athlete_rank(board, athlete_id, coach_id=None):
+    """
+    (rank, entry) of an athlete on a board, or None when they are not on it.
+
+    The rank is counted, not stored: the entries ahead are one range of leaderboard_rank_idx, counted
+    from the index alone, so the cost grows with the rank. On SQLite with 200k entries that is about
+    2 ms at the top of a board and 80 ms at the bottom, see the benchmark_leaderboard_rank command.
+    """
+    entry = _board_entries(board, coach_id).filter(athlete_id=athlete_id).first()
+    if entry is None:
+        return None
+    ahead = _board_entries(board, coach_id).filter(
+        Q(score__gt=entry.score) | Q(score=entry.score, athlete_id__lt=athlete_id)).count()
+    return ahead + 1, entry
+
+
+def rebuild_leaderboards(batch_size=1000):
+    """Replace every board with scores computed from the current AthleteStats rows."""
+    rebuilt = 0
+    batch = []
+    with transaction.atomic():
+        LeaderboardEntry.objects.all().delete()
+        for stats in AthleteStats.objects.order_by('id').iterator(chunk_size=batch_size):
+            batch.append(stats)
+            if len(batch) == batch_size:
+                update_leaderboards(batch)
+                rebuilt += len(batch)
+                batch = []
+        if batch:
+            update_leaderboards(batch)
+            rebuilt += len(batch)
+    return rebuilt
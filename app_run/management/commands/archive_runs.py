@@ -0,0 +1,41 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app_run.models import Run
+from app_run.utils import archive_run
+
+
+class Command(BaseCommand):
+    help = 'Pack the positions of finished runs into compact per-run archives and delete the rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30,
+                            help='Archive runs created at least this many days ago (default: 30)')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Archive at most this many runs')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many runs would be archived')
+
+    def handle(self, *args, days, limit, dry_run, **options):
+        runs = (Run.objects
+                .filter(status=Run.Status.FINISHED,
+                        created_at__lte=timezone.now() - timedelta(days=days),
+                        positions__isnull=False)
+                .distinct()
+                .order_by('id'))
+        if limit is not None:
+            runs = runs[:limit]
+
+        if dry_run:
+            self.stdout.write(f'{runs.count()} runs would be archived')
+            return
+
+        archived = points = 0
+        for run in runs.iterator(chunk_size=100):
+            archive = archive_run(run)
+            if archive:
+                archived += 1
+                points += archive.positions_count
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} runs ({points} positions)'))
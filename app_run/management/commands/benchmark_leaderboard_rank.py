@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app_run.leaderboards import LEADERBOARDS, athlete_rank
+from app_run.models import LeaderboardEntry
+
+
+class Command(BaseCommand):
+    help = 'Time "my rank" lookups at evenly spaced positions of a leaderboard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('board', choices=list(LEADERBOARDS))
+        parser.add_argument('--samples', type=int, default=5,
+                            help='Positions timed, from the top to the bottom of the board (default: 5)')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Lookups averaged per position (default: 20)')
+
+    def handle(self, *args, board, samples, repeat, **options):
+        entries = LeaderboardEntry.objects.filter(board=board).order_by('-score', 'athlete_id')
+        size = entries.count()
+        if not size:
+            raise CommandError(f'The {board} board is empty')
+
+        samples = max(min(samples, size), 1)
+        positions = sorted({round(i * (size - 1) / max(samples - 1, 1)) for i in range(samples)})
+        for position in positions:
+            athlete_id = entries.values_list('athlete_id', flat=True)[position]
+            athlete_rank(board, athlete_id)
+            started = time.perf_counter()
+            for _ in range(repeat):
+                rank, _ = athlete_rank(board, athlete_id)
+            elapsed = (time.perf_counter() - started) / repeat * 1000
+            self.stdout.write(f'rank {rank}/{size}: {elapsed:.3f} ms')
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from app_run.utils import rebuild_athlete_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute athlete stats from finished runs and collected items (backfill or repair)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--athlete', type=int, action='append', dest='athlete_ids',
+                            help='Only rebuild this athlete; may be given several times')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Stats rows written per query (default: 1000)')
+
+    def handle(self, *args, athlete_ids, batch_size, **options):
+        rebuilt = rebuild_athlete_stats(athlete_ids=athlete_ids, batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt stats of {rebuilt} athletes'))
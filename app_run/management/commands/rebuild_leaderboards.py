@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from app_run.leaderboards import rebuild_leaderboards
+from app_run.utils import rebuild_athlete_stats
+
+
+class Command(BaseCommand):
+    help = 'Rewrite every leaderboard from the athlete stats (consistency repair)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--with-stats', action='store_true',
+                            help='Rebuild the athlete stats from runs and items first')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Athletes written per query (default: 1000)')
+
+    def handle(self, *args, with_stats, batch_size, **options):
+        if with_stats:
+            rebuild_athlete_stats(batch_size=batch_size)
+        rebuilt = rebuild_leaderboards(batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt leaderboards of {rebuilt} athletes'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from app_run.utils import rebuild_run_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily, weekly and monthly run rollups from finished runs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--athlete', type=int, action='append', dest='athlete_ids',
+                            help='Only rebuild this athlete; may be given several times')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Athletes rebuilt per transaction (default: 1000)')
+
+    def handle(self, *args, athlete_ids, batch_size, **options):
+        rebuilt = rebuild_run_rollups(athlete_ids=athlete_ids, batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rebuilt} rollup rows'))
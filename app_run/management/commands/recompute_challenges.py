@@ -0,0 +1,57 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from app_run.models import User
+from app_run.utils import iter_athlete_id_chunks, recompute_challenges_for_athletes
+
+
+class Command(BaseCommand):
+    help = "Re-evaluate every challenge rule against all athletes' history and award what is missing"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Worker processes; 1 runs everything in this process (default: 1)')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Athletes evaluated per unit of work (default: 1000)')
+        parser.add_argument('--athlete', type=int, action='append', dest='athlete_ids',
+                            help='Only recompute this athlete; may be given several times')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report the challenges that would be awarded without writing them')
+
+    def handle(self, *args, workers, chunk_size, athlete_ids, dry_run, **options):
+        users = User.objects.all() if athlete_ids is None else User.objects.filter(id__in=athlete_ids)
+        total = users.count()
+        chunks = iter_athlete_id_chunks(athlete_ids, chunk_size=chunk_size)
+        self.done = self.awarded = 0
+
+        if workers == 1:
+            for chunk in chunks:
+                self.report(recompute_challenges_for_athletes(chunk, dry_run), total)
+        else:
+            # Forked workers must not inherit (and share) this process' database connections, so they are all
+            # started before the ids are read; the chunks are then fed to them as the cursor yields them.
+            # django.setup itself is the initializer, as spawned workers can't import this module before it runs
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+                executor.submit(int).result()
+                pending = set()
+                for chunk in chunks:
+                    pending.add(executor.submit(recompute_challenges_for_athletes, chunk, dry_run))
+                    if len(pending) >= workers * 2:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            self.report(future.result(), total)
+                for future in wait(pending).done:
+                    self.report(future.result(), total)
+
+        verb = 'would be awarded' if dry_run else 'awarded'
+        self.stdout.write(self.style.SUCCESS(f'{self.awarded} challenges {verb} to {self.done} athletes'))
+
+    def report(self, result, total):
+        athletes, awarded = result
+        self.done += athletes
+        self.awarded += awarded
+        self.stdout.write(f'{self.done}/{total} athletes, {self.awarded} new challenges')
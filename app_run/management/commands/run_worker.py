@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app_run.models import Task
+from app_run.tasks import claim_task, run_task
+
+
+class Command(BaseCommand):
+    help = 'Run queued background tasks (run finalization and friends) until stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit as soon as no task is due instead of polling')
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help='Seconds to wait between polls when the queue is empty (default: 1)')
+        parser.add_argument('--max-tasks', type=int, default=None,
+                            help='Exit after running this many tasks')
+
+    def handle(self, *args, once, sleep, max_tasks, **options):
+        processed = 0
+        while max_tasks is None or processed < max_tasks:
+            task = claim_task()
+            if task is None:
+                if once:
+                    break
+                time.sleep(sleep)
+                continue
+
+            task = run_task(task)
+            processed += 1
+            if task.status == Task.Status.DONE:
+                self.stdout.write(f'Task {task.id} {task.name} done')
+            else:
+                self.stderr.write(f'Task {task.id} {task.name} {task.status} after {task.attempts} attempts: '
+                                  f'{task.last_error.strip().splitlines()[-1]}')
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} tasks'))
@@ -0,0 +1,84 @@
+# Generated by Django 5.2 on 2026-10-18 01:43
+
+from django.db import migrations, models
+from django.db.models import Count, Sum, Min, Max
+from geopy.distance import geodesic
+
+
+def track_length(points):
+    # Frozen copy of the track length at the time of this migration, so later changes to app_run.geo don't touch it
+    return sum(geodesic(points[i], points[i + 1]).kilometers for i in range(len(points) - 1))
+
+
+def backfill_run_totals(apps, schema_editor):
+    Run = apps.get_model('app_run', 'Run')
+    Positions = apps.get_model('app_run', 'Positions')
+
+    for run in Run.objects.exclude(status='finished').iterator():
+        positions = Positions.objects.filter(run_id=run.id)
+        totals = positions.aggregate(positions_count=Count('id'),
+                                     speed_sum=Sum('speed'),
+                                     speed_count=Count('speed'),
+                                     first_position_at=Min('date_time'),
+                                     last_position_at=Max('date_time'))
+        if not totals['positions_count']:
+            continue
+        points = list(positions.order_by('id').values_list('latitude', 'longitude'))
+        Run.objects.filter(id=run.id).update(positions_count=totals['positions_count'],
+                                             track_distance=track_length(points),
+                                             speed_sum=totals['speed_sum'] or 0,
+                                             speed_count=totals['speed_count'],
+                                             first_position_at=totals['first_position_at'],
+                                             last_position_at=totals['last_position_at'],
+                                             last_latitude=points[-1][0],
+                                             last_longitude=points[-1][1])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0019_subscribe_rating'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='first_position_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='last_latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='last_longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='last_position_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='positions_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='speed_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='speed_sum',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='track_distance',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(backfill_run_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 01:46
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0020_run_totals'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='collectibleitem',
+            index=models.Index(fields=['latitude', 'longitude'], name='collectible_item_lat_lon_idx'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 5.2 on 2026-10-18 01:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0021_collectibleitem_lat_lon_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='positions',
+            index=models.Index(fields=['run', 'id'], name='positions_run_id_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 01:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0022_positions_run_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='simplified_track',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
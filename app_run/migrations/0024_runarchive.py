@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 02:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0023_run_simplified_track'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RunArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('positions_count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('run', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='archive', to='app_run.run')),
+            ],
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2 on 2026-10-18 02:04
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def mark_finished_runs_ready(apps, schema_editor):
+    Run = apps.get_model('app_run', 'Run')
+    Run.objects.filter(status='finished').update(stats_status='ready')
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0024_runarchive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='stats_status',
+            field=models.CharField(blank=True, choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], max_length=7, null=True),
+        ),
+        migrations.RunPython(mark_finished_runs_ready, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('payload', models.JSONField(default=dict)),
+                ('idempotency_key', models.CharField(blank=True, max_length=200, null=True, unique=True)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=7)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('max_attempts', models.PositiveSmallIntegerField(default=5)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_after'], name='task_status_run_after_idx')],
+            },
+        ),
+    ]
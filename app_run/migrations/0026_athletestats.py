@@ -0,0 +1,52 @@
+# Generated by Django 5.2 on 2026-10-18 02:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum, Max
+
+
+def backfill_athlete_stats(apps, schema_editor):
+    Run = apps.get_model('app_run', 'Run')
+    CollectibleItem = apps.get_model('app_run', 'CollectibleItem')
+    AthleteStats = apps.get_model('app_run', 'AthleteStats')
+
+    stats = {}
+    for row in (Run.objects.filter(status='finished').values('athlete_id')
+                .annotate(runs_finished=Count('id'), total_distance=Sum('distance'), longest_distance=Max('distance'),
+                          total_run_time_seconds=Sum('run_time_seconds'), speed_sum=Sum('speed'),
+                          speed_count=Count('speed')).order_by()):
+        athlete_id = row.pop('athlete_id')
+        stats[athlete_id] = AthleteStats(athlete_id=athlete_id, **{key: value or 0 for key, value in row.items()})
+    for row in (CollectibleItem.user.through.objects.values('user_id')
+                .annotate(items_count=Count('id'), items_value=Sum('collectibleitem__value')).order_by()):
+        athlete_stats = stats.setdefault(row['user_id'], AthleteStats(athlete_id=row['user_id']))
+        athlete_stats.items_count = row['items_count']
+        athlete_stats.items_value = row['items_value'] or 0
+    AthleteStats.objects.bulk_create(stats.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0025_task_queue'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AthleteStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('runs_finished', models.PositiveIntegerField(default=0)),
+                ('total_distance', models.FloatField(default=0)),
+                ('longest_distance', models.FloatField(default=0)),
+                ('total_run_time_seconds', models.PositiveBigIntegerField(default=0)),
+                ('speed_sum', models.FloatField(default=0)),
+                ('speed_count', models.PositiveIntegerField(default=0)),
+                ('items_count', models.PositiveIntegerField(default=0)),
+                ('items_value', models.BigIntegerField(default=0)),
+                ('athlete', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(backfill_athlete_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-18 02:12
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_challenges(apps, schema_editor):
+    Challenge = apps.get_model('app_run', 'Challenge')
+    duplicates = (Challenge.objects.values('athlete_id', 'full_name')
+                  .annotate(first_id=Min('id'), count=Count('id')).filter(count__gt=1).order_by())
+    for duplicate in duplicates:
+        (Challenge.objects.filter(athlete_id=duplicate['athlete_id'], full_name=duplicate['full_name'])
+         .exclude(id=duplicate['first_id']).delete())
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0026_athletestats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_challenges, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='challenge',
+            constraint=models.UniqueConstraint(fields=('athlete', 'full_name'), name='unique_athlete_challenge'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2 on 2026-10-18 02:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_leaderboards(apps, schema_editor):
+    AthleteStats = apps.get_model('app_run', 'AthleteStats')
+    LeaderboardEntry = apps.get_model('app_run', 'LeaderboardEntry')
+
+    entries = []
+    for stats in AthleteStats.objects.iterator():
+        scores = {
+            'total_distance': stats.total_distance if stats.runs_finished else None,
+            'runs_finished': stats.runs_finished or None,
+            'avg_speed': stats.speed_sum / stats.speed_count if stats.speed_count else None,
+            'items_value': stats.items_value if stats.items_count else None,
+        }
+        entries.extend(LeaderboardEntry(board=board, athlete_id=stats.athlete_id, score=score)
+                       for board, score in scores.items() if score is not None)
+    LeaderboardEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0027_unique_athlete_challenge'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('board', models.CharField(max_length=30)),
+                ('score', models.FloatField()),
+                ('athlete', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leaderboard_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['board', '-score', 'athlete'], name='leaderboard_rank_idx')],
+                'constraints': [models.UniqueConstraint(fields=('board', 'athlete'), name='unique_leaderboard_athlete')],
+            },
+        ),
+        migrations.RunPython(backfill_leaderboards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2 on 2026-10-18 02:29
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum, DateField
+from django.db.models.functions import Trunc
+
+
+def backfill_run_rollups(apps, schema_editor):
+    Run = apps.get_model('app_run', 'Run')
+    RunRollup = apps.get_model('app_run', 'RunRollup')
+
+    for granularity in ('day', 'week', 'month'):
+        rows = (Run.objects.filter(status='finished')
+                .annotate(period=Trunc('created_at', granularity, output_field=DateField()))
+                .values('athlete_id', 'period')
+                .annotate(runs_count=Count('id'), distance_sum=Sum('distance'),
+                          run_time_seconds_sum=Sum('run_time_seconds'), run_speed_sum=Sum('speed'),
+                          run_speed_count=Count('speed'))
+                .order_by())
+        RunRollup.objects.bulk_create((RunRollup(athlete_id=row['athlete_id'], granularity=granularity,
+                                                 period_start=row['period'], runs_count=row['runs_count'],
+                                                 distance=row['distance_sum'] or 0,
+                                                 run_time_seconds=row['run_time_seconds_sum'] or 0,
+                                                 speed_sum=row['run_speed_sum'] or 0,
+                                                 speed_count=row['run_speed_count'])
+                                       for row in rows.iterator()), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0028_leaderboardentry'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RunRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('day', 'Day'), ('week', 'Week'), ('month', 'Month')], max_length=5)),
+                ('period_start', models.DateField()),
+                ('runs_count', models.PositiveIntegerField(default=0)),
+                ('distance', models.FloatField(default=0)),
+                ('run_time_seconds', models.PositiveBigIntegerField(default=0)),
+                ('speed_sum', models.FloatField(default=0)),
+                ('speed_count', models.PositiveIntegerField(default=0)),
+                ('athlete', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='run_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('athlete', 'granularity', 'period_start'), name='unique_run_rollup')],
+            },
+        ),
+        migrations.RunPython(backfill_run_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-18 02:32
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_coach_ratings(apps, schema_editor):
+    Subscribe = apps.get_model('app_run', 'Subscribe')
+    AthleteStats = apps.get_model('app_run', 'AthleteStats')
+
+    for row in (Subscribe.objects.filter(rating__isnull=False).values('subscribed_to_id')
+                .annotate(rating_sum=Sum('rating'), rating_count=Count('id')).order_by()):
+        AthleteStats.objects.update_or_create(athlete_id=row['subscribed_to_id'],
+                                              defaults={'rating_sum': row['rating_sum'],
+                                                        'rating_count': row['rating_count']})
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0029_runrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='athletestats',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='athletestats',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_coach_ratings, migrations.RunPython.noop),
+    ]
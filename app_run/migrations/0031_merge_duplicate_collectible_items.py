@@ -0,0 +1,51 @@
+# Generated by Django 5.2 on 2026-10-18 02:39
+
+from django.db import migrations
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import Coalesce
+
+
+def merge_duplicate_items(apps, schema_editor):
+    CollectibleItem = apps.get_model('app_run', 'CollectibleItem')
+    AthleteStats = apps.get_model('app_run', 'AthleteStats')
+    LeaderboardEntry = apps.get_model('app_run', 'LeaderboardEntry')
+    Collected = CollectibleItem.user.through
+    duplicates = (CollectibleItem.objects.values('uid')
+                  .annotate(last_id=Max('id'), count=Count('id')).filter(count__gt=1).order_by())
+    affected = set()
+    for duplicate in duplicates:
+        # The latest upload of a uid wins, and whoever collected any copy keeps it
+        copies = CollectibleItem.objects.filter(uid=duplicate['uid'])
+        affected.update(Collected.objects.filter(collectibleitem__in=copies).values_list('user_id', flat=True))
+        others = copies.exclude(id=duplicate['last_id'])
+        Collected.objects.bulk_create(
+            [Collected(collectibleitem_id=duplicate['last_id'], user_id=user_id)
+             for user_id in Collected.objects.filter(collectibleitem__in=others).values_list('user_id', flat=True)],
+            ignore_conflicts=True)
+        others.delete()
+
+    # Collectors of merged copies hold fewer items now, possibly of another value: recount their stats and
+    # their items_value leaderboard entry, as rebuild_athlete_stats and rebuild_leaderboards would
+    totals = {row['user_id']: row for row in Collected.objects.filter(user_id__in=affected).values('user_id')
+              .annotate(items_count=Count('id'), items_value=Coalesce(Sum('collectibleitem__value'), 0)).order_by()}
+    for stats in AthleteStats.objects.filter(athlete_id__in=affected):
+        row = totals.get(stats.athlete_id, {'items_count': 0, 'items_value': 0})
+        stats.items_count, stats.items_value = row['items_count'], row['items_value']
+        stats.save(update_fields=['items_count', 'items_value'])
+        if stats.items_count:
+            LeaderboardEntry.objects.update_or_create(board='items_value', athlete_id=stats.athlete_id,
+                                                      defaults={'score': stats.items_value})
+        else:
+            LeaderboardEntry.objects.filter(board='items_value', athlete_id=stats.athlete_id).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0030_athletestats_rating'),
+    ]
+
+    # The unique constraint comes in the next migration: PostgreSQL can't alter a table in the transaction
+    # that deleted the copies, while the deferred foreign key checks of the deletion are still pending
+    operations = [
+        migrations.RunPython(merge_duplicate_items, migrations.RunPython.noop),
+    ]
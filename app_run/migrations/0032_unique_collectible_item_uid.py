@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 02:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0031_merge_duplicate_collectible_items'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='collectibleitem',
+            name='uid',
+            field=models.CharField(max_length=140, unique=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 02:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0033_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='format',
+            field=models.CharField(default='xlsx', max_length=10),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2 on 2026-10-18 03:50
+
+import zlib
+
+import numpy as np
+from django.db import migrations, models
+
+
+def fill_position_ids(apps, schema_editor):
+    RunArchive = apps.get_model('app_run', 'RunArchive')
+    for archive in RunArchive.objects.filter(positions_count__gt=0).iterator(chunk_size=100):
+        # The ids are the first column of the blob: int64 deltas right after the 9-byte header, in id order
+        buffer = zlib.decompress(bytes(archive.data))
+        ids = np.cumsum(np.frombuffer(buffer, dtype='<i8', count=archive.positions_count, offset=9))
+        archive.first_position_id, archive.last_position_id = int(ids[0]), int(ids[-1])
+        archive.save(update_fields=['first_position_id', 'last_position_id'])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('app_run', '0034_importjob_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='runarchive',
+            name='first_position_id',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='runarchive',
+            name='last_position_id',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='runarchive',
+            index=models.Index(fields=['first_position_id', 'last_position_id'], name='run_archive_positions_idx'),
+        ),
+        migrations.RunPython(fill_position_ids, migrations.RunPython.noop),
+    ]
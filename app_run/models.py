@@ -1,11 +1,17 @@
 from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.utils import timezone
 
 from app_run.validators import latitude_validator, longitude_validator, rating_validator
 
 User = get_user_model()
 
+RUN_TOTALS_FIELDS = ('positions_count', 'track_distance', 'speed_sum', 'speed_count',
+                     'first_position_at', 'last_position_at', 'last_latitude', 'last_longitude')
+RUN_INTERNAL_FIELDS = RUN_TOTALS_FIELDS + ('simplified_track',)
+
 
 class Run(models.Model):
     class Status(models.TextChoices):
@@ -13,6 +19,11 @@ class Run(models.Model):
         IN_PROGRESS = 'in_progress', 'In Progress'
         FINISHED = 'finished', 'Finished'
 
+    class StatsStatus(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        READY = 'ready', 'Ready'
+        FAILED = 'failed', 'Failed'
+
     created_at = models.DateTimeField(auto_now_add=True)
     comment = models.TextField()
     athlete = models.ForeignKey(User, on_delete=models.CASCADE, related_name='runs')
@@ -20,6 +31,20 @@ class Run(models.Model):
     distance = models.FloatField(blank=True, null=True)
     run_time_seconds = models.PositiveIntegerField(blank=True, null=True)
     speed = models.FloatField(null=True, blank=True)
+    # Distance, speed, time, track and challenges are filled in by the finalize_run task after the stop
+    stats_status = models.CharField(choices=StatsStatus.choices, max_length=7, null=True, blank=True)
+    # Display-resolution track as an encoded polyline, computed when the run finishes
+    simplified_track = models.TextField(null=True, blank=True)
+
+    # Running totals over the positions received so far, see utils.update_run_totals
+    positions_count = models.PositiveIntegerField(default=0)
+    track_distance = models.FloatField(default=0)
+    speed_sum = models.FloatField(default=0)
+    speed_count = models.PositiveIntegerField(default=0)
+    first_position_at = models.DateTimeField(null=True, blank=True)
+    last_position_at = models.DateTimeField(null=True, blank=True)
+    last_latitude = models.FloatField(null=True, blank=True)
+    last_longitude = models.FloatField(null=True, blank=True)
 
 
 class AthleteInfo(models.Model):
@@ -31,6 +56,68 @@ class AthleteInfo(models.Model):
     goals = models.CharField(max_length=140, null=True, blank=True)
 
 
+class AthleteStats(models.Model):
+    """Per-user totals over finished runs, collected items and (for coaches) ratings, see utils.record_finished_run."""
+    athlete = models.OneToOneField(User, on_delete=models.CASCADE, related_name='stats')
+    runs_finished = models.PositiveIntegerField(default=0)
+    total_distance = models.FloatField(default=0)
+    longest_distance = models.FloatField(default=0)
+    total_run_time_seconds = models.PositiveBigIntegerField(default=0)
+    speed_sum = models.FloatField(default=0)
+    speed_count = models.PositiveIntegerField(default=0)
+    items_count = models.PositiveIntegerField(default=0)
+    items_value = models.BigIntegerField(default=0)
+    # Ratings given by the coach's subscribers, see utils.refresh_coach_rating
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+
+    @property
+    def avg_speed(self):
+        return self.speed_sum / self.speed_count if self.speed_count else None
+
+    @property
+    def rating(self):
+        return self.rating_sum / self.rating_count if self.rating_count else None
+
+
+class RunRollup(models.Model):
+    """Finished runs of an athlete summed per day, week (from Monday) or month of their start."""
+
+    class Granularity(models.TextChoices):
+        DAY = 'day', 'Day'
+        WEEK = 'week', 'Week'
+        MONTH = 'month', 'Month'
+
+    athlete = models.ForeignKey(User, on_delete=models.CASCADE, related_name='run_rollups')
+    granularity = models.CharField(choices=Granularity.choices, max_length=5)
+    period_start = models.DateField()
+    runs_count = models.PositiveIntegerField(default=0)
+    distance = models.FloatField(default=0)
+    run_time_seconds = models.PositiveBigIntegerField(default=0)
+    speed_sum = models.FloatField(default=0)
+    speed_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['athlete', 'granularity', 'period_start'], name='unique_run_rollup'),
+        ]
+
+
+class LeaderboardEntry(models.Model):
+    """An athlete's score on one leaderboard, kept in step with AthleteStats, see app_run.leaderboards."""
+    board = models.CharField(max_length=30)
+    athlete = models.ForeignKey(User, on_delete=models.CASCADE, related_name='leaderboard_entries')
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['board', 'athlete'], name='unique_leaderboard_athlete'),
+        ]
+        indexes = [
+            models.Index(fields=['board', '-score', 'athlete'], name='leaderboard_rank_idx'),
+        ]
+
+
 class Challenge(models.Model):
     class NameChoices(models.TextChoices):
         RUN10 = 'run10', 'Сделай 10 Забегов!'
@@ -40,6 +127,11 @@ class Challenge(models.Model):
     full_name = models.CharField(max_length=55, choices=NameChoices.choices, default=NameChoices.RUN10)
     athlete = models.ForeignKey(User, on_delete=models.CASCADE, related_name='challenges')
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['athlete', 'full_name'], name='unique_athlete_challenge'),
+        ]
+
 
 class Positions(models.Model):
     run = models.ForeignKey(Run, on_delete=models.CASCADE, related_name='positions')
@@ -49,16 +141,42 @@ class Positions(models.Model):
     speed = models.FloatField(null=True, blank=True)
     distance = models.FloatField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['run', 'id'], name='positions_run_id_idx'),
+        ]
+
+
+class RunArchive(models.Model):
+    """Positions of a finished run packed column by column, see app_run.archive."""
+    run = models.OneToOneField(Run, on_delete=models.CASCADE, related_name='archive')
+    positions_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Range of the archived position ids, to find the archive holding a given position
+    first_position_id = models.BigIntegerField(null=True)
+    last_position_id = models.BigIntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['first_position_id', 'last_position_id'], name='run_archive_positions_idx'),
+        ]
+
 
 class CollectibleItem(models.Model):
     name = models.CharField(max_length=140)
-    uid = models.CharField(max_length=140)
+    uid = models.CharField(max_length=140, unique=True)
     latitude = models.FloatField(validators=[latitude_validator])
     longitude = models.FloatField(validators=[longitude_validator])
     picture = models.URLField()
     value = models.IntegerField()
     user = models.ManyToManyField(User, related_name='collectible_items', )
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['latitude', 'longitude'], name='collectible_item_lat_lon_idx'),
+        ]
+
 
 class Subscribe(models.Model):
     subscriber = models.ForeignKey(User, on_delete=models.CASCADE, related_name='subscriptions', null=True, blank=True)
@@ -66,3 +184,61 @@ class Subscribe(models.Model):
     rating = models.PositiveSmallIntegerField(null=True, blank=True, validators=[rating_validator])
     class Meta:
         unique_together = ('subscriber', 'subscribed_to')
+
+
+class Task(models.Model):
+    """Background job picked up by the run_worker command, see app_run.tasks."""
+
+    class Status(models.TextChoices):
+        QUEUED = 'queued', 'Queued'
+        RUNNING = 'running', 'Running'
+        DONE = 'done', 'Done'
+        FAILED = 'failed', 'Failed'
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    idempotency_key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    status = models.CharField(choices=Status.choices, max_length=7, default=Status.QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='task_status_run_after_idx'),
+        ]
+
+
+class ImportJob(models.Model):
+    """Collectible item upload imported in the background by the import_items task, see app_run.importers."""
+
+    class Status(models.TextChoices):
+        QUEUED = 'queued', 'Queued'
+        RUNNING = 'running', 'Running'
+        DONE = 'done', 'Done'
+        FAILED = 'failed', 'Failed'
+
+    file_name = models.CharField(max_length=255, blank=True)
+    format = models.CharField(max_length=10, default='xlsx')
+    # The uploaded file itself, kept in the database so any worker can read it; emptied once imported
+    data = models.BinaryField()
+    status = models.CharField(choices=Status.choices, max_length=7, default=Status.QUEUED)
+    total_rows = models.PositiveIntegerField(null=True, blank=True)
+    rows_processed = models.PositiveIntegerField(default=0)
+    rows_rejected = models.PositiveIntegerField(default=0)
+    inserted = models.PositiveIntegerField(default=0)
+    updated = models.PositiveIntegerField(default=0)
+    unchanged = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+
+class ImportRejectedRow(models.Model):
+    job = models.ForeignKey(ImportJob, on_delete=models.CASCADE, related_name='rejected_rows')
+    row = models.JSONField(encoder=DjangoJSONEncoder)
@@ -0,0 +1,121 @@
+import base64
+import binascii
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Forward-only cursor pagination on a unique composite ordering.
+
+    Each page is a range scan starting right after the last row of the
+    previous one, so it costs the same no matter how deep the client is,
+    and no COUNT(*) is ever issued.
+    """
+    ordering = ('id',)
+    page_size = 100
+    page_size_query_param = 'size'
+    max_page_size = 10000
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            queryset = queryset.filter(self.after_cursor_q(cursor))
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        self.next_position = [getattr(rows[-1], field) for field in self.ordering] if self.has_next else None
+        return rows
+
+    def paginate_list(self, items, request):
+        """Same as paginate_queryset for objects already loaded in memory, sorted by ``ordering``."""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            cursor = tuple(cursor)
+            items = [item for item in items if tuple(getattr(item, field) for field in self.ordering) > cursor]
+
+        self.has_next = len(items) > self.page_size
+        items = items[:self.page_size]
+        self.next_position = [getattr(items[-1], field) for field in self.ordering] if self.has_next else None
+        return items
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def after_cursor_q(self, cursor):
+        # (a, b) > (x, y)  <=>  a > x OR (a = x AND b > y)
+        q = Q()
+        equal = {}
+        for field, value in zip(self.ordering, cursor):
+            q |= Q(**equal, **{f'{field}__gt': value})
+            equal[field] = value
+        return q
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            values = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii').split(':')
+            cursor = [int(value) for value in values]
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if len(cursor) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def encode_cursor(self, position):
+        return base64.urlsafe_b64encode(':'.join(str(value) for value in position).encode('ascii')).decode('ascii')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class PositionsPagination(KeysetPagination):
+    ordering = ('run_id', 'id')
+    page_size = settings.POSITIONS_PAGE_SIZE
+
+
+class ChallengeAthletesPagination(KeysetPagination):
+    ordering = ('athlete_id',)
+    page_size = 20
+    max_page_size = 1000
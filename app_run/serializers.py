@@ -1,6 +1,7 @@
+from django.utils import timezone
 from rest_framework import serializers
 
-from .models import Run, AthleteInfo, Challenge, Positions, CollectibleItem, User
+from .models import Run, AthleteInfo, Challenge, Positions, CollectibleItem, User, ImportJob, RUN_INTERNAL_FIELDS
 
 
 class CollectibleItemSerializer(serializers.ModelSerializer):
@@ -9,6 +10,16 @@ class CollectibleItemSerializer(serializers.ModelSerializer):
         fields = 'name', 'uid', 'latitude', 'longitude', 'picture', 'value'
 
 
+class NearbyCollectibleItemSerializer(CollectibleItemSerializer):
+    distance = serializers.SerializerMethodField()
+
+    class Meta(CollectibleItemSerializer.Meta):
+        fields = CollectibleItemSerializer.Meta.fields + ('distance',)
+
+    def get_distance(self, obj):
+        return round(obj.distance, 1)
+
+
 class UserBaseSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -60,7 +71,7 @@ class RunSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Run
-        fields = '__all__'
+        exclude = RUN_INTERNAL_FIELDS
 
 
 class AthleteInfoSerializer(serializers.ModelSerializer):
@@ -77,6 +88,12 @@ class ChallengeSerializer(serializers.ModelSerializer):
         fields = ('full_name', 'athlete')
 
 
+def validate_run_in_progress(value):
+    if value.status == Run.Status.IN_PROGRESS:
+        return value
+    raise serializers.ValidationError(f'The run status must be "in_process"; current status:{value.status}')
+
+
 class PositionsSerializer(serializers.ModelSerializer):
     date_time = serializers.DateTimeField(format='%Y-%m-%dT%H:%M:%S.%f')
 
@@ -85,10 +102,45 @@ class PositionsSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
     def validate_run(self, value):
-        if value.status == Run.Status.IN_PROGRESS:
-            return value
-        raise serializers.ValidationError(f'The run status must be "in_process"; current status:{value.status}')
+        return validate_run_in_progress(value)
+
+
+class PositionFixSerializer(serializers.ModelSerializer):
+    date_time = serializers.DateTimeField(format='%Y-%m-%dT%H:%M:%S.%f')
 
+    class Meta:
+        model = Positions
+        fields = ('latitude', 'longitude', 'date_time')
 
 
+class PositionsBulkSerializer(serializers.Serializer):
+    MAX_POSITIONS = 1000
 
+    run = serializers.PrimaryKeyRelatedField(queryset=Run.objects.select_related('athlete'))
+    positions = PositionFixSerializer(many=True, allow_empty=False, max_length=MAX_POSITIONS)
+
+    def validate_run(self, value):
+        return validate_run_in_progress(value)
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    rows_per_second = serializers.SerializerMethodField()
+    eta_seconds = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ImportJob
+        exclude = ('data',)
+
+    def get_rows_per_second(self, obj):
+        if obj.started_at is None:
+            return None
+        elapsed = ((obj.finished_at or timezone.now()) - obj.started_at).total_seconds()
+        return round(obj.rows_processed / elapsed, 1) if elapsed > 0 else None
+
+    def get_eta_seconds(self, obj):
+        if obj.status in (ImportJob.Status.DONE, ImportJob.Status.FAILED):
+            return 0
+        rows_per_second = self.get_rows_per_second(obj)
+        if not rows_per_second or obj.total_rows is None:
+            return None
+        return round(max(obj.total_rows - obj.rows_processed, 0) / rows_per_second)
@@ -0,0 +1,51 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Run, Positions, CollectibleItem, Subscribe
+from .utils import update_run_totals, recompute_run_totals, bump_collectible_items_version, refresh_coach_rating, \
+    record_run_finished_elsewhere, record_run_unfinished, refresh_athlete_run_stats
+
+
+@receiver(post_save, sender=Run)
+def run_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # The stats status is kept on the instance too, or saving it again would write the old one back
+    if instance.status == Run.Status.FINISHED and instance.stats_status is None:
+        # RunStopView marks its runs pending and leaves them to finalize_run; any other finished run counts now
+        instance.stats_status = record_run_finished_elsewhere(instance.id).stats_status
+    elif instance.status != Run.Status.FINISHED and instance.stats_status is not None:
+        instance.stats_status = record_run_unfinished(instance.id).stats_status
+
+
+@receiver(post_delete, sender=Run)
+def run_deleted(sender, instance, **kwargs):
+    if instance.stats_status == Run.StatsStatus.READY:
+        # After the commit: when the athlete is deleted along with their runs there is nothing left to count
+        athlete_id = instance.athlete_id
+        transaction.on_commit(lambda: refresh_athlete_run_stats(athlete_id))
+
+
+@receiver(post_save, sender=Positions)
+def positions_created(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        update_run_totals(instance.run_id, [instance])
+    else:
+        # An edited position can change any of the totals, not just the tail of the track
+        recompute_run_totals(instance.run_id)
+
+
+@receiver(post_save, sender=CollectibleItem)
+@receiver(post_delete, sender=CollectibleItem)
+def collectible_item_changed(sender, **kwargs):
+    bump_collectible_items_version()
+
+
+@receiver(post_save, sender=Subscribe)
+@receiver(post_delete, sender=Subscribe)
+def subscription_changed(sender, instance, raw=False, **kwargs):
+    if not raw and instance.subscribed_to_id:
+        refresh_coach_rating(instance.subscribed_to_id)
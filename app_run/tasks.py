@@ -0,0 +1,111 @@
+import threading
+import traceback
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .importers import run_import_job, mark_import_job_failed
+from .models import Run, Task
+from .utils import finalize_run
+
+
+def mark_run_stats_failed(run_id):
+    Run.objects.filter(id=run_id).update(stats_status=Run.StatsStatus.FAILED)
+
+
+# The task run_task is running in this thread, for heartbeat
+_running = threading.local()
+
+
+def heartbeat():
+    """Refresh the lock of the task running in this thread, so claim_task doesn't reclaim a long task."""
+    task = getattr(_running, 'task', None)
+    if task is not None:
+        task.locked_at = timezone.now()
+        Task.objects.filter(id=task.id, status=Task.Status.RUNNING).update(locked_at=task.locked_at)
+
+
+TASK_HANDLERS = {
+    'finalize_run': finalize_run,
+    'import_items': partial(run_import_job, on_chunk=heartbeat),
+}
+
+# Called with the task payload once a task has used up all its attempts
+TASK_FAILURE_HANDLERS = {
+    'finalize_run': mark_run_stats_failed,
+    'import_items': mark_import_job_failed,
+}
+
+
+def enqueue(name, payload, idempotency_key=None, max_attempts=5):
+    """Queue a task; a second enqueue with the same idempotency key returns the existing task."""
+    if name not in TASK_HANDLERS:
+        raise ValueError(f'Unknown task {name!r}, expected one of: {", ".join(TASK_HANDLERS)}')
+
+    if idempotency_key is not None:
+        existing = Task.objects.filter(idempotency_key=idempotency_key).first()
+        if existing:
+            return existing
+    try:
+        with transaction.atomic():
+            task = Task.objects.create(name=name, payload=payload, idempotency_key=idempotency_key,
+                                       max_attempts=max_attempts)
+    except IntegrityError:
+        return Task.objects.get(idempotency_key=idempotency_key)
+
+    if settings.TASK_QUEUE_EAGER:
+        # Once the caller's transaction commits, so the task sees the rows it was queued for
+        transaction.on_commit(lambda: run_task(claim_task(Task.objects.filter(id=task.id))))
+    return task
+
+
+def claim_task(queryset=None):
+    """Lock the next due task (or a running one whose worker went away) and mark it running."""
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.TASK_LOCK_TIMEOUT_SECONDS)
+    if queryset is None:
+        queryset = Task.objects.all()
+    with transaction.atomic():
+        task = (queryset
+                .filter(Q(status=Task.Status.QUEUED, run_after__lte=now) |
+                        Q(status=Task.Status.RUNNING, locked_at__lt=stale))
+                .select_for_update(skip_locked=True)
+                .order_by('run_after', 'id')
+                .first())
+        if task is None:
+            return None
+        task.status = Task.Status.RUNNING
+        task.locked_at = now
+        task.attempts += 1
+        task.save(update_fields=['status', 'locked_at', 'attempts'])
+    return task
+
+
+def run_task(task):
+    """Run a claimed task and record the outcome, scheduling a retry with backoff on failure."""
+    _running.task = task
+    try:
+        TASK_HANDLERS[task.name](**task.payload)
+    except Exception:
+        task.last_error = traceback.format_exc()
+        if task.attempts < task.max_attempts:
+            task.status = Task.Status.QUEUED
+            task.run_after = timezone.now() + timedelta(
+                seconds=settings.TASK_RETRY_DELAY_SECONDS * 2 ** (task.attempts - 1))
+        else:
+            task.status = Task.Status.FAILED
+            task.finished_at = timezone.now()
+            if task.name in TASK_FAILURE_HANDLERS:
+                TASK_FAILURE_HANDLERS[task.name](**task.payload)
+    else:
+        task.status = Task.Status.DONE
+        task.finished_at = timezone.now()
+    finally:
+        _running.task = None
+    task.locked_at = None
+    task.save(update_fields=['status', 'run_after', 'locked_at', 'last_error', 'finished_at'])
+    return task
@@ -1,18 +1,40 @@
+import csv
+import json
 import os
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
 from unittest.mock import patch, MagicMock
 
+import numpy as np
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from geopy.distance import geodesic
+from openpyxl import Workbook
 from rest_framework import status
 from rest_framework.test import APITestCase
 
-from app_run.models import CollectibleItem, Subscribe
-from app_run.models import Run, Challenge, Positions
-from app_run.utils import calculate_and_save_run_distance, award_challenge_if_completed_run_50km, \
-    calculate_run_time_in_seconds
-from app_run.utils import collect_item_if_nearby
+from app_run.archive import pack_track, unpack_track
+from app_run.caching import cached, cache_counters, reset_cache_counters, response_cache
+from app_run.challenges import CHALLENGE_RULES, ChallengeContext, award_challenges, evaluate_challenges
+from app_run.geo import segment_lengths, track_length, GridIndex, encode_polyline, decode_polyline, \
+    encode_deltas, decode_deltas, simplify_track
+from app_run.importers import EXPECTED_HEADERS, UnsupportedFormat, check_headers, detect_format, \
+    import_collectible_items, iter_xlsx_rows, run_import_job
+from app_run.models import CollectibleItem, Subscribe, AthleteStats, LeaderboardEntry, RunRollup
+from app_run.models import Run, Challenge, Positions, RunArchive, Task, ImportJob
+from app_run.tasks import enqueue, claim_task, run_task, TASK_HANDLERS
+from app_run.utils import calculate_and_save_run_distance, \
+    calculate_run_time_in_seconds, finalize_run, rebuild_athlete_stats, recompute_challenges_for_athletes
+from app_run.utils import collect_item_if_nearby, get_collectible_items_index, iter_run_track, archive_run
 
 
 class ChallengeRun10Test(APITestCase):
@@ -35,13 +57,15 @@ class ChallengeRun10Test(APITestCase):
         self.assertEqual(Challenge.objects.count(), 0)
 
         for i in range(1, 11):
-            response = self.client.post(reverse('run-stop', args=[i]))
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(reverse('run-stop', args=[i]))
             self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(Challenge.objects.filter(athlete=self.user).count(), 1)
         self.assertEqual(Run.objects.filter(status=Run.Status.FINISHED).count(), 10)
 
         for i in range(11, 26):
-            response = self.client.post(reverse('run-stop', args=[i]), data={})
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(reverse('run-stop', args=[i]), data={})
             self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(Challenge.objects.filter(athlete=self.user).count(), 1)
         self.assertEqual(Challenge.objects.count(), 1)
@@ -113,15 +137,43 @@ class PositionsEndpointTest(APITestCase):
     def test_position_list(self):
         response = self.client.get(reverse('positions-list'))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNone(response.data['next'])
 
     def test_detail_position_for_run(self):
         response = self.client.get(reverse('positions-list'), data={'run': self.run_in_progress1.id})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data[0]['id'], self.position1.id)
-        self.assertEqual(response.data[0]['longitude'], self.position1.longitude)
-        self.assertEqual(response.data[0]['latitude'], self.position1.latitude)
-        self.assertEqual(response.data[0]['run'], self.run_in_progress1.id)
+        self.assertEqual(response.data['results'][0]['id'], self.position1.id)
+        self.assertEqual(response.data['results'][0]['longitude'], self.position1.longitude)
+        self.assertEqual(response.data['results'][0]['latitude'], self.position1.latitude)
+        self.assertEqual(response.data['results'][0]['run'], self.run_in_progress1.id)
+
+    def test_position_list_pagination(self):
+        for i in range(4):
+            Positions.objects.create(run=self.run_in_progress, longitude=33 + i, latitude=44)
+        Positions.objects.create(run=self.run_in_progress1, longitude=33, latitude=45)
+
+        expected = list(Positions.objects.order_by('run_id', 'id').values_list('id', flat=True))
+        received = []
+        url = reverse('positions-list') + '?size=2'
+        while url:
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 2)
+            received += [position['id'] for position in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(received, expected)
+
+        response = self.client.get(reverse('positions-list'), data={'run': self.run_in_progress.id, 'size': 3})
+        self.assertEqual([position['id'] for position in response.data['results']], expected[:3])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([position['id'] for position in response.data['results']], expected[3:4])
+        self.assertIsNone(response.data['next'])
+
+    def test_position_list_invalid_cursor(self):
+        response = self.client.get(reverse('positions-list'), data={'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_position_delete(self):
         response = self.client.delete(reverse('positions-detail', args=[self.position1.id]))
@@ -233,12 +285,53 @@ class CalculateDistanceRun(APITestCase):
         self.assertEqual(run.distance, 866.4554329098687)
 
     def test_calculate_distance_run_stop_endpoint(self):
-        response = self.client.post(reverse('run-stop', args=[self.run.id]))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('run-stop', args=[self.run.id]))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         response = self.client.get(reverse('runs-detail', args=[self.run.id]))
         self.assertEqual(response.data['distance'], 866.4554329098687)
 
 
+class TestDistanceEngines(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self.track = np.column_stack([50.45 + np.cumsum(rng.normal(0, 1e-4, 2000)),
+                                      30.52 + np.cumsum(rng.normal(0, 1e-4, 2000))])
+        self.long_segments = [(41.49008, -71.312796), (41.499498, -81.695391), (-33.8688, 151.2093),
+                              (0, 0), (0.5, 179.7), (10, 179.9), (10, -179.9), (89.9, 0), (-89.9, 180)]
+
+    def test_vincenty_matches_geodesic(self):
+        exact = segment_lengths(self.track, engine='geodesic')
+        vincenty = segment_lengths(self.track, engine='vincenty')
+        self.assertLess(np.max(np.abs(vincenty - exact)), 1e-6)
+
+        exact = segment_lengths(self.long_segments, engine='geodesic')
+        vincenty = segment_lengths(self.long_segments, engine='vincenty')
+        self.assertLess(np.max(np.abs(vincenty - exact)), 1e-6)
+
+    def test_haversine_error_is_bounded(self):
+        exact = track_length(self.track, engine='geodesic')
+        self.assertAlmostEqual(track_length(self.track, engine='haversine') / exact, 1, delta=0.006)
+
+        exact = segment_lengths(self.long_segments, engine='geodesic')
+        haversine = segment_lengths(self.long_segments, engine='haversine')
+        self.assertLess(np.max(np.abs(haversine / exact - 1)), 0.006)
+
+    def test_short_tracks(self):
+        self.assertEqual(track_length([]), 0)
+        self.assertEqual(track_length([(50.45, 30.52)]), 0)
+        self.assertEqual(track_length([(50.45, 30.52), (50.45, 30.52)]), 0)
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            track_length(self.track, engine='flat')
+
+    @override_settings(RUN_DISTANCE_ENGINE='geodesic')
+    def test_engine_from_settings(self):
+        self.assertEqual(track_length(self.long_segments[:2]),
+                         geodesic(self.long_segments[0], self.long_segments[1]).kilometers)
+
+
 class Run50kmChalengeTest(APITestCase):
     def setUp(self):
         self.user = get_user_model().objects.create_user(
@@ -257,16 +350,27 @@ class Run50kmChalengeTest(APITestCase):
 
     def test_award_challenge_if_completed_run_50km(self):
         self.assertEqual(self.user.challenges.filter(full_name=Challenge.NameChoices.RUN50KM).count(), 0)
-        award_challenge_if_completed_run_50km(athlete_id=self.user.id)
+        award_challenges(athlete_id=self.user.id)
         self.assertEqual(self.user.challenges.filter(full_name=Challenge.NameChoices.RUN50KM).count(), 1)
         Run.objects.create(athlete=self.user,
                            comment='Test Run',
                            status=Run.Status.FINISHED,
                            distance=55)
-        award_challenge_if_completed_run_50km(athlete_id=self.user.id)
+        award_challenges(athlete_id=self.user.id)
         self.assertEqual(self.user.challenges.filter(full_name=Challenge.NameChoices.RUN50KM).count(), 1)
 
 
+def xlsx_file(rows):
+    wb = Workbook()
+    for row in rows:
+        wb.active.append(row)
+    buffer = BytesIO()
+    wb.save(buffer)
+    buffer.seek(0)
+    buffer.name = 'items.xlsx'
+    return buffer
+
+
 class CollectibleItemsFileUploadTest(APITestCase):
     def test_file_upload(self):
         self.assertEqual(CollectibleItem.objects.count(), 0)
@@ -285,8 +389,218 @@ class CollectibleItemsFileUploadTest(APITestCase):
         )
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 4)
+        self.assertEqual(len(response.data['invalid_rows']), 4)
+        self.assertEqual(response.data['inserted'], 2)
+        self.assertEqual(CollectibleItem.objects.count(), 2)
+
+    def test_wrong_headers(self):
+        response = self.client.post(reverse('upload-file'),
+                                    {'file': xlsx_file([['Name', 'UID', 'Value']])}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['got'], ['Name', 'UID', 'Value'])
+
+    def test_import_in_chunks(self):
+        rows = [[f'Item {i}', f'uid-{i}', i, 45.0, 25.0 + i / 1000, 'https://example.com/item.png'] for i in range(25)]
+        rows[3][3] = 'north'
+        rows[7][2] = '7.5'
+        rows[8][2] = '8.0'
+        file = xlsx_file([EXPECTED_HEADERS] + rows)
+
+        rows = iter_xlsx_rows(file)
+        check_headers(rows)
+        # A lookup of the chunk's uids and one upsert per chunk of 10 rows, each in its own transaction
+        with self.assertNumQueries(12):
+            chunks = list(import_collectible_items(rows, chunk_size=10))
+
+        self.assertEqual([chunk['rows'] for chunk in chunks], [10, 10, 5])
+        self.assertEqual([row[1] for chunk in chunks for row in chunk['invalid_rows']], ['uid-3', 'uid-7'])
+        self.assertEqual(CollectibleItem.objects.count(), 23)
+        self.assertEqual(CollectibleItem.objects.get(uid='uid-8').value, 8)
+
+    def test_reupload_updates_items_by_uid(self):
+        rows = [[f'Item {i}', f'uid-{i}', i, 45.0, 25.0, 'https://example.com/item.png'] for i in range(5)]
+        self.client.post(reverse('upload-file'), {'file': xlsx_file([EXPECTED_HEADERS] + rows)},
+                         format='multipart')
+        item = CollectibleItem.objects.get(uid='uid-1')
+
+        rows[1][2] = 10
+        rows.append(['New item', 'uid-5', 5, 45.0, 25.0, 'https://example.com/item.png'])
+        response = self.client.post(reverse('upload-file'), {'file': xlsx_file([EXPECTED_HEADERS] + rows)},
+                                    format='multipart')
+
+        self.assertEqual({key: response.data[key] for key in ('rows', 'inserted', 'updated', 'unchanged')},
+                         {'rows': 6, 'inserted': 1, 'updated': 1, 'unchanged': 4})
+        self.assertEqual(CollectibleItem.objects.count(), 6)
+        item.refresh_from_db()
+        self.assertEqual(item.value, 10)
+
+    def test_reupload_refreshes_collectors_value(self):
+        athlete = get_user_model().objects.create_user(username='collector', password='password123')
+        rows = [['Cup', 'uid-1', 5, 45.0, 25.0, 'https://example.com/cup.png']]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload-file'), {'file': xlsx_file([EXPECTED_HEADERS] + rows)},
+                             format='multipart')
+        collect_item_if_nearby(45.0, 25.0, athlete)
+        self.assertEqual(AthleteStats.objects.get(athlete=athlete).items_value, 5)
+
+        rows[0][2] = 500
+        self.client.post(reverse('upload-file'), {'file': xlsx_file([EXPECTED_HEADERS] + rows)}, format='multipart')
+        stats = AthleteStats.objects.get(athlete=athlete)
+        self.assertEqual((stats.items_count, stats.items_value), (1, 500))
+        self.assertEqual(LeaderboardEntry.objects.get(athlete=athlete, board='items_value').score, 500)
+
+
+class TestImportFormats(APITestCase):
+    rows = [
+        ['Cup', 'uid-1', '5', '45.0', '25.0', 'https://example.com/cup.png'],
+        ['Shoes', 'uid-2', 'many', '45.0', '25.0', 'https://example.com/shoes.png'],
+        ['', '', '', '', '', ''],
+        ['Medal', 'uid-3', '3', '45.5', '25.5', 'https://example.com/medal.png'],
+    ]
+
+    def test_detect_format(self):
+        self.assertEqual(detect_format('items.csv', 'application/octet-stream'), 'csv')
+        self.assertEqual(detect_format('items', 'application/x-ndjson; charset=utf-8'), 'ndjson')
+        self.assertEqual(detect_format('items.JSONL'), 'ndjson')
+        self.assertEqual(detect_format('items.xlsx', 'application/octet-stream'), 'xlsx')
+        with self.assertRaises(UnsupportedFormat):
+            detect_format('items.xls', 'application/vnd.ms-excel')
+
+    def test_csv_upload(self):
+        content = '\ufeff' + '\r\n'.join(','.join(row) for row in [EXPECTED_HEADERS] + self.rows)
+        file = SimpleUploadedFile('items.csv', content.encode(), content_type='text/csv')
+        response = self.client.post(reverse('upload-file'), {'file': file}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['rows'], response.data['inserted']), (3, 2))
+        self.assertEqual(response.data['invalid_rows'], [('Shoes', 'uid-2', 'many', '45.0', '25.0',
+                                                          'https://example.com/shoes.png')])
+        self.assertEqual(CollectibleItem.objects.get(uid='uid-3').latitude, 45.5)
+
+    def test_ndjson_import_job(self):
+        lines = [json.dumps(dict(zip(reversed(EXPECTED_HEADERS), reversed(row)))) for row in self.rows if row[0]]
+        lines.insert(1, 'not json')
+        file = SimpleUploadedFile('items.ndjson', '\n'.join(lines).encode())
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('import-jobs'), {'file': file}, format='multipart')
+
+        job = ImportJob.objects.get(id=response.data['id'])
+        self.assertEqual((job.format, job.status), ('ndjson', ImportJob.Status.DONE))
+        self.assertEqual((job.rows_processed, job.rows_rejected, job.inserted), (4, 2, 2))
+        self.assertEqual(job.rejected_rows.order_by('id').first().row, ['not json'])
+
+    def test_wrong_headers_and_format(self):
+        file = SimpleUploadedFile('items.csv', b'Name,UID\r\nCup,uid-1\r\n', content_type='text/csv')
+        response = self.client.post(reverse('upload-file'), {'file': file}, format='multipart')
+        self.assertEqual(response.data['got'], ['Name', 'UID'])
+
+        file = SimpleUploadedFile('items.txt', b'Cup', content_type='text/plain')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('import-jobs'), {'file': file}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(ImportJob.objects.exists())
+
+
+class TestImportJobs(APITestCase):
+    def _upload(self, file_name='upload_example.xlsx'):
+        path = os.path.join(settings.BASE_DIR, 'app_run', 'tests', 'fixtures', file_name)
+        with open(path, 'rb') as f:
+            file = SimpleUploadedFile(file_name, f.read())
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('import-jobs'), {'file': file}, format='multipart')
+
+    def test_import_job(self):
+        response = self._upload()
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertNotIn('data', response.data)
+        self.assertEqual(Task.objects.get().payload, {'job_id': response.data['id']})
+
+        response = self.client.get(reverse('import-job', args=[response.data['id']]))
+        self.assertEqual(response.data['status'], ImportJob.Status.DONE)
+        self.assertEqual((response.data['rows_processed'], response.data['rows_rejected'],
+                          response.data['inserted']), (6, 4, 2))
+        self.assertEqual(response.data['eta_seconds'], 0)
         self.assertEqual(CollectibleItem.objects.count(), 2)
+        self.assertEqual(ImportJob.objects.get().data, b'')
+
+        response = self.client.get(reverse('import-job-rejected', args=[response.data['id']]))
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], EXPECTED_HEADERS)
+        self.assertEqual([row[1] for row in rows[1:]], ['37729fh2', 'fh548ruh', 'fj39gb27', 'qude82dh'])
+
+    def test_retried_job_starts_over(self):
+        path = os.path.join(settings.BASE_DIR, 'app_run', 'tests', 'fixtures', 'upload_example.xlsx')
+        with open(path, 'rb') as f:
+            data = f.read()
+        job = ImportJob.objects.create(file_name='upload_example.xlsx', data=data)
+        run_import_job(job.id)
+        # A worker that died mid-import leaves the job running with its file still there
+        ImportJob.objects.filter(id=job.id).update(status=ImportJob.Status.RUNNING, data=data)
+        run_import_job(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual((job.rows_processed, job.rows_rejected, job.inserted, job.unchanged), (6, 4, 0, 2))
+        self.assertEqual(job.rejected_rows.count(), 4)
+
+    def test_wrong_headers(self):
+        job = ImportJob.objects.create(file_name='items.xlsx', data=xlsx_file([['Name', 'UID']]).getvalue())
+        run_import_job(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.Status.FAILED)
+        self.assertIn('Wrong headers', job.error)
+
+    def _job(self, count):
+        rows = [[f'Item {i}', f'uid-{i}', i, 45.0, 25.0, 'https://example.com/item.png'] for i in range(count)]
+        return ImportJob.objects.create(file_name='items.xlsx',
+                                        data=xlsx_file([EXPECTED_HEADERS] + rows).getvalue())
+
+    def test_job_bumps_items_version_once(self):
+        job = self._job(6)
+        with self.captureOnCommitCallbacks() as callbacks:
+            run_import_job(job.id, chunk_size=2)
+        self.assertEqual(len(callbacks), 1)
+
+    def test_failed_job_bumps_items_version_of_committed_chunks(self):
+        job = self._job(4)
+        with patch('app_run.importers._upsert_items', side_effect=[(2, 0, 0), RuntimeError('Database went away')]):
+            with self.captureOnCommitCallbacks() as callbacks, self.assertRaises(RuntimeError):
+                run_import_job(job.id, chunk_size=2)
+        self.assertEqual(len(callbacks), 1)
+
+    @override_settings(TASK_QUEUE_EAGER=False)
+    def test_import_task_keeps_its_lock_fresh(self):
+        job = self._job(4)
+        enqueue('import_items', {'job_id': job.id, 'chunk_size': 2})
+        task = claim_task()
+        long_ago = timezone.now() - timedelta(seconds=settings.TASK_LOCK_TIMEOUT_SECONDS * 2)
+        Task.objects.update(locked_at=long_ago)
+
+        # Seen at the start of every chunk
+        locks = []
+
+        def record_lock(rejected_rows):
+            locks.append(Task.objects.get().locked_at)
+
+        with patch('app_run.importers.ImportRejectedRow.objects.bulk_create', side_effect=record_lock):
+            run_task(task)
+
+        self.assertEqual(locks[0], long_ago)
+        self.assertGreater(locks[1], timezone.now() - timedelta(seconds=settings.TASK_LOCK_TIMEOUT_SECONDS))
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.Status.DONE)
+
+    @override_settings(IMPORT_JOB_MAX_FILE_BYTES=100)
+    def test_file_size_limit(self):
+        response = self._upload()
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertFalse(ImportJob.objects.exists())
+
+    def test_job_is_not_left_queued_when_enqueue_fails(self):
+        with patch('app_run.views.enqueue', side_effect=RuntimeError('Queue unavailable')):
+            with self.assertRaises(RuntimeError):
+                self._upload()
+        self.assertFalse(ImportJob.objects.exists())
 
 
 class CollectibleItemsEndpointTest(APITestCase):
@@ -298,7 +612,7 @@ class CollectibleItemsEndpointTest(APITestCase):
                                        picture='https:\\test.com',
                                        value=1)
         CollectibleItem.objects.create(name='Test2',
-                                       uid='asd',
+                                       uid='qwe',
                                        latitude=11,
                                        longitude=22,
                                        picture='https:\\test.com',
@@ -311,6 +625,58 @@ class CollectibleItemsEndpointTest(APITestCase):
         self.assertEqual(len(response.data), 2)
 
 
+class TestNearbyCollectibleItems(APITestCase):
+    def setUp(self):
+        # Due north of (45, 25) every 0.001 degrees (~111 m), plus one in the corner of the 500 m box
+        points = [(45 + i * 0.001, 25.0) for i in (7, 1, 3, 20)] + [(45.004, 25.005), (10.0, 179.9), (10.0, -179.9)]
+        for i, (latitude, longitude) in enumerate(points):
+            CollectibleItem.objects.create(name=f'Item {i}', uid=f'item-{i}', latitude=latitude, longitude=longitude,
+                                           picture='https://example.com/item.png', value=1)
+
+    def test_nearby(self):
+        response = self.client.get(reverse('collectible_item-list'), {'lat': 45, 'lon': 25, 'radius': 500})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['uid'] for item in response.data['results']], ['item-1', 'item-2'])
+        self.assertAlmostEqual(response.data['results'][0]['distance'], 111.1, delta=0.5)
+        with self.settings(RUN_DISTANCE_ENGINE='haversine'):
+            response = self.client.get(reverse('collectible_item-list'), {'lat': 45, 'lon': 25, 'radius': 500})
+        # The configured engine: a sphere makes a degree of latitude a little longer than the ellipsoid does
+        self.assertAlmostEqual(response.data['results'][0]['distance'], 111.2, delta=0.05)
+
+        response = self.client.get(reverse('collectible_item-list'), {'lat': 45, 'lon': 25, 'radius': 3000, 'size': 2})
+        self.assertEqual(response.data['count'], 5)
+        self.assertEqual([item['uid'] for item in response.data['results']], ['item-1', 'item-2'])
+        self.assertIsNotNone(response.data['next'])
+
+    def test_box(self):
+        response = self.client.get(reverse('collectible_item-list'),
+                                   {'min_lat': 44.9, 'min_lon': 24.9, 'max_lat': 45.0045, 'max_lon': 25.1})
+        self.assertEqual([item['uid'] for item in response.data['results']], ['item-1', 'item-2', 'item-4'])
+
+        # Crossing the antimeridian
+        response = self.client.get(reverse('collectible_item-list'),
+                                   {'min_lat': 9.5, 'min_lon': 179.5, 'max_lat': 10.5, 'max_lon': -179.5})
+        self.assertEqual({item['uid'] for item in response.data['results']}, {'item-5', 'item-6'})
+
+    def test_invalid_parameters(self):
+        for params in ({'lat': 45, 'lon': 25}, {'lat': 95, 'lon': 25, 'radius': 10},
+                       {'lat': 45, 'lon': 25, 'radius': 10 ** 6}, {'lat': 'north', 'lon': 25, 'radius': 10},
+                       {'min_lat': 40, 'min_lon': 20, 'max_lat': 45, 'max_lon': 25},
+                       {'min_lat': 10, 'min_lon': 179, 'max_lat': 10.5, 'max_lon': -179.5}):
+            response = self.client.get(reverse('collectible_item-list'), params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+    def test_full_width_box_is_rejected(self):
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('collectible_item-list'),
+                                       {'min_lat': 9.5, 'min_lon': -180, 'max_lat': 10.5, 'max_lon': 180})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_plain_list_unchanged(self):
+        response = self.client.get(reverse('collectible_item-list'))
+        self.assertEqual(len(response.data), 7)
+
+
 class CollectibleItemsTest(APITestCase):
     def setUp(self):
         self.user = get_user_model().objects.create_user(
@@ -396,7 +762,7 @@ class CollectibleItemsTest(APITestCase):
         with self.assertNumQueries(3):
             self.client.get(reverse('users-detail', args=[self.user.id]))
 
-class CollectItemNearbyUnitTestCase(APITestCase):
+class CollectItemIfNearbyUnitTestCase(APITestCase):
     def setUp(self):
         self.user = get_user_model().objects.create_user(
             username='testuser',
@@ -405,23 +771,24 @@ class CollectItemNearbyUnitTestCase(APITestCase):
 
         )
 
-        self.item1 = CollectibleItem.objects.create(
-            name="Item1",
-            uid="item1uid",
-            latitude=40.0000,
-            longitude=29.0000,
-            picture="http://example.com/item1.png",
-            value=100
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item1 = CollectibleItem.objects.create(
+                name="Item1",
+                uid="item1uid",
+                latitude=40.0000,
+                longitude=29.0000,
+                picture="http://example.com/item1.png",
+                value=100
+            )
 
-        self.item2 = CollectibleItem.objects.create(
-            name="Item2",
-            uid="item2uid",
-            latitude=40.0020,
-            longitude=29.0020,
-            picture="http://example.com/item2.png",
-            value=200
-        )
+            self.item2 = CollectibleItem.objects.create(
+                name="Item2",
+                uid="item2uid",
+                latitude=40.0020,
+                longitude=29.0020,
+                picture="http://example.com/item2.png",
+                value=200
+            )
 
     @patch("app_run.utils.geodesic")
     def test_collect_item_if_nearby(self, mock_geodesic):
@@ -432,12 +799,34 @@ class CollectItemNearbyUnitTestCase(APITestCase):
 
         mock_geodesic.side_effect = [near, far]
 
-        collected = collect_item_if_nearby(10, 10, self.user)
+        collected = collect_item_if_nearby(40.0005, 29.0005, self.user)
 
         self.assertIn(self.item1, collected)
         self.assertNotIn(self.item2, collected)
         self.assertTrue(self.user.collectible_items.filter(id=self.item1.id).exists())
 
+    @patch("app_run.utils.geodesic")
+    def test_collect_item_if_nearby_skips_items_outside_bounding_box(self, mock_geodesic):
+        collected = collect_item_if_nearby(10, 10, self.user)
+
+        self.assertEqual(collected, [])
+        mock_geodesic.assert_not_called()
+
+    def test_collect_item_if_nearby_across_antimeridian(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            item = CollectibleItem.objects.create(
+                name="Item3",
+                uid="item3uid",
+                latitude=10.0000,
+                longitude=-179.9997,
+                picture="http://example.com/item3.png",
+                value=300
+            )
+
+        collected = collect_item_if_nearby(10.0000, 179.9997, self.user)
+
+        self.assertEqual(collected, [item])
+
 
 class CollectItemNearbyUnitTestCase(APITestCase):
     ITEM_POSITION = (50.4501, 30.5234)
@@ -452,14 +841,15 @@ class CollectItemNearbyUnitTestCase(APITestCase):
 
         )
 
-        self.item = CollectibleItem.objects.create(
-            name="Item1",
-            uid="item1uid",
-            latitude=self.ITEM_POSITION[0],
-            longitude=self.ITEM_POSITION[1],
-            picture="http://example.com/item1.png",
-            value=100
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item = CollectibleItem.objects.create(
+                name="Item1",
+                uid="item1uid",
+                latitude=self.ITEM_POSITION[0],
+                longitude=self.ITEM_POSITION[1],
+                picture="http://example.com/item1.png",
+                value=100
+            )
 
         self.run_in_progress = Run.objects.create(athlete=self.user,
                                                   comment='Test Run 1',
@@ -499,6 +889,67 @@ class CollectItemNearbyUnitTestCase(APITestCase):
         self.assertIsInstance(response.json().get("items")[0], dict)
 
 
+class CollectibleItemsIndexTest(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='testuser',
+            password='password123',
+            email='test@example.com',
+
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item = CollectibleItem.objects.create(
+                name="Item1",
+                uid="item1uid",
+                latitude=50.4501,
+                longitude=30.5234,
+                picture="http://example.com/item1.png",
+                value=100
+            )
+
+    def test_index_is_reused_until_catalog_changes(self):
+        get_collectible_items_index()
+        with self.assertNumQueries(0):
+            index = get_collectible_items_index()
+        self.assertEqual(index.size, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            CollectibleItem.objects.create(name="Item2",
+                                           uid="item2uid",
+                                           latitude=50.4502,
+                                           longitude=30.5235,
+                                           picture="http://example.com/item2.png",
+                                           value=200)
+        self.assertEqual(get_collectible_items_index().size, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.delete()
+        self.assertEqual(get_collectible_items_index().size, 1)
+
+        # Nothing changes for other processes until the transaction commits
+        with self.captureOnCommitCallbacks() as callbacks:
+            CollectibleItem.objects.create(name="Item3", uid="item3uid", latitude=50.4503, longitude=30.5236,
+                                           picture="http://example.com/item3.png", value=300)
+            self.assertEqual(get_collectible_items_index().size, 1)
+        self.assertEqual(len(callbacks), 1)
+
+    def test_position_far_from_items_does_not_query_items(self):
+        get_collectible_items_index()
+        with CaptureQueriesContext(connection) as queries:
+            collect_item_if_nearby(10, 10, self.user)
+        self.assertEqual(len(queries.captured_queries), 0)
+
+        collected = collect_item_if_nearby(50.45055, 30.5234, self.user)
+        self.assertEqual(collected, [self.item])
+        self.assertEqual(collect_item_if_nearby(50.45055, 30.5234, self.user), [])
+
+    def test_grid_index_candidates(self):
+        index = GridIndex([(1, 50.4501, 30.5234), (2, 50.4600, 30.5234), (3, 10.0, -179.9999)])
+        self.assertEqual([key for key, _, _ in index.candidates([(50.4505, 30.5234)], 100)], [1])
+        self.assertEqual([key for key, _, _ in index.candidates([(10.0, 179.9999)], 100)], [3])
+        self.assertEqual([key for key, _, _ in index.candidates([(0, 0)], 100)], [])
+
+
 class RunTimeTestCase(APITestCase):
 
     def setUp(self):
@@ -586,7 +1037,8 @@ class RunTimeTestCase(APITestCase):
 
         )
 
-        response = self.client.post(reverse('run-stop', args=[self.run_in_progress.id]))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('run-stop', args=[self.run_in_progress.id]))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
         response = self.client.get(reverse('runs-detail', args=[self.run_in_progress.id]))
@@ -632,11 +1084,596 @@ class TestPositionDistanceCalculation(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(Positions.objects.last().distance, 0.74)
 
-        response = self.client.post(reverse('run-stop', args=[self.run_in_progress.id]))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('run-stop', args=[self.run_in_progress.id]))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(Run.objects.last().speed, 2.72)
 
 
+class TestPositionsBulkEndpoint(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='testuser',
+            password='password123',
+            email='test@example.com',
+
+        )
+        self.run_in_progress = Run.objects.create(athlete=self.user,
+                                                  comment='Test Run 1',
+                                                  status=Run.Status.IN_PROGRESS)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item = CollectibleItem.objects.create(
+                name="Item1",
+                uid="item1uid",
+                latitude=45.0000,
+                longitude=25.0095,
+                picture="http://example.com/item1.png",
+                value=100
+            )
+        self.fixes = [
+            {'latitude': 45.0000, 'longitude': 25.0000, 'date_time': '2024-10-12T14:35:15.123456'},
+            {'latitude': 45.0000, 'longitude': 25.0031, 'date_time': '2024-10-12T14:36:15.123456'},
+            {'latitude': 45.0000, 'longitude': 25.0095, 'date_time': '2024-10-12T14:38:15.123456'},
+        ]
+
+    def test_bulk_create_positions(self):
+        response = self.client.post(reverse('positions-bulk'),
+                                    data={'run': self.run_in_progress.id, 'positions': self.fixes},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 3)
+        self.assertEqual(list(Positions.objects.order_by('id').values_list('distance', flat=True)),
+                         [0, 0.24, 0.74])
+        self.assertEqual(list(Positions.objects.order_by('id').values_list('speed', flat=True)),
+                         [0, 4.0, 4.17])
+        self.assertEqual(self.user.collectible_items.count(), 1)
+
+    def test_bulk_create_continues_existing_track(self):
+        self.client.post(reverse('positions-list'), data={'run': self.run_in_progress.id, **self.fixes[0]})
+        response = self.client.post(reverse('positions-bulk'),
+                                    data={'run': self.run_in_progress.id, 'positions': self.fixes[1:]},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Positions.objects.order_by('id').last().distance, 0.74)
+
+    def test_bulk_create_query_count_does_not_grow_with_batch(self):
+        fixes = [{'latitude': 45.0000, 'longitude': 25.005 + 0.0001 * i, 'date_time': f'2024-10-12T14:{i:02}:15.123456'}
+                 for i in range(1, 50)]
+        get_collectible_items_index()
+        with self.assertNumQueries(20):
+            response = self.client.post(reverse('positions-bulk'),
+                                        data={'run': self.run_in_progress.id, 'positions': fixes},
+                                        format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Positions.objects.count(), 49)
+        self.assertEqual(self.user.collectible_items.count(), 1)
+
+    def test_bulk_create_validation(self):
+        run_finished = Run.objects.create(athlete=self.user,
+                                          comment='Test Run',
+                                          status=Run.Status.FINISHED)
+        response = self.client.post(reverse('positions-bulk'),
+                                    data={'run': run_finished.id, 'positions': self.fixes},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(reverse('positions-bulk'),
+                                    data={'run': self.run_in_progress.id, 'positions': []},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(reverse('positions-bulk'),
+                                    data={'run': self.run_in_progress.id,
+                                          'positions': [{'latitude': 91, 'longitude': 22,
+                                                         'date_time': '2024-10-12T14:42:15.123456'}]},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Positions.objects.count(), 0)
+
+
+class TestRunTotals(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='testuser',
+            password='password123',
+            email='test@example.com',
+
+        )
+        self.run_in_progress = Run.objects.create(athlete=self.user,
+                                                  comment='Test Run 1',
+                                                  status=Run.Status.IN_PROGRESS)
+
+    def test_run_totals_are_updated_on_position_create(self):
+        for longitude, date_time in ((25.0000, '2024-10-12T14:35:15.123456'),
+                                     (25.0031, '2024-10-12T14:36:15.123456'),
+                                     (25.0095, '2024-10-12T14:38:15.123456')):
+            self.client.post(reverse('positions-list'), data={'run': self.run_in_progress.id,
+                                                              'latitude': 45.0000,
+                                                              'longitude': longitude,
+                                                              'date_time': date_time})
+        self.run_in_progress.refresh_from_db()
+        self.assertEqual(self.run_in_progress.positions_count, 3)
+        self.assertEqual(self.run_in_progress.speed_count, 3)
+        self.assertAlmostEqual(self.run_in_progress.track_distance,
+                               calculate_and_save_run_distance(self.run_in_progress.id))
+        self.assertEqual(self.run_in_progress.last_longitude, 25.0095)
+        self.assertEqual(calculate_run_time_in_seconds(self.run_in_progress), 180)
+
+        response = self.client.get(reverse('runs-detail', args=[self.run_in_progress.id]))
+        self.assertNotIn('positions_count', response.data)
+        self.assertNotIn('last_latitude', response.data)
+
+    def test_run_totals_follow_edited_and_deleted_positions(self):
+        fixes = [{'latitude': 45.0000, 'longitude': 25 + 0.001 * i, 'date_time': f'2024-10-12T14:{i:02}:15.123456'}
+                 for i in range(5)]
+        self.client.post(reverse('positions-bulk'), data={'run': self.run_in_progress.id, 'positions': fixes},
+                         format='json')
+        positions = list(Positions.objects.filter(run=self.run_in_progress).order_by('id'))
+
+        positions[2].longitude = 25.01
+        positions[2].save()
+        response = self.client.delete(reverse('positions-detail', args=[positions[4].id]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        self.run_in_progress.refresh_from_db()
+        self.assertEqual(self.run_in_progress.positions_count, 4)
+        self.assertAlmostEqual(self.run_in_progress.track_distance,
+                               calculate_and_save_run_distance(self.run_in_progress.id))
+        self.assertEqual(self.run_in_progress.last_longitude, 25.003)
+        self.assertEqual(calculate_run_time_in_seconds(self.run_in_progress), 3 * 60)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('run-stop', args=[self.run_in_progress.id]))
+        response = self.client.delete(reverse('positions-detail', args=[positions[0].id]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(TASK_QUEUE_EAGER=False)
+    def test_run_stop_does_not_depend_on_track_length(self):
+        fixes = [{'latitude': 45.0000, 'longitude': 25 + 0.0001 * i, 'date_time': f'2024-10-12T14:{i:02}:15.123456'}
+                 for i in range(50)]
+        self.client.post(reverse('positions-bulk'),
+                         data={'run': self.run_in_progress.id, 'positions': fixes},
+                         format='json')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('run-stop', args=[self.run_in_progress.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(any('app_run_positions' in query['sql'] for query in queries.captured_queries))
+
+        # The simplified track is built by the finalize_run task, off the request path
+        run_task(claim_task())
+        run = Run.objects.get(id=self.run_in_progress.id)
+        self.assertTrue(run.simplified_track)
+        self.assertAlmostEqual(run.distance, track_length([(45, 25 + 0.0001 * i) for i in range(50)]))
+        self.assertEqual(run.run_time_seconds, 49 * 60)
+        self.assertEqual(run.speed, round(sum(Positions.objects.values_list('speed', flat=True)) / 50, 2))
+
+
+class TestRunTrackExport(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='testuser',
+            password='password123',
+            email='test@example.com',
+
+        )
+        self.run = Run.objects.create(athlete=self.user,
+                                      comment='Test Run 1',
+                                      status=Run.Status.IN_PROGRESS)
+        self.positions = [
+            Positions.objects.create(run=self.run, latitude=45.0, longitude=25.0 + i / 1000,
+                                     date_time=f'2024-10-12T14:3{i}:15.123456Z', speed=i, distance=i / 10)
+            for i in range(3)
+        ]
+
+    def test_export_ndjson(self):
+        response = self.client.get(reverse('run-export', args=[self.run.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [position.id for position in self.positions])
+        self.assertEqual(rows[1], {'id': self.positions[1].id, 'latitude': 45.0, 'longitude': 25.001,
+                                   'date_time': '2024-10-12T14:31:15.123456', 'speed': 1.0, 'distance': 0.1})
+
+    def test_export_csv(self):
+        response = self.client.get(reverse('run-export', args=[self.run.id]), data={'type': 'csv'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], ['id', 'latitude', 'longitude', 'date_time', 'speed', 'distance'])
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[3][3], '2024-10-12T14:32:15.123456')
+
+    def test_export_errors(self):
+        response = self.client.get(reverse('run-export', args=[self.run.id]), data={'type': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('run-export', args=[self.run.id + 1]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TestEncodedTrack(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='testuser',
+            password='password123',
+            email='test@example.com',
+
+        )
+        self.run = Run.objects.create(athlete=self.user,
+                                      comment='Test Run 1',
+                                      status=Run.Status.IN_PROGRESS)
+        self.points = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+        for i, (latitude, longitude) in enumerate(self.points):
+            Positions.objects.create(run=self.run, latitude=latitude, longitude=longitude,
+                                     date_time=f'2024-10-12T14:30:{15 + i * 2}.{i}00000Z')
+
+    def test_polyline_encoding(self):
+        self.assertEqual(encode_polyline(self.points), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+        self.assertEqual(decode_polyline('_p~iF~ps|U_ulLnnqC_mqNvxq`@'), self.points)
+        self.assertEqual(decode_deltas(encode_deltas([0, 2100, 4200, 4100, -5])), [0, 2100, 4200, 4100, -5])
+
+    def test_positions_list_polyline(self):
+        response = self.client.get(reverse('positions-list'), data={'run': self.run.id, 'track': 'polyline'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'run': self.run.id, 'points': 3, 'polyline': '_p~iF~ps|U_ulLnnqC_mqNvxq`@'})
+
+        response = self.client.get(reverse('positions-list'),
+                                   data={'run': self.run.id, 'track': 'polyline', 'timestamps': 'true'})
+        self.assertEqual(response.data['started_at'], '2024-10-12T14:30:15.000000')
+        self.assertEqual(decode_deltas(response.data['timestamps']), [0, 2100, 4200])
+
+        response = self.client.get(reverse('positions-list'), data={'track': 'polyline'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_run_detail_polyline(self):
+        response = self.client.get(reverse('runs-detail', args=[self.run.id]))
+        self.assertNotIn('track', response.data)
+
+        response = self.client.get(reverse('runs-detail', args=[self.run.id]), data={'track': 'polyline'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['track']['polyline'], '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+
+class TestTrackSimplification(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='testuser',
+            password='password123',
+            email='test@example.com',
+
+        )
+        self.run = Run.objects.create(athlete=self.user,
+                                      comment='Test Run 1',
+                                      status=Run.Status.IN_PROGRESS)
+        # A straight line with a single 50 m detour in the middle
+        fixes = [{'latitude': 45.0, 'longitude': 25 + i * 0.0001, 'date_time': f'2024-10-12T14:{i:02}:15.123456'}
+                 for i in range(21)]
+        fixes[10]['latitude'] = 45.00045
+        self.client.post(reverse('positions-bulk'), data={'run': self.run.id, 'positions': fixes}, format='json')
+
+    def test_douglas_peucker(self):
+        points = [(45.0, 25 + i * 0.0001) for i in range(21)]
+        points[10] = (45.00045, 25.001)
+        self.assertEqual(simplify_track(points, tolerance_m=5), [0, 9, 10, 11, 20])
+        self.assertEqual(simplify_track(points, tolerance_m=100), [0, 20])
+        self.assertEqual(simplify_track(points, max_points=3), [0, 10, 20])
+        self.assertEqual(simplify_track(points[:1], tolerance_m=5), [0])
+
+    def test_simplified_track_is_stored_when_run_finishes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('run-stop', args=[self.run.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.run.refresh_from_db()
+        self.assertEqual(decode_polyline(self.run.simplified_track),
+                         [(45.0, 25.0), (45.0, 25.0009), (45.00045, 25.001), (45.0, 25.0011), (45.0, 25.002)])
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('positions-list'),
+                                       data={'run': self.run.id, 'track': 'polyline', 'simplify': 'true'})
+        self.assertEqual(response.data['points'], 5)
+        self.assertEqual(response.data['polyline'], self.run.simplified_track)
+
+    def test_simplification_parameters(self):
+        response = self.client.get(reverse('runs-detail', args=[self.run.id]),
+                                   data={'track': 'polyline', 'simplify': 'true', 'tolerance': 100})
+        self.assertEqual(response.data['track']['points'], 2)
+
+        response = self.client.get(reverse('positions-list'),
+                                   data={'run': self.run.id, 'track': 'polyline', 'simplify': 'true',
+                                         'points': 3, 'timestamps': 'true'})
+        self.assertEqual(response.data['points'], 3)
+        self.assertEqual(decode_deltas(response.data['timestamps']), [0, 600000, 1200000])
+
+        response = self.client.get(reverse('positions-list'),
+                                   data={'run': self.run.id, 'track': 'polyline', 'simplify': 'true',
+                                         'tolerance': 'far'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestRunArchive(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='testuser',
+            password='password123',
+            email='test@example.com',
+
+        )
+        self.run = Run.objects.create(athlete=self.user,
+                                      comment='Test Run 1',
+                                      status=Run.Status.IN_PROGRESS)
+        fixes = [{'latitude': 45.0 + i * 0.00013, 'longitude': 25 + i * 0.0001,
+                  'date_time': f'2024-10-12T14:{i:02}:15.123456'}
+                 for i in range(30)]
+        self.client.post(reverse('positions-bulk'), data={'run': self.run.id, 'positions': fixes}, format='json')
+        Positions.objects.create(run=self.run, latitude=45.01, longitude=25.01)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('run-stop', args=[self.run.id]))
+        self.run.refresh_from_db()
+
+    @staticmethod
+    def rounded(rows):
+        return [{key: round(value, 6) if isinstance(value, float) else value for key, value in row.items()}
+                for row in rows]
+
+    def test_pack_track_round_trip(self):
+        rows = list(iter_run_track(self.run.id))
+        unpacked = unpack_track(pack_track(rows))
+        self.assertEqual([row[:4] for row in unpacked], [row[:4] for row in rows])
+        for row, original in zip(unpacked, rows):
+            for value, expected in zip(row[4:], original[4:]):
+                self.assertAlmostEqual(value, expected, places=6)
+        self.assertIsNone(unpacked[-1][3])
+        self.assertEqual(unpack_track(pack_track([])), [])
+
+    def test_archived_run_reads_like_a_live_run(self):
+        positions = self.client.get(reverse('positions-list'), data={'run': self.run.id, 'size': 7})
+        export = b''.join(self.client.get(reverse('run-export', args=[self.run.id])).streaming_content)
+        export = self.rounded(json.loads(line) for line in export.splitlines())
+        polyline = self.client.get(reverse('positions-list'),
+                                   data={'run': self.run.id, 'track': 'polyline', 'timestamps': 'true'}).data
+        distance = calculate_and_save_run_distance(self.run.id)
+        run_time = calculate_run_time_in_seconds(self.run)
+
+        archive = archive_run(self.run)
+        self.assertEqual(archive.positions_count, 31)
+        self.assertFalse(Positions.objects.filter(run=self.run).exists())
+
+        archived = self.client.get(reverse('positions-list'), data={'run': self.run.id, 'size': 7}).data
+        self.assertEqual(archived['next'], positions.data['next'])
+        self.assertEqual(self.rounded(archived['results']), self.rounded(positions.data['results']))
+        self.assertEqual(len(self.client.get(archived['next']).data['results']), 7)
+        archived_export = b''.join(self.client.get(reverse('run-export', args=[self.run.id])).streaming_content)
+        self.assertEqual(self.rounded(json.loads(line) for line in archived_export.splitlines()), export)
+        self.assertEqual(self.client.get(reverse('positions-list'),
+                                         data={'run': self.run.id, 'track': 'polyline', 'timestamps': 'true'}).data,
+                         polyline)
+        self.assertAlmostEqual(calculate_and_save_run_distance(self.run.id), distance, places=6)
+        self.assertEqual(calculate_run_time_in_seconds(self.run), run_time)
+
+    def test_archived_position_detail(self):
+        position = Positions.objects.filter(run=self.run).order_by('id')[5]
+        expected = self.rounded([self.client.get(reverse('positions-detail', args=[position.id])).data])
+        other = Run.objects.create(athlete=self.user, comment='Test Run 2', status=Run.Status.IN_PROGRESS)
+        live = Positions.objects.create(run=other, latitude=45.0, longitude=25.0)
+        archive_run(self.run)
+
+        response = self.client.get(reverse('positions-detail', args=[position.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.rounded([response.data]), expected)
+        response = self.client.get(reverse('positions-detail', args=[position.id]), data={'run': other.id})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.delete(reverse('positions-detail', args=[position.id]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # The unfiltered list only walks the positions table, archived runs are listed with ?run=
+        response = self.client.get(reverse('positions-list'))
+        self.assertEqual([row['id'] for row in response.data['results']], [live.id])
+
+    def test_archive_runs_command(self):
+        Run.objects.filter(id=self.run.id).update(created_at=timezone.now() - timedelta(days=31))
+        in_progress = Run.objects.create(athlete=self.user, comment='Test Run 2', status=Run.Status.IN_PROGRESS)
+        Positions.objects.create(run=in_progress, latitude=45.0, longitude=25.0)
+
+        out = StringIO()
+        call_command('archive_runs', '--dry-run', stdout=out)
+        self.assertIn('1 runs would be archived', out.getvalue())
+        self.assertFalse(RunArchive.objects.exists())
+
+        call_command('archive_runs', stdout=StringIO())
+        self.assertEqual(RunArchive.objects.get().run_id, self.run.id)
+        self.assertEqual(Positions.objects.count(), 1)
+
+        with self.assertRaises(ValueError):
+            archive_run(in_progress)
+
+
+@override_settings(TASK_QUEUE_EAGER=False)
+class TestRunFinalizationQueue(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='testuser',
+            password='password123',
+            email='test@example.com',
+
+        )
+        self.run = Run.objects.create(athlete=self.user,
+                                      comment='Test Run 1',
+                                      status=Run.Status.IN_PROGRESS)
+        fixes = [{'latitude': 45.0, 'longitude': 25 + i * 0.001, 'date_time': f'2024-10-12T14:{i:02}:15.123456'}
+                 for i in range(30)]
+        self.client.post(reverse('positions-bulk'), data={'run': self.run.id, 'positions': fixes}, format='json')
+
+    def test_stop_is_undone_when_enqueue_fails(self):
+        with patch('app_run.views.enqueue', side_effect=RuntimeError('Queue unavailable')):
+            with self.assertRaises(RuntimeError):
+                self.client.post(reverse('run-stop', args=[self.run.id]))
+        self.run.refresh_from_db()
+        self.assertEqual((self.run.status, self.run.stats_status), (Run.Status.IN_PROGRESS, None))
+
+        response = self.client.post(reverse('run-stop', args=[self.run.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Task.objects.get().payload, {'run_id': self.run.id})
+
+    def test_stop_queues_finalization(self):
+        response = self.client.post(reverse('run-stop', args=[self.run.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        run = self.client.get(reverse('runs-detail', args=[self.run.id])).data
+        self.assertEqual(run['status'], Run.Status.FINISHED)
+        self.assertEqual(run['stats_status'], Run.StatsStatus.PENDING)
+        self.assertIsNone(run['distance'])
+
+        task = Task.objects.get()
+        self.assertEqual((task.name, task.payload, task.status), ('finalize_run', {'run_id': self.run.id},
+                                                                  Task.Status.QUEUED))
+        self.assertEqual(enqueue('finalize_run', {'run_id': self.run.id},
+                                 idempotency_key=f'finalize_run:{self.run.id}'), task)
+
+        call_command('run_worker', '--once', stdout=StringIO())
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.Status.DONE, 1))
+
+        run = self.client.get(reverse('runs-detail', args=[self.run.id])).data
+        self.assertEqual(run['stats_status'], Run.StatsStatus.READY)
+        self.assertAlmostEqual(run['distance'], 2.29, places=2)
+        self.assertEqual(run['run_time_seconds'], 29 * 60)
+
+        # Finalizing again does not recompute or award anything
+        Run.objects.filter(id=self.run.id).update(distance=0)
+        finalize_run(self.run.id)
+        self.run.refresh_from_db()
+        self.assertEqual(self.run.distance, 0)
+
+    def test_failed_finalization_is_retried(self):
+        failing = MagicMock(side_effect=RuntimeError('database went away'))
+        with patch.dict(TASK_HANDLERS, finalize_run=failing):
+            self.client.post(reverse('run-stop', args=[self.run.id]))
+            Task.objects.update(max_attempts=2)
+
+            call_command('run_worker', '--once', stdout=StringIO(), stderr=StringIO())
+            task = Task.objects.get()
+            self.assertEqual((task.status, task.attempts), (Task.Status.QUEUED, 1))
+            self.assertIn('database went away', task.last_error)
+            self.assertGreater(task.run_after, timezone.now())
+
+            # Not due yet
+            call_command('run_worker', '--once', stdout=StringIO(), stderr=StringIO())
+            self.assertEqual(failing.call_count, 1)
+
+            Task.objects.update(run_after=timezone.now())
+            call_command('run_worker', '--once', stdout=StringIO(), stderr=StringIO())
+
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.Status.FAILED, 2))
+        self.run.refresh_from_db()
+        self.assertEqual(self.run.stats_status, Run.StatsStatus.FAILED)
+
+    def test_stale_running_task_is_reclaimed(self):
+        self.client.post(reverse('run-stop', args=[self.run.id]))
+        self.assertIsNotNone(claim_task())
+        self.assertIsNone(claim_task())
+
+        Task.objects.update(locked_at=timezone.now() - timedelta(seconds=settings.TASK_LOCK_TIMEOUT_SECONDS + 1))
+        call_command('run_worker', '--once', stdout=StringIO())
+        self.run.refresh_from_db()
+        self.assertEqual(self.run.stats_status, Run.StatsStatus.READY)
+
+
+class TestAthleteStats(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='testuser',
+            password='password123',
+            email='test@example.com',
+
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            CollectibleItem.objects.create(name='Item', uid='item-1', latitude=45.0, longitude=25.001,
+                                           picture='https://example.com/item.png', value=7)
+        for minutes in (5, 20):
+            run = Run.objects.create(athlete=self.user, comment='Test Run', status=Run.Status.IN_PROGRESS)
+            fixes = [{'latitude': 45.0, 'longitude': 25 + i * 0.001,
+                      'date_time': f'2024-10-12T14:{i * minutes // 10:02}:15.123456'} for i in range(11)]
+            self.client.post(reverse('positions-bulk'), data={'run': run.id, 'positions': fixes}, format='json')
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('run-stop', args=[run.id]))
+
+    def test_stats_follow_finished_runs_and_items(self):
+        stats = self.user.stats
+        runs = Run.objects.filter(athlete=self.user)
+        self.assertEqual(stats.runs_finished, 2)
+        self.assertAlmostEqual(stats.total_distance, sum(runs.values_list('distance', flat=True)))
+        self.assertAlmostEqual(stats.longest_distance, max(runs.values_list('distance', flat=True)))
+        self.assertEqual(stats.total_run_time_seconds, 5 * 60 + 20 * 60)
+        self.assertAlmostEqual(stats.avg_speed, sum(runs.values_list('speed', flat=True)) / 2)
+        self.assertEqual((stats.items_count, stats.items_value), (1, 7))
+
+        response = self.client.get(reverse('users-detail', args=[self.user.id]))
+        self.assertEqual(response.data['runs_finished'], 2)
+
+    def test_rebuild_matches_incremental_stats(self):
+        fields = [field.name for field in AthleteStats._meta.concrete_fields if field.name != 'id']
+        incremental = AthleteStats.objects.values(*fields).get()
+        AthleteStats.objects.all().delete()
+
+        out = StringIO()
+        call_command('rebuild_athlete_stats', stdout=out)
+        self.assertIn('Rebuilt stats of 1 athletes', out.getvalue())
+        rebuilt = AthleteStats.objects.values(*fields).get()
+        for field in fields:
+            self.assertAlmostEqual(rebuilt[field], incremental[field])
+
+        # Rebuilding twice updates the rows in place
+        rebuild_athlete_stats(athlete_ids=[self.user.id])
+        self.assertEqual(AthleteStats.objects.count(), 1)
+
+    def test_runs_finished_outside_run_stop_are_counted(self):
+        run = Run.objects.create(athlete=self.user, comment='Test Run', status=Run.Status.IN_PROGRESS,
+                                 distance=3, run_time_seconds=900)
+        response = self.client.patch(reverse('runs-detail', args=[run.id]), data={'status': 'finished'},
+                                     format='json')
+        self.assertEqual(response.status_code, 200)
+        other = Run.objects.create(athlete=self.user, comment='Test Run', status=Run.Status.FINISHED, distance=2,
+                                   run_time_seconds=600)
+        other.save()
+
+        stats = AthleteStats.objects.get(athlete=self.user)
+        self.assertEqual(stats.runs_finished, 4)
+        self.assertEqual(stats.total_run_time_seconds, 25 * 60 + 900 + 600)
+        response = self.client.get(reverse('users-list'))
+        self.assertEqual(response.data[0]['runs_finished'], 4)
+
+        # Saving a finished run again doesn't count it twice
+        run.refresh_from_db()
+        run.save()
+        self.assertEqual(AthleteStats.objects.get(athlete=self.user).runs_finished, 4)
+
+    def test_deleted_and_reopened_runs_stop_counting(self):
+        first, second = Run.objects.filter(athlete=self.user).order_by('id')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(reverse('runs-detail', args=[first.id]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.get(reverse('users-list'))
+        self.assertEqual(response.data[0]['runs_finished'], 1)
+        response = self.client.get(reverse('leaderboard', args=['total_distance']))
+        self.assertAlmostEqual(response.data['results'][0]['score'], second.distance)
+        today = timezone.localdate(second.created_at)
+        rollup = RunRollup.objects.get(athlete=self.user, granularity='day', period_start=today)
+        self.assertEqual((rollup.runs_count, rollup.run_time_seconds), (1, 20 * 60))
+
+        response = self.client.patch(reverse('runs-detail', args=[second.id]), data={'status': 'in_progress'},
+                                     format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(AthleteStats.objects.get(athlete=self.user).runs_finished, 0)
+        self.assertFalse(LeaderboardEntry.objects.filter(athlete=self.user, board='total_distance').exists())
+        self.assertFalse(RunRollup.objects.filter(athlete=self.user).exists())
+
+        # Finishing it again counts it again
+        self.client.patch(reverse('runs-detail', args=[second.id]), data={'status': 'finished'}, format='json')
+        self.assertEqual(self.client.get(reverse('users-list')).data[0]['runs_finished'], 1)
+
+
 class TestChallenge2KmIn10Minutes(APITestCase):
 
     def setUp(self):
@@ -666,15 +1703,259 @@ class TestChallenge2KmIn10Minutes(APITestCase):
             date_time='2024-10-12T14:09:15.123456',
 
         )
-        response = self.client.post(reverse('run-stop', args=[self.run_in_progress.id]))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('run-stop', args=[self.run_in_progress.id]))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         challenges = self.user.challenges.all()
         self.assertEqual(challenges.count(), 1)
         self.assertEqual(challenges.first().full_name, 'run2kmin10m')
 
 
+class TestLeaderboards(APITestCase):
+    def setUp(self):
+        self.coach = get_user_model().objects.create_user(username='coach', password='password123', is_staff=True)
+        self.users = [get_user_model().objects.create_user(
+            username=f'testuser{i}',
+            password='password123',
+            email='test@example.com',
+
+        ) for i in range(4)]
+        for user in self.users[:2]:
+            Subscribe.objects.create(subscriber=user, subscribed_to=self.coach)
+        for user, distances in zip(self.users, [(3, 4), (10,), (4, 3), ()]):
+            for distance in distances:
+                Run.objects.create(athlete=user, comment='Test Run', status=Run.Status.FINISHED,
+                                   distance=distance, speed=distance, run_time_seconds=600)
+
+    def board(self, board, **params):
+        response = self.client.get(reverse('leaderboard', args=[board]), data=params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(row['rank'], row['athlete'], row['score']) for row in response.data['results']]
+
+    def test_top_n(self):
+        first, second, third, _ = self.users
+        self.assertEqual(self.board('total_distance'), [(1, second.id, 10), (2, first.id, 7), (3, third.id, 7)])
+        self.assertEqual(self.board('runs_finished', size=2), [(1, first.id, 2), (2, third.id, 2)])
+        self.assertEqual(self.board('avg_speed', coach=self.coach.id), [(1, second.id, 10), (2, first.id, 3.5)])
+        self.assertEqual(self.board('items_value'), [])
+
+        response = self.client.get(reverse('leaderboard', args=['fastest']))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_coach_must_be_staff(self):
+        athlete = self.users[0]
+        response = self.client.get(reverse('leaderboard', args=['total_distance']), data={'coach': athlete.id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('leaderboard-rank', args=['total_distance', athlete.id]),
+                                   data={'coach': athlete.id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rank(self):
+        third = self.users[2]
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('leaderboard-rank', args=['total_distance', third.id]))
+        self.assertEqual((response.data['rank'], response.data['score']), (3, 7))
+
+        response = self.client.get(reverse('leaderboard-rank', args=['total_distance', third.id]),
+                                   data={'coach': self.coach.id})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse('leaderboard-rank', args=['total_distance', self.users[3].id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        # A new run moves the athlete up right away
+        Run.objects.create(athlete=third, comment='Test Run', status=Run.Status.FINISHED, distance=5,
+                           run_time_seconds=600)
+        response = self.client.get(reverse('leaderboard-rank', args=['total_distance', third.id]))
+        self.assertEqual((response.data['rank'], response.data['score']), (1, 12))
+
+    def test_rebuild(self):
+        expected = self.board('total_distance')
+        LeaderboardEntry.objects.update(score=0)
+        out = StringIO()
+        call_command('rebuild_leaderboards', stdout=out)
+        self.assertIn('Rebuilt leaderboards of 3 athletes', out.getvalue())
+        self.assertEqual(self.board('total_distance'), expected)
+
+    def test_benchmark_rank(self):
+        out = StringIO()
+        call_command('benchmark_leaderboard_rank', 'total_distance', '--repeat', '1', stdout=out)
+        self.assertEqual([line.split(':')[0] for line in out.getvalue().splitlines()],
+                         ['rank 1/3', 'rank 2/3', 'rank 3/3'])
+
+
+class TestRunRollups(APITestCase):
+    def setUp(self):
+        self.coach = get_user_model().objects.create_user(username='coach', password='password123', is_staff=True)
+        self.users = [get_user_model().objects.create_user(
+            username=f'testuser{i}',
+            password='password123',
+            email='test@example.com',
+
+        ) for i in range(2)]
+        for user in self.users:
+            Subscribe.objects.create(subscriber=user, subscribed_to=self.coach)
+        # 2024-10-07 is a Monday
+        for user, day, distance in [(self.users[0], '2024-10-07', 3), (self.users[0], '2024-10-09', 5),
+                                    (self.users[0], '2024-10-14', 2), (self.users[0], '2024-11-01', 10),
+                                    (self.users[1], '2024-10-08', 4)]:
+            run = Run.objects.create(athlete=user, comment='Test Run', status=Run.Status.IN_PROGRESS,
+                                     distance=distance, speed=distance, run_time_seconds=600)
+            Run.objects.filter(id=run.id).update(created_at=f'{day}T08:00:00Z')
+            run.refresh_from_db()
+            # Finished the way the runs API or the admin would
+            run.status = Run.Status.FINISHED
+            run.save()
+
+    def rollups(self, **params):
+        response = self.client.get(reverse('run-rollups'), data=params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(str(row['period_start']), row['runs_count'], row['distance']) for row in response.data]
+
+    def test_athlete_and_coach_rollups(self):
+        athlete = self.users[0].id
+        self.assertEqual(self.rollups(granularity='week', athlete=athlete),
+                         [('2024-10-07', 2, 8), ('2024-10-14', 1, 2), ('2024-10-28', 1, 10)])
+        self.assertEqual(self.rollups(granularity='month', athlete=athlete),
+                         [('2024-10-01', 3, 10), ('2024-11-01', 1, 10)])
+        self.assertEqual(self.rollups(granularity='day', athlete=athlete, **{'from': '2024-10-08', 'to': '2024-10-31'}),
+                         [('2024-10-09', 1, 5), ('2024-10-14', 1, 2)])
+        self.assertEqual(self.rollups(granularity='week', coach=self.coach.id, to='2024-10-13'),
+                         [('2024-10-07', 3, 12)])
+
+        response = self.client.get(reverse('run-rollups'), data={'granularity': 'week', 'coach': self.coach.id})
+        self.assertEqual(response.data[0]['avg_speed'], 4)
+        self.assertEqual(response.data[0]['run_time_seconds'], 1800)
+
+        for params in [{'granularity': 'year', 'athlete': athlete}, {'granularity': 'week'},
+                       {'granularity': 'week', 'athlete': athlete, 'from': 'yesterday'}]:
+            response = self.client.get(reverse('run-rollups'), data=params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rebuild_matches_incremental_rollups(self):
+        fields = ('athlete_id', 'granularity', 'period_start', 'runs_count', 'distance', 'run_time_seconds',
+                  'speed_sum', 'speed_count')
+        incremental = set(RunRollup.objects.values_list(*fields))
+        RunRollup.objects.update(runs_count=0)
+
+        out = StringIO()
+        call_command('rebuild_run_rollups', stdout=out)
+        self.assertIn(f'Rebuilt {len(incremental)} rollup rows', out.getvalue())
+        self.assertEqual(set(RunRollup.objects.values_list(*fields)), incremental)
+
+    def test_finishing_a_run_updates_rollups(self):
+        run = Run.objects.create(athlete=self.users[1], comment='Test Run', status=Run.Status.IN_PROGRESS)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('run-stop', args=[run.id]))
+        today = timezone.localdate(run.created_at)
+        self.assertEqual(RunRollup.objects.get(athlete=self.users[1], granularity='day', period_start=today).runs_count,
+                         1)
+
+    def test_runs_without_speed_are_not_averaged(self):
+        for speed in (4, None, 2):
+            run = Run.objects.create(athlete=self.users[1], comment='Test Run', status=Run.Status.IN_PROGRESS,
+                                     distance=1, speed=speed, run_time_seconds=600)
+            run.status = Run.Status.FINISHED
+            run.save()
+        rollup = RunRollup.objects.get(athlete=self.users[1], granularity='day',
+                                       period_start=timezone.localdate(run.created_at))
+        self.assertEqual((rollup.runs_count, rollup.speed_sum, rollup.speed_count), (3, 6, 2))
+
+
+class TestChallengeRules(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='testuser',
+            password='password123',
+            email='test@example.com',
+
+        )
+
+    def finished_run(self, distance, run_time_seconds):
+        return Run(athlete=self.user, status=Run.Status.FINISHED, distance=distance,
+                   run_time_seconds=run_time_seconds)
+
+    def test_rules(self):
+        stats = AthleteStats(athlete=self.user, runs_finished=10, total_distance=12)
+        awards = evaluate_challenges([ChallengeContext(self.user.id, stats, self.finished_run(2.1, 590))])
+        self.assertEqual({award.full_name for award in awards},
+                         {Challenge.NameChoices.RUN10, Challenge.NameChoices.RUN2KMIN10M})
+
+        stats = AthleteStats(athlete=self.user, runs_finished=3, total_distance=51)
+        awards = evaluate_challenges([ChallengeContext(self.user.id, stats, self.finished_run(2.1, 601))])
+        self.assertEqual([award.full_name for award in awards], [Challenge.NameChoices.RUN50KM])
+
+        self.assertEqual(set(self.user.challenges.values_list('full_name', flat=True)),
+                         {Challenge.NameChoices.RUN10, Challenge.NameChoices.RUN2KMIN10M,
+                          Challenge.NameChoices.RUN50KM})
+
+    def test_awards_are_idempotent_and_cost_one_query(self):
+        stats = AthleteStats(athlete=self.user, runs_finished=12, total_distance=60)
+        run = self.finished_run(2.5, 500)
+        extra_rule = MagicMock(return_value=False)
+        with patch.dict(CHALLENGE_RULES, {'extra': extra_rule}):
+            for _ in range(2):
+                with self.assertNumQueries(1):
+                    award_challenges(self.user.id, stats=stats, run=run)
+        self.assertEqual(extra_rule.call_count, 2)
+        self.assertEqual(self.user.challenges.count(), 3)
+
+        with self.assertNumQueries(0):
+            award_challenges(self.user.id, stats=AthleteStats(athlete=self.user), run=None)
+
+
+class TestRecomputeChallenges(APITestCase):
+    def setUp(self):
+        self.users = [get_user_model().objects.create_user(
+            username=f'testuser{i}',
+            password='password123',
+            email='test@example.com',
+
+        ) for i in range(5)]
+        for user, (runs, distance, run_time_seconds) in zip(self.users, [(10, 1, 900), (2, 30, 9000), (1, 2.5, 580),
+                                                                        (3, 1, 900), (0, 0, 0)]):
+            for _ in range(runs):
+                Run.objects.create(athlete=user, comment='Test Run', status=Run.Status.FINISHED,
+                                   distance=distance, run_time_seconds=run_time_seconds)
+        Run.objects.create(athlete=self.users[3], comment='Test Run', status=Run.Status.IN_PROGRESS,
+                           distance=50, run_time_seconds=60)
+        Challenge.objects.create(athlete=self.users[0], full_name=Challenge.NameChoices.RUN10)
+
+    def expected(self):
+        return {(self.users[0].id, Challenge.NameChoices.RUN10),
+                (self.users[1].id, Challenge.NameChoices.RUN50KM),
+                (self.users[2].id, Challenge.NameChoices.RUN2KMIN10M)}
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('recompute_challenges', '--dry-run', '--chunk-size', '2', stdout=out)
+        self.assertIn('2/5 athletes', out.getvalue())
+        self.assertIn('2 challenges would be awarded to 5 athletes', out.getvalue())
+        self.assertEqual(Challenge.objects.count(), 1)
+
+    def test_dry_run_with_workers(self):
+        # Dry run only: the forked workers write to their own copy of the in-memory test database
+        out = StringIO()
+        call_command('recompute_challenges', '--dry-run', '--workers', '2', '--chunk-size', '2', stdout=out)
+        self.assertEqual(out.getvalue().count('athletes,'), 3)
+        self.assertIn('5/5 athletes', out.getvalue())
+        self.assertIn('2 challenges would be awarded to 5 athletes', out.getvalue())
+        self.assertEqual(Challenge.objects.count(), 1)
+
+    def test_recompute(self):
+        with self.assertNumQueries(6):
+            self.assertEqual(recompute_challenges_for_athletes([user.id for user in self.users]), (5, 2))
+        self.assertEqual(set(Challenge.objects.values_list('athlete_id', 'full_name')), self.expected())
+
+        out = StringIO()
+        call_command('recompute_challenges', '--chunk-size', '3', stdout=out)
+        self.assertIn('0 challenges awarded to 5 athletes', out.getvalue())
+        self.assertEqual(Challenge.objects.count(), 3)
+
+
 class TestChallengeSummary(APITestCase):
     def setUp(self):
+        response_cache().clear()
+        reset_cache_counters()
         self.users = [get_user_model().objects.create_user(
             username=f'testuser{i}',
             first_name=f'Firstname-{i}',
@@ -720,6 +2001,113 @@ class TestChallengeSummary(APITestCase):
             response = self.client.get(reverse('challenges-summary'))
             self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_summary_is_grouped_counted_and_capped(self):
+        response = self.client.get(reverse('challenges-summary'), data={'size': 2})
+        self.assertEqual([(row['full_name'], row['count'], len(row['athletes'])) for row in response.data],
+                         [('run10', 1, 1), ('run50km', 2, 2), ('run2kmin10m', 4, 2)])
+        self.assertEqual(response.data[0]['name_to_display'], Challenge.NameChoices.RUN10.label)
+        self.assertEqual(response.data[1]['athletes'][0], {'id': self.users[0].id, 'username': 'testuser0',
+                                                           'full_name': 'Firstname-0 Lastname-0'})
+        self.assertIsNone(response.data[1]['next'])
+
+        athletes = [athlete['id'] for athlete in response.data[2]['athletes']]
+        with self.assertNumQueries(1):
+            page = self.client.get(response.data[2]['next'])
+        self.assertIsNone(page.data['next'])
+        athletes += [athlete['id'] for athlete in page.data['results']]
+        self.assertEqual(athletes, [user.id for user in self.users[:4]])
+
+    def test_cached_summary_costs_one_query_on_the_database_cache(self):
+        responses = {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'test_response_cache'}
+        with override_settings(CACHES={**settings.CACHES, 'responses': responses}):
+            call_command('createcachetable', 'test_response_cache')
+            self.client.get(reverse('challenges-summary'))
+            with self.assertNumQueries(1):
+                self.client.get(reverse('challenges-summary'))
+        self.assertEqual(cache_counters('challenge_summary'), {'hits': 1, 'stale': 0, 'misses': 1})
+
+    def test_summary_cache_ignores_unrelated_parameters(self):
+        response = self.client.get(reverse('challenges-summary'), data={'size': 2, 'x': 1})
+        with self.assertNumQueries(0):
+            other = self.client.get(reverse('challenges-summary'), data={'x': 2, 'size': 2})
+        self.assertEqual(other.data, response.data)
+        self.assertNotIn('x=', response.data[2]['next'])
+        self.assertEqual(cache_counters('challenge_summary'), {'hits': 1, 'stale': 0, 'misses': 1})
+
+    def test_challenge_page_validation(self):
+        response = self.client.get(reverse('challenges-summary'), data={'challenge': 'run100'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('challenges-summary'), data={'challenge': 'run10', 'cursor': '!'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(RESPONSE_CACHE={'test': {'ttl': 10, 'stale_ttl': 20}}, RESPONSE_CACHE_REFRESH_IN_BACKGROUND=False)
+class TestResponseCache(SimpleTestCase):
+    def setUp(self):
+        response_cache().clear()
+        reset_cache_counters()
+        self.compute = MagicMock(side_effect=[1, 2, 3])
+
+    def make_stale(self, key):
+        value, _ = response_cache().get(f'response_cache:test:{key}')
+        response_cache().set(f'response_cache:test:{key}', (value, time.time() - 1), timeout=20)
+
+    def test_fresh_stale_and_expired_entries(self):
+        self.assertEqual(cached('test', 'key', self.compute), 1)
+        self.assertEqual(cached('test', 'key', self.compute), 1)
+        self.assertEqual(self.compute.call_count, 1)
+
+        # Stale: the old value is served and refreshed once
+        self.make_stale('key')
+        self.assertEqual(cached('test', 'key', self.compute), 1)
+        self.assertEqual(cached('test', 'key', self.compute), 2)
+        self.assertEqual(self.compute.call_count, 2)
+        self.assertEqual(cache_counters('test'), {'hits': 2, 'stale': 1, 'misses': 1})
+
+        response_cache().delete('response_cache:test:key')
+        self.assertEqual(cached('test', 'key', self.compute), 3)
+        self.assertEqual(cache_counters('test')['misses'], 2)
+
+    def test_concurrent_misses_compute_once(self):
+        started = threading.Event()
+
+        def slow_compute():
+            started.set()
+            time.sleep(0.2)
+            return 'value'
+
+        compute = MagicMock(side_effect=slow_compute)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cached('test', 'slow', compute)))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(compute.call_count, 1)
+
+    def test_stale_entry_refreshed_in_background(self):
+        refreshed = threading.Event()
+
+        def compute():
+            refreshed.set()
+            return 'new'
+
+        cached('test', 'background', lambda: 'old')
+        self.make_stale('background')
+        with override_settings(RESPONSE_CACHE_REFRESH_IN_BACKGROUND=True):
+            self.assertEqual(cached('test', 'background', compute), 'old')
+        self.assertTrue(refreshed.wait(5))
+        for _ in range(50):
+            if response_cache().get('response_cache:test:background')[0] == 'new':
+                break
+            time.sleep(0.01)
+        self.assertEqual(response_cache().get('response_cache:test:background')[0], 'new')
+
 
 class TestCoachSubscription(APITestCase):
     def setUp(self):
@@ -955,10 +2343,30 @@ class TestCoachRating(APITestCase):
         with self.assertNumQueries(1):
             self.client.get(reverse('users-list'))
 
+    def test_coach_rating_stored_on_stats(self):
+        self.client.post(reverse('rate-coach', args=[self.coach_user.id]),
+                         data={'athlete': self.athlete_user1.id, 'rating': 4})
+        self.client.post(reverse('rate-coach', args=[self.coach_user.id]),
+                         data={'athlete': self.athlete_user2.id, 'rating': 1})
+        stats = AthleteStats.objects.get(athlete=self.coach_user)
+        self.assertEqual((stats.rating_sum, stats.rating_count), (5, 2))
+        self.assertEqual(stats.rating, 2.5)
+
+        Subscribe.objects.get(subscriber=self.athlete_user2).delete()
+        stats.refresh_from_db()
+        self.assertEqual((stats.rating_sum, stats.rating_count), (4, 1))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('users-list'), {'type': 'coach'})
+        self.assertEqual(response.data[0]['rating'], 4)
+        self.assertNotIn('app_run_subscribe', queries.captured_queries[0]['sql'])
+
 
 class TestAnalyticsForCoach(APITestCase):
 
     def setUp(self):
+        response_cache().clear()
+        reset_cache_counters()
         self.athlete_user1 = get_user_model().objects.create_user(
             username='testuser',
             password='password123',
@@ -1072,9 +2480,36 @@ class TestAnalyticsForCoach(APITestCase):
         self.assertEqual(response.data.get('speed_avg_user'), self.athlete_user2.id)
         self.assertEqual(response.data.get('speed_avg_value'), 3.5)
 
-        with self.assertNumQueries(4):
+        # Served from the cache, only the coach is looked up
+        with self.assertNumQueries(1):
             self.client.get(reverse('analytics-for-coach', args=[self.coach_user.id]))
 
+    def test_analytics_for_coach_without_runs(self):
+        response = self.client.get(reverse('analytics-for-coach', args=[self.coach_user_no_run.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, dict.fromkeys(['longest_run_user', 'longest_run_value', 'total_run_user',
+                                                       'total_run_value', 'speed_avg_user', 'speed_avg_value']))
+
+    def test_analytics_for_coaches(self):
+        coach_ids = [self.coach_user_2.id, self.coach_user.id, self.coach_user_no_run.id]
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('analytics-for-coaches'),
+                                       data={'coach_ids': ','.join(map(str, coach_ids))})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['coach_id'] for row in response.data], coach_ids)
+        self.assertEqual(response.data[0]['longest_run_value'], 50)
+        self.assertEqual(response.data[1]['total_run_user'], self.athlete_user2.id)
+        self.assertEqual(response.data[1]['speed_avg_value'], 3.5)
+        self.assertIsNone(response.data[2]['total_run_user'])
+
+        response = self.client.get(reverse('analytics-for-coaches'),
+                                   data={'coach_ids': f'{self.coach_user.id},{self.athlete_user1.id}'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['coach_ids'], [self.athlete_user1.id])
+
+        response = self.client.get(reverse('analytics-for-coaches'), data={'coach_ids': 'one,two'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_analytics_for_coachendpoint_coach_2(self):
         response = self.client.get(reverse('analytics-for-coach', args=[self.coach_user_2.id]))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
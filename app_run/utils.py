@@ -1,54 +1,661 @@
+import csv
+import json
+import threading
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models.aggregates import Sum, Min, Max
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q, F, Window, DateField
+from django.db.models.aggregates import Sum, Min, Max, Count
+from django.db.models.functions import Coalesce, FirstValue, NullIf, RowNumber, Trunc
+from django.utils import timezone
 from geopy.distance import geodesic
 
-from .models import Challenge, Run, Positions, CollectibleItem
+from .archive import pack_track, unpack_track
+from .challenges import ChallengeContext, award_challenges, earned_challenges
+from .leaderboards import update_leaderboards
+from .geo import segment_lengths, track_length, distances_from, bounding_box, GridIndex, encode_polyline, \
+    encode_deltas, polyline_length, simplify_track
+from .models import Challenge, Run, Positions, CollectibleItem, RunArchive, AthleteStats, Subscribe, RunRollup, \
+    RUN_TOTALS_FIELDS
 
+COLLECT_ITEM_RADIUS_METERS = 100
 
-def award_challenge_if_completed_run_10(athlete_id):
-    user = get_user_model().objects.get(id=athlete_id)
+# Lives in the shared CACHES backend (see settings) so saves in one process reach all the others
+COLLECTIBLE_ITEMS_VERSION_KEY = 'collectible_items_version'
+_collectible_items_index = None
+_collectible_items_index_version = None
+_collectible_items_index_lock = threading.Lock()
 
-    if user.runs.filter(status=Run.Status.FINISHED).count() == 10:
-        return Challenge.objects.create(athlete_id=athlete_id, full_name=Challenge.NameChoices.RUN10)
-    return None
 
+def record_finished_run(run):
+    """Add a newly finished run to its athlete's stats; call inside the transaction finishing the run."""
+    stats, _ = AthleteStats.objects.select_for_update().get_or_create(athlete_id=run.athlete_id)
+    stats.runs_finished += 1
+    stats.total_distance += run.distance or 0
+    stats.longest_distance = max(stats.longest_distance, run.distance or 0)
+    stats.total_run_time_seconds += run.run_time_seconds or 0
+    if run.speed is not None:
+        stats.speed_sum += run.speed
+        stats.speed_count += 1
+    stats.save()
+    update_leaderboards([stats])
+    return stats
+
+
+def record_collected_items(user, items):
+    if not items:
+        return
+    stats, _ = AthleteStats.objects.select_for_update().get_or_create(athlete_id=user.id)
+    stats.items_count += len(items)
+    stats.items_value += sum(item.value for item in items)
+    stats.save(update_fields=['items_count', 'items_value'])
+    update_leaderboards([stats])
+
+
+def refresh_coach_rating(coach_id):
+    """Store the sum and count of a coach's ratings on their stats row, serialized by the row lock."""
+    with transaction.atomic():
+        stats = AthleteStats.objects.select_for_update().filter(athlete_id=coach_id).first()
+        ratings = Subscribe.objects.filter(subscribed_to_id=coach_id, rating__isnull=False).aggregate(
+            rating_sum=Coalesce(Sum('rating'), 0), rating_count=Count('id'))
+        if stats is None:
+            if not ratings['rating_count']:
+                return None
+            stats, _ = AthleteStats.objects.select_for_update().get_or_create(athlete_id=coach_id)
+        stats.rating_sum = ratings['rating_sum']
+        stats.rating_count = ratings['rating_count']
+        stats.save(update_fields=['rating_sum', 'rating_count'])
+    return stats
 
-def award_challenge_if_completed_run_50km(athlete_id):
-    user = get_user_model().objects.get(id=athlete_id)
-    if (not user.challenges.filter(full_name=Challenge.NameChoices.RUN50KM).exists() and
-            user.runs.aggregate(Sum('distance'))['distance__sum'] >= 50):
-        return Challenge.objects.create(athlete_id=athlete_id, full_name=Challenge.NameChoices.RUN50KM)
-    return None
 
+def period_start(day, granularity):
+    if granularity == RunRollup.Granularity.WEEK:
+        return day - timedelta(days=day.weekday())
+    if granularity == RunRollup.Granularity.MONTH:
+        return day.replace(day=1)
+    return day
 
-def calculate_and_save_run_distance(run_id):
-    positions = Positions.objects.filter(run_id=run_id).order_by('id').values_list('latitude', 'longitude')
 
-    total_distance = sum(
-        geodesic(positions[i], positions[i + 1]).kilometers
-        for i in range(len(positions) - 1)
+def record_run_rollups(run):
+    """Add a newly finished run to its athlete's day, week and month rollups."""
+    day = timezone.localdate(run.created_at)
+    periods = [(granularity, period_start(day, granularity)) for granularity in RunRollup.Granularity.values]
+    RunRollup.objects.bulk_create([RunRollup(athlete_id=run.athlete_id, granularity=granularity, period_start=start)
+                                   for granularity, start in periods], ignore_conflicts=True)
+    q = Q()
+    for granularity, start in periods:
+        q |= Q(granularity=granularity, period_start=start)
+    RunRollup.objects.filter(q, athlete_id=run.athlete_id).update(
+        runs_count=F('runs_count') + 1,
+        distance=F('distance') + (run.distance or 0),
+        run_time_seconds=F('run_time_seconds') + (run.run_time_seconds or 0),
+        speed_sum=F('speed_sum') + (run.speed or 0),
+        # An int, not a bool: PostgreSQL has no integer + boolean
+        speed_count=F('speed_count') + int(run.speed is not None),
     )
+
+
+def rebuild_run_rollups(athlete_ids=None, batch_size=1000):
+    """Recompute the rollups of the given athletes, or everyone, from their finished runs."""
+    rebuilt = 0
+    for chunk in iter_athlete_id_chunks(athlete_ids, chunk_size=batch_size):
+        runs = Run.objects.filter(status=Run.Status.FINISHED, athlete_id__in=chunk)
+        rollups = []
+        for granularity in RunRollup.Granularity.values:
+            rows = (runs
+                    .annotate(period=Trunc('created_at', granularity, output_field=DateField()))
+                    .values('athlete_id', 'period')
+                    .annotate(runs_count=Count('id'),
+                              distance_sum=Coalesce(Sum('distance'), 0.0),
+                              run_time_seconds_sum=Coalesce(Sum('run_time_seconds'), 0),
+                              run_speed_sum=Coalesce(Sum('speed'), 0.0),
+                              run_speed_count=Count('speed'))
+                    .order_by())
+            rollups.extend(RunRollup(athlete_id=row['athlete_id'], granularity=granularity,
+                                     period_start=row['period'], runs_count=row['runs_count'],
+                                     distance=row['distance_sum'], run_time_seconds=row['run_time_seconds_sum'],
+                                     speed_sum=row['run_speed_sum'], speed_count=row['run_speed_count'])
+                           for row in rows)
+        with transaction.atomic():
+            RunRollup.objects.filter(athlete_id__in=chunk).delete()
+            RunRollup.objects.bulk_create(rollups, batch_size=batch_size)
+        rebuilt += len(rollups)
+    return rebuilt
+
+
+def iter_athlete_id_chunks(athlete_ids=None, chunk_size=1000):
+    users = get_user_model().objects.order_by('id')
+    if athlete_ids is not None:
+        users = users.filter(id__in=athlete_ids)
+
+    chunk = []
+    for user_id in users.values_list('id', flat=True).iterator(chunk_size=chunk_size):
+        chunk.append(user_id)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def compute_athlete_stats(athlete_ids):
+    """Unsaved AthleteStats of the given athletes, computed from runs and collected items."""
+    run_totals = {row.pop('athlete_id'): row for row in (
+        Run.objects.filter(status=Run.Status.FINISHED, athlete_id__in=athlete_ids).values('athlete_id').annotate(
+            runs_finished=Count('id'),
+            total_distance=Coalesce(Sum('distance'), 0.0),
+            longest_distance=Coalesce(Max('distance'), 0.0),
+            total_run_time_seconds=Coalesce(Sum('run_time_seconds'), 0),
+            speed_sum=Coalesce(Sum('speed'), 0.0),
+            speed_count=Count('speed'),
+        ).order_by())}
+    item_totals = {row.pop('user_id'): row for row in (
+        CollectibleItem.user.through.objects.filter(user_id__in=athlete_ids).values('user_id').annotate(
+            items_count=Count('id'),
+            items_value=Coalesce(Sum('collectibleitem__value'), 0),
+        ).order_by())}
+    rating_totals = {row.pop('subscribed_to_id'): row for row in (
+        Subscribe.objects.filter(subscribed_to_id__in=athlete_ids, rating__isnull=False)
+        .values('subscribed_to_id').annotate(
+            rating_sum=Sum('rating'),
+            rating_count=Count('id'),
+        ).order_by())}
+    return {athlete_id: AthleteStats(athlete_id=athlete_id, **run_totals.get(athlete_id, {}),
+                                     **item_totals.get(athlete_id, {}), **rating_totals.get(athlete_id, {}))
+            for athlete_id in athlete_ids}
+
+
+def rebuild_athlete_stats(athlete_ids=None, batch_size=1000):
+    """Recompute stats from runs and collected items, for the given athletes or everyone."""
+    fields = [field.name for field in AthleteStats._meta.concrete_fields if field.name not in ('id', 'athlete')]
+    rebuilt = 0
+    for chunk in iter_athlete_id_chunks(athlete_ids, chunk_size=batch_size):
+        stats = compute_athlete_stats(chunk).values()
+        AthleteStats.objects.bulk_create(stats, update_conflicts=True, unique_fields=['athlete'],
+                                         update_fields=fields)
+        update_leaderboards(stats)
+        rebuilt += len(chunk)
+    return rebuilt
+
+
+def recompute_challenges_for_athletes(athlete_ids, dry_run=False):
+    """Award every challenge the athletes' history earns them; returns (athletes, new awards)."""
+    stats = compute_athlete_stats(athlete_ids)
+    contexts = [ChallengeContext(athlete_id, athlete_stats) for athlete_id, athlete_stats in stats.items()]
+    runs = (Run.objects.filter(status=Run.Status.FINISHED, athlete_id__in=athlete_ids)
+            .defer('simplified_track').iterator(chunk_size=2000))
+    contexts.extend(ChallengeContext(run.athlete_id, stats[run.athlete_id], run) for run in runs)
+
+    existing = set(Challenge.objects.filter(athlete_id__in=athlete_ids).values_list('athlete_id', 'full_name'))
+    new_awards = earned_challenges(contexts) - existing
+    if new_awards and not dry_run:
+        Challenge.objects.bulk_create([Challenge(athlete_id=athlete_id, full_name=name)
+                                       for athlete_id, name in new_awards], ignore_conflicts=True)
+    return len(athlete_ids), len(new_awards)
+
+
+def _coach_analytics_metrics():
+    return {
+        'longest_run': F('subscriber__stats__longest_distance'),
+        'total_run': F('subscriber__stats__total_distance'),
+        'speed_avg': F('subscriber__stats__speed_sum') / NullIf('subscriber__stats__speed_count', 0),
+    }
+
+
+def coach_analytics(coach_ids):
+    """Best athlete of each coach by longest run, total distance and average speed, in one query."""
+    annotations = {'row_number': Window(RowNumber(), partition_by=F('subscribed_to_id'), order_by=F('id').asc())}
+    for name, value in _coach_analytics_metrics().items():
+        order_by = [value.desc(nulls_last=True), F('subscriber_id').asc()]
+        annotations[f'{name}_user'] = Window(FirstValue('subscriber_id'), partition_by=F('subscribed_to_id'),
+                                             order_by=order_by)
+        annotations[f'{name}_value'] = Window(FirstValue(value), partition_by=F('subscribed_to_id'),
+                                              order_by=order_by)
+    fields = [field for field in annotations if field != 'row_number']
+
+    analytics = {coach_id: dict.fromkeys(fields) for coach_id in coach_ids}
+    rows = (Subscribe.objects
+            .filter(subscribed_to_id__in=coach_ids, subscriber__stats__runs_finished__gt=0)
+            .annotate(**annotations)
+            .filter(row_number=1)
+            .values('subscribed_to_id', *fields))
+    for row in rows:
+        analytics[row.pop('subscribed_to_id')] = row
+    return analytics
+
+
+def calculate_and_save_run_distance(run_id, engine=None):
+    positions = [(latitude, longitude) for _, latitude, longitude, _, _, _ in iter_run_track(run_id)]
+
+    total_distance = track_length(positions, engine=engine)
     Run.objects.filter(id=run_id).update(distance=total_distance)
     return total_distance
 
 
 def collect_item_if_nearby(latitude, longitude, user):
-    collected_items = []
-    for item in CollectibleItem.objects.exclude(user=user):
-        try:
-            distance = geodesic((latitude, longitude), (item.latitude, item.longitude)).meters
-        except ValueError:
-            continue
-        if distance <= 100:
-            collected_items.append(item)
-    user.collectible_items.add(*collected_items)
+    return collect_items_near_points([(latitude, longitude)], user)
+
+
+def bounding_box_q(points, radius_m):
+    min_latitude, max_latitude, longitude_ranges = bounding_box(points, radius_m)
+    longitude_q = Q()
+    for min_longitude, max_longitude in longitude_ranges:
+        longitude_q |= Q(longitude__range=(min_longitude, max_longitude))
+    return Q(latitude__range=(min_latitude, max_latitude)) & longitude_q
+
+
+def _sorted_by_distance(items, latitude, longitude):
+    # All at once with RUN_DISTANCE_ENGINE, the same engine as run distances
+    distances = distances_from((latitude, longitude), [(item.latitude, item.longitude) for item in items])
+    for item, distance in zip(items, distances):
+        item.distance = float(distance) * 1000
+    return sorted(items, key=lambda item: (item.distance, item.id))
+
+
+def collectible_items_near(latitude, longitude, radius_m):
+    """Items within ``radius_m`` metres of the point, nearest first, each with its ``distance`` in metres."""
+    # The (latitude, longitude) index narrows the table to the box around the circle, distances do the rest
+    candidates = CollectibleItem.objects.filter(bounding_box_q([(latitude, longitude)], radius_m))
+    return [item for item in _sorted_by_distance(list(candidates), latitude, longitude) if item.distance <= radius_m]
+
+
+def collectible_items_in_box(min_latitude, min_longitude, max_latitude, max_longitude):
+    """
+    Items inside the box, nearest to its centre first, each with its ``distance`` in metres.
+
+    A box with min_longitude greater than max_longitude crosses the antimeridian.
+    """
+    if min_longitude <= max_longitude:
+        longitude_q = Q(longitude__range=(min_longitude, max_longitude))
+        center_longitude = (min_longitude + max_longitude) / 2
+    else:
+        longitude_q = Q(longitude__gte=min_longitude) | Q(longitude__lte=max_longitude)
+        center_longitude = (min_longitude + max_longitude + 360) / 2
+        center_longitude = center_longitude - 360 if center_longitude > 180 else center_longitude
+    candidates = CollectibleItem.objects.filter(Q(latitude__range=(min_latitude, max_latitude)) & longitude_q)
+    return _sorted_by_distance(list(candidates), (min_latitude + max_latitude) / 2, center_longitude)
+
+
+def bump_collectible_items_version():
+    # Only once the change is committed: a worker rebuilding its index before that would read the old rows
+    # and keep them under the new version
+    transaction.on_commit(lambda: cache.set(COLLECTIBLE_ITEMS_VERSION_KEY, uuid.uuid4().hex, timeout=None))
+
+
+def get_collectible_items_index():
+    """Per-process grid index over the item catalog, rebuilt when the shared catalog version changes."""
+    global _collectible_items_index, _collectible_items_index_version
+
+    version = cache.get(COLLECTIBLE_ITEMS_VERSION_KEY)
+    if version is None:
+        cache.add(COLLECTIBLE_ITEMS_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(COLLECTIBLE_ITEMS_VERSION_KEY)
+
+    with _collectible_items_index_lock:
+        if _collectible_items_index is None or _collectible_items_index_version != version:
+            _collectible_items_index = GridIndex(
+                CollectibleItem.objects.values_list('id', 'latitude', 'longitude').iterator(chunk_size=10000))
+            _collectible_items_index_version = version
+        return _collectible_items_index
+
+
+def collect_items_near_points(points, user):
+    nearby_item_ids = []
+    for item_id, item_latitude, item_longitude in get_collectible_items_index().candidates(
+            points, COLLECT_ITEM_RADIUS_METERS):
+        for latitude, longitude in points:
+            try:
+                distance = geodesic((latitude, longitude), (item_latitude, item_longitude)).meters
+            except ValueError:
+                break
+            if distance <= COLLECT_ITEM_RADIUS_METERS:
+                nearby_item_ids.append(item_id)
+                break
+    if not nearby_item_ids:
+        return []
+
+    collected_items = list(CollectibleItem.objects.filter(id__in=nearby_item_ids).exclude(user=user))
+    if collected_items:
+        with transaction.atomic():
+            user.collectible_items.add(*collected_items)
+            record_collected_items(user, collected_items)
     return collected_items
 
 
+def calculate_position_distance_and_speed(previous_position, latitude, longitude, date_time,
+                                          distance_to_previous=None):
+    if not previous_position:
+        return 0, 0
+
+    if distance_to_previous is None:
+        distance_to_previous = geodesic((latitude, longitude),
+                                        (previous_position.latitude, previous_position.longitude)).kilometers
+    distance_to_previous = round(distance_to_previous, 2)
+    if previous_position.distance:
+        position_distance = previous_position.distance + distance_to_previous
+    else:
+        position_distance = distance_to_previous
+
+    speed = 0
+    if date_time and previous_position.date_time:
+        time_from_previous = (date_time - previous_position.date_time).total_seconds()
+        if time_from_previous:
+            speed = round(distance_to_previous * 1000 / time_from_previous, 2)
+    return position_distance, speed
+
+
+def create_positions_batch(run, fixes):
+    previous_position = Positions.objects.filter(run=run).order_by('-id').first()
+
+    points = [(fix['latitude'], fix['longitude']) for fix in fixes]
+    if previous_position:
+        segments = segment_lengths([(previous_position.latitude, previous_position.longitude)] + points)
+    else:
+        segments = [None] + list(segment_lengths(points))
+
+    positions = []
+    for fix, distance_to_previous in zip(fixes, segments):
+        position_distance, speed = calculate_position_distance_and_speed(previous_position,
+                                                                         fix['latitude'],
+                                                                         fix['longitude'],
+                                                                         fix.get('date_time'),
+                                                                         distance_to_previous)
+        previous_position = Positions(run=run,
+                                      latitude=fix['latitude'],
+                                      longitude=fix['longitude'],
+                                      date_time=fix.get('date_time'),
+                                      distance=position_distance,
+                                      speed=speed)
+        positions.append(previous_position)
+
+    with transaction.atomic():
+        Positions.objects.bulk_create(positions)
+        update_run_totals(run.id, positions, segments=[segment or 0 for segment in segments])
+    collect_items_near_points(points, user=run.athlete)
+    return positions
+
+
+def _position_date_time(position):
+    # Positions created through the ORM may still hold the raw value they were given
+    date_time = Positions._meta.get_field('date_time').to_python(position.date_time)
+    if date_time and timezone.is_naive(date_time):
+        date_time = timezone.make_aware(date_time)
+    return date_time
+
+
+def update_run_totals(run_id, positions, segments=None):
+    """Fold newly saved positions into the run's running totals.
+
+    ``segments`` are the distances in km from each position to the one before it;
+    they are computed from the run's last known point when not given.
+    """
+    with transaction.atomic():
+        run = Run.objects.select_for_update().get(id=run_id)
+
+        if segments is None:
+            points = [(position.latitude, position.longitude) for position in positions]
+            if run.last_latitude is None:
+                segments = segment_lengths(points)
+            else:
+                segments = segment_lengths([(run.last_latitude, run.last_longitude)] + points)
+
+        run.positions_count += len(positions)
+        run.track_distance += float(sum(segments))
+        for position in positions:
+            if position.speed is not None:
+                run.speed_sum += position.speed
+                run.speed_count += 1
+            date_time = _position_date_time(position)
+            if date_time:
+                if not run.first_position_at or date_time < run.first_position_at:
+                    run.first_position_at = date_time
+                if not run.last_position_at or date_time > run.last_position_at:
+                    run.last_position_at = date_time
+        run.last_latitude = positions[-1].latitude
+        run.last_longitude = positions[-1].longitude
+
+        run.save(update_fields=RUN_TOTALS_FIELDS)
+    return run
+
+
+def recompute_run_totals(run_id):
+    """Rebuild a run's running totals from all of its positions, after one of them was changed or deleted."""
+    with transaction.atomic():
+        run = Run.objects.select_for_update().get(id=run_id)
+        positions = Positions.objects.filter(run_id=run_id)
+        totals = positions.aggregate(positions_count=Count('id'),
+                                     speed_sum=Coalesce(Sum('speed'), 0.0),
+                                     speed_count=Count('speed'),
+                                     first_position_at=Min('date_time'),
+                                     last_position_at=Max('date_time'))
+        points = list(positions.order_by('id').values_list('latitude', 'longitude'))
+        for field, value in totals.items():
+            setattr(run, field, value)
+        run.track_distance = track_length(points) if len(points) > 1 else 0.0
+        run.last_latitude, run.last_longitude = points[-1] if points else (None, None)
+        run.save(update_fields=RUN_TOTALS_FIELDS)
+    return run
+
+
+def apply_run_totals(run):
+    run.distance = run.track_distance
+    run.speed = round(run.speed_sum / run.speed_count, 2) if run.speed_count else None
+    if run.first_position_at and run.last_position_at:
+        run.run_time_seconds = int((run.last_position_at - run.first_position_at).total_seconds())
+    else:
+        run.run_time_seconds = None
+    return run
+
+
+def finalize_run(run_id):
+    """Derived stats and challenges of a stopped run; safe to call again for the same run."""
+    with transaction.atomic():
+        run = Run.objects.select_for_update().get(id=run_id)
+        # Counted already, or put back in progress before the task ran
+        if run.stats_status == Run.StatsStatus.READY or run.status != Run.Status.FINISHED:
+            return run
+
+        apply_run_totals(run)
+        run.simplified_track = build_simplified_track(run.id)
+        run.stats_status = Run.StatsStatus.READY
+        run.save()
+        stats = record_finished_run(run)
+        record_run_rollups(run)
+        award_challenges(run.athlete_id, stats=stats, run=run)
+    return run
+
+
+def record_run_finished_elsewhere(run_id):
+    """
+    Count a run finished without RunStopView (runs API, admin, ORM) in the athlete's stats and rollups.
+
+    Such runs carry their distance, speed and time as saved, so none of finalize_run's derived values
+    are recomputed, and challenges are left to the usual award paths.
+    """
+    with transaction.atomic():
+        run = Run.objects.select_for_update().get(id=run_id)
+        if run.status != Run.Status.FINISHED or run.stats_status is not None:
+            return run
+        # update() rather than save() so the Run post_save signal doesn't come back here
+        Run.objects.filter(id=run_id).update(stats_status=Run.StatsStatus.READY)
+        run.stats_status = Run.StatsStatus.READY
+        record_finished_run(run)
+        record_run_rollups(run)
+    return run
+
+
+def refresh_athlete_run_stats(athlete_id):
+    """Recompute one athlete's stats, leaderboard entries and rollups; a no-op once the athlete is deleted."""
+    rebuild_athlete_stats(athlete_ids=[athlete_id])
+    rebuild_run_rollups(athlete_ids=[athlete_id])
+
+
+def record_run_unfinished(run_id):
+    """
+    Take a run that is no longer finished out of its athlete's stats, leaderboards and rollups.
+
+    A run finalize_run hasn't counted yet is only unmarked. A counted one can't be subtracted back (the
+    longest distance would be lost), so the athlete's rows are recomputed from their remaining runs.
+    """
+    with transaction.atomic():
+        run = Run.objects.select_for_update().get(id=run_id)
+        if run.status == Run.Status.FINISHED or run.stats_status is None:
+            return run
+        counted = run.stats_status == Run.StatsStatus.READY
+        # update() rather than save() so the Run post_save signal doesn't come back here
+        Run.objects.filter(id=run_id).update(stats_status=None)
+        run.stats_status = None
+        if counted:
+            refresh_athlete_run_stats(run.athlete_id)
+    return run
+
+
 def calculate_run_time_in_seconds(run):
-    result = run.positions.aggregate(min_date=Min("date_time"),
-                                     max_date=Max("date_time"),
-                                     )
+    rows = archived_track(run.id)
+    if rows is not None:
+        date_times = [date_time for _, _, _, date_time, _, _ in rows if date_time]
+        result = {'min_date': min(date_times, default=None), 'max_date': max(date_times, default=None)}
+    else:
+        result = run.positions.aggregate(min_date=Min("date_time"),
+                                         max_date=Max("date_time"),
+                                         )
     if result['min_date'] and result['max_date']:
         return int((result['max_date'] - result['min_date']).total_seconds())
     return None
+
+
+TRACK_EXPORT_FIELDS = ('id', 'latitude', 'longitude', 'date_time', 'speed', 'distance')
+TRACK_DATE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def _export_row(row):
+    row = dict(zip(TRACK_EXPORT_FIELDS, row))
+    if row['date_time']:
+        row['date_time'] = row['date_time'].strftime(TRACK_DATE_TIME_FORMAT)
+    return row
+
+
+def iter_track_ndjson(rows):
+    for row in rows:
+        yield json.dumps(_export_row(row)) + '\n'
+
+
+def iter_track_csv(rows):
+    writer = csv.DictWriter(_Echo(), fieldnames=TRACK_EXPORT_FIELDS)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(_export_row(row))
+
+
+TRACK_EXPORT_TYPES = {
+    'ndjson': ('application/x-ndjson', iter_track_ndjson),
+    'csv': ('text/csv', iter_track_csv),
+}
+
+
+def archived_track(run_id):
+    """Rows of an archived run in TRACK_EXPORT_FIELDS order, or None when its positions are still in the table."""
+    blob = RunArchive.objects.filter(run_id=run_id).values_list('data', flat=True).first()
+    if blob is None:
+        return None
+    return unpack_track(blob)
+
+
+def archived_positions(run_id):
+    rows = archived_track(run_id)
+    if rows is None:
+        return None
+    return [Positions(run_id=run_id, **dict(zip(TRACK_EXPORT_FIELDS, row))) for row in rows]
+
+
+def archived_position(position_id):
+    """A position of an archived run by its id, or None when no archive holds it."""
+    # Runs recorded at the same time interleave their ids, so a few archives may span the id
+    archives = (RunArchive.objects.filter(first_position_id__lte=position_id, last_position_id__gte=position_id)
+                .values_list('run_id', 'data'))
+    for run_id, blob in archives.iterator(chunk_size=10):
+        for row in unpack_track(blob):
+            if row[0] == position_id:
+                return Positions(run_id=run_id, **dict(zip(TRACK_EXPORT_FIELDS, row)))
+    return None
+
+
+def iter_run_track(run_id, chunk_size=2000):
+    rows = archived_track(run_id)
+    if rows is not None:
+        return iter(rows)
+    return (Positions.objects.filter(run_id=run_id)
+            .order_by('id')
+            .values_list(*TRACK_EXPORT_FIELDS)
+            .iterator(chunk_size=chunk_size))
+
+
+def archive_run(run):
+    """Pack a finished run's positions into its RunArchive and delete the rows."""
+    if run.status != Run.Status.FINISHED:
+        raise ValueError(f'Only finished runs can be archived; current status:{run.status}')
+    with transaction.atomic():
+        rows = list(Positions.objects.filter(run_id=run.id).order_by('id').values_list(*TRACK_EXPORT_FIELDS))
+        if not rows and RunArchive.objects.filter(run_id=run.id).exists():
+            return None
+        archive, _ = RunArchive.objects.update_or_create(run_id=run.id,
+                                                         defaults={'positions_count': len(rows),
+                                                                   'data': pack_track(rows),
+                                                                   'first_position_id': rows[0][0] if rows else None,
+                                                                   'last_position_id': rows[-1][0] if rows else None})
+        Positions.objects.filter(run_id=run.id).delete()
+    return archive
+
+
+def encoded_track(run, timestamps=False, simplify=False, tolerance_m=None, max_points=None):
+    """Run track as a Google encoded polyline.
+
+    With ``timestamps`` the fix times are added as milliseconds since ``started_at``,
+    delta-encoded with the same scheme; they are left out when some fix has no time.
+    ``simplify`` returns the Douglas-Peucker simplified track, the one stored when the
+    run finished unless a tolerance, a point budget or timestamps are asked for.
+    """
+    stored = run.simplified_track
+    if simplify and tolerance_m is None and max_points is None and not timestamps and stored is not None:
+        return {'run': run.id, 'points': polyline_length(stored), 'polyline': stored, 'simplified': True}
+
+    rows = [(latitude, longitude, date_time)
+            for _, latitude, longitude, date_time, _, _ in iter_run_track(run.id)]
+    if simplify:
+        if tolerance_m is None and max_points is None:
+            tolerance_m = settings.TRACK_SIMPLIFY_TOLERANCE_METERS
+        kept = simplify_track([(latitude, longitude) for latitude, longitude, _ in rows], tolerance_m, max_points)
+        rows = [rows[index] for index in kept]
+
+    track = {
+        'run': run.id,
+        'points': len(rows),
+        'polyline': encode_polyline((latitude, longitude) for latitude, longitude, _ in rows),
+    }
+    if simplify:
+        track['simplified'] = True
+    if timestamps:
+        track['started_at'] = None
+        track['timestamps'] = None
+        times = [date_time for _, _, date_time in rows]
+        if times and all(times):
+            started_at = times[0]
+            track['started_at'] = started_at.strftime(TRACK_DATE_TIME_FORMAT)
+            track['timestamps'] = encode_deltas(round((date_time - started_at).total_seconds() * 1000)
+                                                for date_time in times)
+    return track
+
+
+def build_simplified_track(run_id):
+    points = [(latitude, longitude) for _, latitude, longitude, _, _, _ in iter_run_track(run_id)]
+    kept = simplify_track(points, tolerance_m=settings.TRACK_SIMPLIFY_TOLERANCE_METERS)
+    return encode_polyline(points[index] for index in kept)
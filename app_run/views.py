@@ -1,30 +1,40 @@
-from collections import defaultdict
+from datetime import date
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
-from django.db.models import Q
-from django.db.models import Sum
-from django.db.models.aggregates import Count, Avg
-from django.db.models.functions import Round
+from django.db import IntegrityError, transaction
+from django.db.models import F, Window, FloatField
+from django.db.models.aggregates import Count, Sum
+from django.db.models.functions import Cast, Coalesce, NullIf, RowNumber
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
-from geopy.distance import geodesic
-from openpyxl import load_workbook
 from rest_framework import viewsets, status
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, action
+from rest_framework.exceptions import NotFound, ValidationError as DRFValidationError
 from rest_framework.filters import OrderingFilter
 from rest_framework.filters import SearchFilter
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.views import APIView
 
-from app_run.models import Run, AthleteInfo, Challenge, Positions, CollectibleItem, Subscribe, User
+from app_run.caching import cached
+from app_run.importers import EXPECTED_HEADERS, ITEM_PARSERS, UnsupportedFormat, WrongHeaders, check_headers, \
+    detect_format, import_collectible_items, import_report, iter_rejected_rows_csv
+from app_run.leaderboards import LEADERBOARDS, top_entries, athlete_rank
+from app_run.models import Run, AthleteInfo, Challenge, Positions, CollectibleItem, Subscribe, User, RunRollup, \
+    ImportJob
+from app_run.pagination import PositionsPagination, ChallengeAthletesPagination
 from app_run.serializers import RunSerializer, UserListSerializer, AthleteInfoSerializer, ChallengeSerializer, \
-    PositionsSerializer, CollectibleItemSerializer, CoachDetailSerializer, AthleteDetailSerializer
-from app_run.utils import award_challenge_if_completed_run_10, calculate_run_time_in_seconds
-from .utils import calculate_and_save_run_distance, award_challenge_if_completed_run_50km, collect_item_if_nearby
+    PositionsSerializer, CollectibleItemSerializer, CoachDetailSerializer, AthleteDetailSerializer, \
+    PositionsBulkSerializer, ImportJobSerializer, NearbyCollectibleItemSerializer
+from app_run.tasks import enqueue
+from .utils import collect_item_if_nearby, \
+    calculate_position_distance_and_speed, create_positions_batch, \
+    TRACK_EXPORT_TYPES, iter_run_track, encoded_track, archived_position, archived_positions, coach_analytics, \
+    period_start, collectible_items_near, collectible_items_in_box, recompute_run_totals
 
 
 @api_view(['GET'])
@@ -36,10 +46,35 @@ def company_details(request):
     })
 
 
+MAX_ANALYTICS_COACHES = 100
+LEADERBOARD_SIZE = 100
+MAX_LEADERBOARD_SIZE = 1000
+MAX_ROLLUP_PERIODS = 400
+
+
 class Pagination(PageNumberPagination):
     page_size_query_param = 'size'
 
 
+def _query_flag(request, name):
+    return request.query_params.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def _track_options(request):
+    options = {
+        'timestamps': _query_flag(request, 'timestamps'),
+        'simplify': _query_flag(request, 'simplify'),
+    }
+    try:
+        if 'tolerance' in request.query_params:
+            options['tolerance_m'] = float(request.query_params['tolerance'])
+        if 'points' in request.query_params:
+            options['max_points'] = int(request.query_params['points'])
+    except ValueError:
+        raise DRFValidationError({'message': 'tolerance must be a number of metres and points an integer'})
+    return options
+
+
 class RunViewSet(viewsets.ModelViewSet):
     queryset = Run.objects.all().select_related('athlete')
     serializer_class = RunSerializer
@@ -48,6 +83,27 @@ class RunViewSet(viewsets.ModelViewSet):
     ordering_fields = ('created_at',)
     pagination_class = Pagination
 
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        data = self.get_serializer(instance).data
+        if request.query_params.get('track') == 'polyline':
+            data['track'] = encoded_track(instance, **_track_options(request))
+        return Response(data)
+
+
+@api_view(['GET'])
+def export_run_track(request, id):
+    run = get_object_or_404(Run, id=id)
+    export_type = request.query_params.get('type', 'ndjson')
+    if export_type not in TRACK_EXPORT_TYPES:
+        return Response({'message': f'type must be one of: {", ".join(TRACK_EXPORT_TYPES)}'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    content_type, render = TRACK_EXPORT_TYPES[export_type]
+    response = StreamingHttpResponse(render(iter_run_track(run.id)), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="run-{run.id}.{export_type}"'
+    return response
+
 
 class RunStarView(APIView):
     def post(self, request, id):
@@ -65,21 +121,14 @@ class RunStarView(APIView):
 
 class RunStopView(APIView):
     def post(self, request, id):
-        run = get_object_or_404(
-            Run.objects.annotate(
-                speed_avg=Round(Avg('positions__speed'), 2)),
-            id=id)
+        run = get_object_or_404(Run, id=id)
         if run.status == Run.Status.IN_PROGRESS:
-            run.status = Run.Status.FINISHED
-            run.run_time_seconds = calculate_run_time_in_seconds(run)
-            run.speed = run.speed_avg
-            run.save()
-            award_challenge_if_completed_run_10(athlete_id=run.athlete.id)
-            distance = calculate_and_save_run_distance(run_id=id)
-            award_challenge_if_completed_run_50km(athlete_id=run.athlete.id)
-
-            if distance >= 2 and run.run_time_seconds <= 600:
-                Challenge.objects.create(athlete=run.athlete, full_name=Challenge.NameChoices.RUN2KMIN10M)
+            # Both or neither: a finished run without its task would never be finalized, nor stopped again
+            with transaction.atomic():
+                run.status = Run.Status.FINISHED
+                run.stats_status = Run.StatsStatus.PENDING
+                run.save(update_fields=['status', 'stats_status'])
+                enqueue('finalize_run', {'run_id': run.id}, idempotency_key=f'finalize_run:{run.id}')
 
             return Response({'message':
                                  'Run has finished'},
@@ -92,8 +141,8 @@ class RunStopView(APIView):
 class UserViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = (get_user_model().objects.
                 exclude(is_superuser=True).
-                annotate(runs_finished=Count('runs', filter=Q(runs__status=Run.Status.FINISHED)),
-                         rating=Avg('followers__rating'), ))
+                annotate(runs_finished=Coalesce('stats__runs_finished', 0),
+                         rating=Cast('stats__rating_sum', FloatField()) / NullIf('stats__rating_count', 0), ))
 
     filter_backends = (SearchFilter, OrderingFilter)
     search_fields = 'first_name', 'last_name'
@@ -166,8 +215,22 @@ class ChallengesView(viewsets.ReadOnlyModelViewSet):
         return Challenge.objects.all().select_related('athlete')
 
 
+def _check_positions_editable(position):
+    # Positions of finished runs are already rolled into the run, the athlete's stats and the archive
+    if position.run.status != Run.Status.IN_PROGRESS:
+        raise DRFValidationError({'message': f'Positions can only be changed while the run is in progress; '
+                                              f'current status:{position.run.status}'})
+
+
 class PositionsViewSet(viewsets.ModelViewSet):
+    """
+    Positions of runs, read from the table or from the run's archive once archive_runs has packed it.
+
+    Detail lookups and ``?run=`` listings cover both. The unfiltered list only walks the positions table:
+    archived runs are listed run by run.
+    """
     serializer_class = PositionsSerializer
+    pagination_class = PositionsPagination
 
     def perform_create(self, serializer):
         latitude = serializer.validated_data.get('latitude')
@@ -176,31 +239,66 @@ class PositionsViewSet(viewsets.ModelViewSet):
         run = serializer.validated_data.get('run')
         previous_position = Positions.objects.filter(run=run).order_by('-id').first()
 
-        position_distance = 0
-        speed = 0
-        if previous_position:
-            distance_to_previous = round(geodesic((latitude, longitude),
-                                                  (previous_position.latitude, previous_position.longitude)).kilometers,
-                                         2)
-            if previous_position.distance:
-                position_distance = previous_position.distance + distance_to_previous
-            else:
-                position_distance = distance_to_previous
-
-            time_from_previous = (
-                    serializer.validated_data.get('date_time') - previous_position.date_time).total_seconds()
-
-            if time_from_previous:
-                speed = round(distance_to_previous * 1000 / time_from_previous, 2)
+        position_distance, speed = calculate_position_distance_and_speed(previous_position,
+                                                                         latitude,
+                                                                         longitude,
+                                                                         serializer.validated_data.get('date_time'))
 
-        instance = serializer.save(distance=position_distance,
-                                   speed=speed)
+        with transaction.atomic():
+            instance = serializer.save(distance=position_distance,
+                                       speed=speed)
         collect_item_if_nearby(
             latitude=latitude,
             longitude=longitude,
             user=instance.run.athlete
         )
 
+    def perform_update(self, serializer):
+        _check_positions_editable(serializer.instance)
+        serializer.save()
+
+    def perform_destroy(self, instance):
+        _check_positions_editable(instance)
+        with transaction.atomic():
+            instance.delete()
+            recompute_run_totals(instance.run_id)
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        serializer = PositionsBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        positions = create_positions_batch(run=serializer.validated_data['run'],
+                                           fixes=serializer.validated_data['positions'])
+        return Response(PositionsSerializer(positions, many=True).data,
+                        status=status.HTTP_201_CREATED)
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('track') == 'polyline':
+            run_id = request.query_params.get('run', None)
+            if not run_id:
+                return Response({'message': 'run parameter is required for the polyline track'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            run = get_object_or_404(Run, id=run_id)
+            return Response(encoded_track(run, **_track_options(request)))
+
+        run_id = request.query_params.get('run', '')
+        positions = archived_positions(int(run_id)) if run_id.isdigit() else None
+        if positions is not None:
+            page = self.paginator.paginate_list(positions, request)
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return super().list(request, *args, **kwargs)
+
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            pk = self.kwargs[self.lookup_field]
+            position = archived_position(int(pk)) if str(pk).isdigit() else None
+            run_id = self.request.query_params.get('run', None)
+            if position is None or (run_id and str(position.run_id) != run_id):
+                raise
+            return position
+
     def get_queryset(self):
         qs = Positions.objects.all()
         run_id = self.request.query_params.get('run', None)
@@ -209,64 +307,181 @@ class PositionsViewSet(viewsets.ModelViewSet):
         return qs
 
 
+def _import_format(file):
+    if file is None:
+        raise DRFValidationError({'message': 'file field is required'})
+    try:
+        return detect_format(file.name, file.content_type)
+    except UnsupportedFormat as e:
+        raise DRFValidationError({'message': str(e)})
+
+
 @api_view(['POST'])
 def upload_file(request):
     file = request.FILES.get('file')
-    EXPECTED_HEADERS = ['Name', 'UID', 'Value', 'Latitude', 'Longitude', 'URL']
-    wb = load_workbook(file)
-    ws = wb.active
-
-    headers = [cell.value for cell in next(ws.iter_rows(max_row=1))]
-    if headers != EXPECTED_HEADERS:
+    rows = ITEM_PARSERS[_import_format(file)].iter_rows(file)
+    try:
+        check_headers(rows)
+    except WrongHeaders as e:
+        rows.close()
         return Response({
             'error': 'Wrong headers',
             'expected': EXPECTED_HEADERS,
-            'got': headers,
+            'got': e.headers,
         }, status=status.HTTP_400_BAD_REQUEST)
 
-    invalid_rows = []
-    for row in ws.iter_rows(min_row=2, values_only=True):
-        if all(cell is None for cell in row):
-            continue
-        data = {
-            'name': row[0],
-            'uid': row[1],
-            'value': row[2],
-            'latitude': row[3],
-            'longitude': row[4],
-            'picture': row[5]
-        }
-        serializer = CollectibleItemSerializer(data=data)
-        if serializer.is_valid():
-            serializer.save()
-        else:
-            invalid_rows.append(row)
-    return Response(invalid_rows)
+    return Response(import_report(import_collectible_items(rows)))
+
+
+@api_view(['POST'])
+def import_jobs(request):
+    file = request.FILES.get('file')
+    file_format = _import_format(file)
+    # The file is kept in the job row until a worker imports it, and read whole on both sides
+    if file.size > settings.IMPORT_JOB_MAX_FILE_BYTES:
+        return Response({'message': f'file must be at most {settings.IMPORT_JOB_MAX_FILE_BYTES} bytes'},
+                        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    with transaction.atomic():
+        job = ImportJob.objects.create(file_name=file.name, format=file_format, data=file.read())
+        enqueue('import_items', {'job_id': job.id}, idempotency_key=f'import_items:{job.id}')
+    job = ImportJob.objects.defer('data').get(id=job.id)
+    return Response(ImportJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['GET'])
+def import_job(request, job_id):
+    job = get_object_or_404(ImportJob.objects.defer('data'), id=job_id)
+    return Response(ImportJobSerializer(job).data)
+
+
+@api_view(['GET'])
+def import_job_rejected_rows(request, job_id):
+    job = get_object_or_404(ImportJob.objects.only('id'), id=job_id)
+    rows = job.rejected_rows.order_by('id').values_list('row', flat=True).iterator(chunk_size=2000)
+    response = StreamingHttpResponse(iter_rejected_rows_csv(rows), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="import-{job.id}-rejected.csv"'
+    return response
+
+
+class NearbyItemsPagination(Pagination):
+    page_size = 50
+    max_page_size = 500
+
+
+MAX_NEARBY_RADIUS_METERS = 50000
+MAX_NEARBY_BOX_DEGREES = 1.0
+
+
+def _float_param(request, name, low, high):
+    try:
+        value = float(request.query_params[name])
+    except (KeyError, ValueError):
+        raise DRFValidationError({'message': f'{name} must be a number'})
+    if not low <= value <= high:
+        raise DRFValidationError({'message': f'{name} must be in the [{low}; {high}] range'})
+    return value
 
 
 class CollectibleItemViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    The whole catalog, or with ``?lat=&lon=&radius=`` (metres) the items around a point and with
+    ``?min_lat=&min_lon=&max_lat=&max_lon=`` the items in a box, nearest first and paginated.
+    """
     serializer_class = CollectibleItemSerializer
     queryset = CollectibleItem.objects.all()
 
+    def list(self, request, *args, **kwargs):
+        params = request.query_params
+        if {'lat', 'lon', 'radius'} & params.keys():
+            items = collectible_items_near(_float_param(request, 'lat', -90, 90),
+                                           _float_param(request, 'lon', -180, 180),
+                                           _float_param(request, 'radius', 0, MAX_NEARBY_RADIUS_METERS))
+        elif {'min_lat', 'min_lon', 'max_lat', 'max_lon'} & params.keys():
+            min_lat = _float_param(request, 'min_lat', -90, 90)
+            max_lat = _float_param(request, 'max_lat', min_lat, 90)
+            min_lon = _float_param(request, 'min_lon', -180, 180)
+            max_lon = _float_param(request, 'max_lon', -180, 180)
+            # min_lon > max_lon is a box across the antimeridian; -180 to 180 is the whole globe, not a 0 wide box
+            width = max_lon - min_lon if min_lon <= max_lon else max_lon - min_lon + 360
+            if max_lat - min_lat > MAX_NEARBY_BOX_DEGREES or max_lon - min_lon >= 360 \
+                    or width > MAX_NEARBY_BOX_DEGREES:
+                raise DRFValidationError(
+                    {'message': f'The box can be at most {MAX_NEARBY_BOX_DEGREES} degrees on each side'})
+            items = collectible_items_in_box(min_lat, min_lon, max_lat, max_lon)
+        else:
+            return super().list(request, *args, **kwargs)
+
+        paginator = NearbyItemsPagination()
+        page = paginator.paginate_queryset(items, request, view=self)
+        return paginator.get_paginated_response(NearbyCollectibleItemSerializer(page, many=True).data)
+
+
+def _challenge_athlete(athlete_id, username, first_name, last_name):
+    return {
+        'id': athlete_id,
+        'username': username,
+        'full_name': f'{first_name} {last_name}'.strip(),
+    }
+
 
 @api_view(['GET'])
 def challenge_summary(request):
-    challenges = Challenge.objects.select_related('athlete').all()
-    challenges_dict = defaultdict(list)
-    for challenge in challenges:
-        challenges_dict[challenge.get_full_name_display()].append({
-            'id': challenge.athlete.id,
-            'username': challenge.athlete.username,
-            'full_name': challenge.athlete.get_full_name(),
-        })
-
+    paginator = ChallengeAthletesPagination()
+    challenge = request.query_params.get('challenge')
+    if challenge is not None:
+        if challenge not in Challenge.NameChoices.values:
+            return Response({'message': f'challenge must be one of: {", ".join(Challenge.NameChoices.values)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        challenges = paginator.paginate_queryset(
+            Challenge.objects.filter(full_name=challenge).select_related('athlete'), request)
+        return paginator.get_paginated_response([
+            _challenge_athlete(item.athlete_id, item.athlete.username, item.athlete.first_name,
+                               item.athlete.last_name)
+            for item in challenges])
+
+    page_size = paginator.get_page_size(request)
+
+    def compute():
+        # The first page_size athletes of every challenge, numbered and counted by the database
+        rows = (Challenge.objects
+                .annotate(position=Window(RowNumber(), partition_by=F('full_name'), order_by=F('athlete_id').asc()),
+                          athletes_count=Window(Count('id'), partition_by=F('full_name')))
+                .filter(position__lte=page_size)
+                .order_by('full_name', 'athlete_id')
+                .values_list('full_name', 'athletes_count', 'athlete_id', 'athlete__username',
+                             'athlete__first_name', 'athlete__last_name'))
+        summary = {}
+        for full_name, athletes_count, *athlete in rows:
+            summary.setdefault(full_name, {'count': athletes_count, 'athletes': []})
+            summary[full_name]['athletes'].append(_challenge_athlete(*athlete))
+
+        data = []
+        for choice in Challenge.NameChoices:
+            if choice.value not in summary:
+                continue
+            athletes = summary[choice.value]['athletes']
+            next_cursor = None
+            if summary[choice.value]['count'] > len(athletes):
+                next_cursor = paginator.encode_cursor([athletes[-1]['id']])
+            data.append({
+                'full_name': choice.value,
+                'name_to_display': choice.label,
+                'count': summary[choice.value]['count'],
+                'athletes': athletes,
+                'next': next_cursor,
+            })
+        return data
+
+    # Keyed by the page size alone, the only parameter the summary depends on, so other query parameters
+    # can't multiply the entries; the next links are built per request from the path and that page size
+    base_url = replace_query_param(request.build_absolute_uri(request.path), paginator.page_size_query_param,
+                                   page_size)
     data = []
-    for key, value in challenges_dict.items():
-        data.append({
-            'name_to_display': key,
-            'athletes': value
-        })
-
+    for row in cached('challenge_summary', f'size={page_size}', compute):
+        if row['next'] is not None:
+            next_link = replace_query_param(base_url, 'challenge', row['full_name'])
+            row = {**row, 'next': replace_query_param(next_link, paginator.cursor_query_param, row['next'])}
+        data.append(row)
     return Response(data, status=status.HTTP_200_OK)
 
 
@@ -328,7 +543,9 @@ def rate_coach(request, coach_id):
         subscribe.full_clean()
     except ValidationError as e:
         return Response({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
-    subscribe.save()
+    with transaction.atomic():
+        # The subscription signal folds the new rating into the coach's stats row in the same transaction
+        subscribe.save()
     return Response({f'message': 'Coach was successfully rated'}, status=status.HTTP_200_OK)
 
 
@@ -340,39 +557,117 @@ def analytics_for_coach(request, coach_id):
             {'message': f'User is not a coach'},
             status=status.HTTP_400_BAD_REQUEST)
 
-    longest_run = Run.objects.filter(athlete__subscriptions__subscribed_to_id=coach_id).order_by('-distance').first()
-
-    max_total_run_distance_athlete = (
-        User.objects
-        .filter(subscriptions__subscribed_to_id=coach_id)
-        .annotate(total_distance=Sum('runs__distance')).order_by('-total_distance').first()
-    )
-    # max_total_run_distance_athlete = (
-    #     User.objects
-    #     .filter(subscriptions__subscribed_to_id=coach_id)
-    #     .annotate(total_distance=Coalesce(Sum('runs__distance'), Value(0), output_field=FloatField()))
-    #     .order_by('-total_distance')
-    #     .first()
-    # )
-
-    max_avg_run_speed_athlete = (
-        User.objects
-        .filter(subscriptions__subscribed_to_id=coach_id)
-        .annotate(avg_speed=Avg('runs__speed')).order_by('-avg_speed').first()
-    )
+    return Response(cached('coach_analytics', coach.id, lambda: coach_analytics([coach.id])[coach.id]),
+                    status=status.HTTP_200_OK)
 
-    return Response({
 
-        'longest_run_user': longest_run.athlete_id,
+@api_view(['GET'])
+def analytics_for_coaches(request):
+    try:
+        coach_ids = list(dict.fromkeys(int(coach_id) for coach_id in
+                                       request.query_params.get('coach_ids', '').split(',') if coach_id))
+    except ValueError:
+        return Response({'message': 'coach_ids must be a comma-separated list of ids'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if not coach_ids or len(coach_ids) > MAX_ANALYTICS_COACHES:
+        return Response({'message': f'coach_ids must list between 1 and {MAX_ANALYTICS_COACHES} coaches'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    coaches = set(User.objects.filter(id__in=coach_ids, is_staff=True).values_list('id', flat=True))
+    not_coaches = [coach_id for coach_id in coach_ids if coach_id not in coaches]
+    if not_coaches:
+        return Response({'message': 'Users are not coaches', 'coach_ids': not_coaches},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    analytics = cached('coach_analytics', ','.join(map(str, coach_ids)), lambda: coach_analytics(coach_ids))
+    return Response([{'coach_id': coach_id, **analytics[coach_id]} for coach_id in coach_ids],
+                    status=status.HTTP_200_OK)
 
-        'longest_run_value': longest_run.distance,
 
-        'total_run_user': max_total_run_distance_athlete.id,
+def _leaderboard_options(request, board):
+    if board not in LEADERBOARDS:
+        raise NotFound(f'Unknown leaderboard, expected one of: {", ".join(LEADERBOARDS)}')
+    try:
+        coach_id = int(request.query_params['coach']) if 'coach' in request.query_params else None
+    except ValueError:
+        raise DRFValidationError({'message': 'coach must be a user id'})
+    if coach_id is not None and not User.objects.filter(id=coach_id, is_staff=True).exists():
+        raise DRFValidationError({'message': 'User is not a coach'})
+    return coach_id
 
-        'total_run_value': max_total_run_distance_athlete.total_distance,
 
-        'speed_avg_user': max_avg_run_speed_athlete.id,
+def _leaderboard_row(rank, entry):
+    return {
+        'rank': rank,
+        'athlete': entry.athlete_id,
+        'score': entry.score,
+    }
+
+
+@api_view(['GET'])
+def leaderboard(request, board):
+    coach_id = _leaderboard_options(request, board)
+    try:
+        size = int(request.query_params.get('size', LEADERBOARD_SIZE))
+    except ValueError:
+        raise DRFValidationError({'message': 'size must be an integer'})
+    size = min(max(size, 1), MAX_LEADERBOARD_SIZE)
+
+    results = []
+    for rank, entry in top_entries(board, size, coach_id=coach_id):
+        row = _leaderboard_row(rank, entry)
+        row['username'] = entry.athlete.username
+        row['full_name'] = entry.athlete.get_full_name()
+        results.append(row)
+    return Response({'board': board, 'coach': coach_id, 'results': results}, status=status.HTTP_200_OK)
 
-        'speed_avg_value': max_avg_run_speed_athlete.avg_speed,
 
-    }, status=status.HTTP_200_OK)
+@api_view(['GET'])
+def leaderboard_rank(request, board, athlete_id):
+    coach_id = _leaderboard_options(request, board)
+    ranked = athlete_rank(board, athlete_id, coach_id=coach_id)
+    if ranked is None:
+        return Response({'message': 'Athlete is not on this leaderboard'}, status=status.HTTP_404_NOT_FOUND)
+    return Response({'board': board, 'coach': coach_id, **_leaderboard_row(*ranked)}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def run_rollups(request):
+    granularity = request.query_params.get('granularity')
+    if granularity not in RunRollup.Granularity.values:
+        return Response({'message': f'granularity must be one of: {", ".join(RunRollup.Granularity.values)}'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    try:
+        athlete_id = int(request.query_params['athlete']) if 'athlete' in request.query_params else None
+        coach_id = int(request.query_params['coach']) if 'coach' in request.query_params else None
+        date_from = date.fromisoformat(request.query_params['from']) if 'from' in request.query_params else None
+        date_to = date.fromisoformat(request.query_params['to']) if 'to' in request.query_params else None
+    except ValueError:
+        return Response({'message': 'athlete and coach must be user ids, from and to dates as YYYY-MM-DD'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if (athlete_id is None) == (coach_id is None):
+        return Response({'message': 'Exactly one of athlete or coach is required'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    rollups = RunRollup.objects.filter(granularity=granularity)
+    if athlete_id is not None:
+        rollups = rollups.filter(athlete_id=athlete_id)
+    else:
+        rollups = rollups.filter(athlete__subscriptions__subscribed_to_id=coach_id)
+    if date_from:
+        rollups = rollups.filter(period_start__gte=period_start(date_from, granularity))
+    if date_to:
+        rollups = rollups.filter(period_start__lte=date_to)
+
+    # A coach's chart sums their athletes' rows for each period
+    rows = (rollups.values('period_start')
+            .annotate(runs=Sum('runs_count'), total_distance=Sum('distance'), total_time=Sum('run_time_seconds'),
+                      total_speed=Sum('speed_sum'), speeds=Sum('speed_count'))
+            .order_by('-period_start')[:MAX_ROLLUP_PERIODS])
+    return Response([{
+        'period_start': row['period_start'],
+        'runs_count': row['runs'],
+        'distance': row['total_distance'],
+        'run_time_seconds': row['total_time'],
+        'avg_speed': row['total_speed'] / row['speeds'] if row['speeds'] else None,
+    } for row in reversed(rows)], status=status.HTTP_200_OK)
@@ -115,3 +115,48 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 COMPANY_NAME = 'Blade Runer'
 SLOGAN = 'Standing still is just moving backward slowly'
 CONTACTS = '57th Street, New New York, NY 10001'
+
+# Engine used for run track lengths: 'vincenty' and 'haversine' are vectorized,
+# 'geodesic' is the exact (and slow) geopy implementation.
+RUN_DISTANCE_ENGINE = 'vincenty'
+
+# Default page size of the positions API; clients may ask for up to 10000 with ?size=
+POSITIONS_PAGE_SIZE = 1000
+
+# Douglas-Peucker tolerance of the display-resolution track stored for finished runs
+TRACK_SIMPLIFY_TOLERANCE_METERS = 5
+
+# Background tasks (app_run.tasks) are stored in the database and run by `manage.py run_worker`.
+# With TASK_QUEUE_EAGER they run inside the request that queued them, no worker needed.
+TASK_QUEUE_EAGER = False
+TASK_RETRY_DELAY_SECONDS = 10
+TASK_LOCK_TIMEOUT_SECONDS = 600
+
+# Largest file accepted by the import jobs API, which keeps the file in the job row until a worker imports it
+IMPORT_JOB_MAX_FILE_BYTES = 20 * 1024 * 1024
+
+# Shared by every web and worker process: the collectible items catalog version and the response cache
+# below must be seen by all of them. Create the tables with `manage.py createcachetable`.
+# The response cache has its own table, so its entries never cull the catalog version.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_response_cache',
+    },
+}
+
+# Stale-while-revalidate cache of read-heavy endpoints (app_run.caching): entries are fresh for `ttl`
+# seconds and then served for up to `stale_ttl` more while one request recomputes them.
+RESPONSE_CACHE = {
+    'challenge_summary': {'ttl': 30, 'stale_ttl': 300},
+    'coach_analytics': {'ttl': 60, 'stale_ttl': 600},
+}
+RESPONSE_CACHE_ALIAS = 'responses'
+RESPONSE_CACHE_LOCK_SECONDS = 30
+# Refresh stale entries in a thread after responding. Only for long-lived processes: on Lambda the
+# process may be frozen as soon as it responds, so the request serving a stale entry refreshes it.
+RESPONSE_CACHE_REFRESH_IN_BACKGROUND = False
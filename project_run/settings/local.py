@@ -9,6 +9,19 @@ DATABASES = {
         'NAME': BASE_DIR / 'db.sqlite3',
     }
 }
+
+TASK_QUEUE_EAGER = True
+
+# A single process with eager tasks has nothing to share its cache with
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+    },
+}
 #
 # LOGGING = {
 #     "version": 1,
@@ -20,7 +20,8 @@ from rest_framework.routers import DefaultRouter
 
 from app_run.views import company_details, RunViewSet, UserViewSet, RunStarView, RunStopView, AthleteInfoView, \
     ChallengesView, PositionsViewSet, upload_file, CollectibleItemViewSet, challenge_summary, subscribe_coach, \
-    rate_coach, analytics_for_coach
+    rate_coach, analytics_for_coach, analytics_for_coaches, export_run_track, \
+    leaderboard, leaderboard_rank, run_rollups, import_jobs, import_job, import_job_rejected_rows
 
 router = DefaultRouter()
 router.register('api/runs', RunViewSet, basename='runs')
@@ -34,12 +35,20 @@ urlpatterns = [
     path('', include(router.urls)),
     path('api/runs/<int:id>/start/', RunStarView.as_view(), name='run-start'),
     path('api/runs/<int:id>/stop/', RunStopView.as_view(), name='run-stop'),
+    path('api/runs/<int:id>/export/', export_run_track, name='run-export'),
     path('api/athlete_info/<int:user_id>/', AthleteInfoView.as_view(), name='athlete-info'),
     path('api/challenges/', ChallengesView.as_view({'get': 'list'}), name='challenges'),
     path('api/upload_file/', upload_file, name='upload-file'),
+    path('api/import_jobs/', import_jobs, name='import-jobs'),
+    path('api/import_jobs/<int:job_id>/', import_job, name='import-job'),
+    path('api/import_jobs/<int:job_id>/rejected/', import_job_rejected_rows, name='import-job-rejected'),
     path('api/challenges_summary/', challenge_summary, name='challenges-summary'),
     path('api/subscribe_to_coach/<int:coach_id>/', subscribe_coach, name='subscribe-coach'),
     path('api/rate_coach/<int:coach_id>/', rate_coach, name='rate-coach'),
     path('api/analytics_for_coach/<int:coach_id>/', analytics_for_coach, name='analytics-for-coach'),
+    path('api/analytics_for_coach/', analytics_for_coaches, name='analytics-for-coaches'),
+    path('api/leaderboards/<str:board>/', leaderboard, name='leaderboard'),
+    path('api/leaderboards/<str:board>/<int:athlete_id>/', leaderboard_rank, name='leaderboard-rank'),
+    path('api/run_rollups/', run_rollups, name='run-rollups'),
 
 ]